@@ -1,13 +1,219 @@
 import json
 import os
+import re
+import time
 import psycopg2
-from typing import Dict, Any
+from typing import Dict, Any, Tuple, Optional
 from datetime import datetime, timedelta
 
+SUMMARY_DEFAULT_DAYS = 30
+SUMMARY_MAX_DAYS = 366
+SUCCESS_STATUSES = ('AUTHORIZED', 'CONFIRMED')
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Min-LSN',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT shard, status FROM t_p83864310_fintech_payment_reco.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+# Реплики для чтения по шардам: {"main": "postgres://replica...", "shard-2": "..."}.
+# Шард без реплики, отставшая или недоступная реплика — чтение с primary
+REPLICA_DSNS: Dict[str, str] = json.loads(os.environ.get('REPLICA_DSNS') or '{}')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_RETRY_SECONDS = 10
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+_replica_skip_until: Dict[str, float] = {}
+
+def read_min_lsn(event: Dict[str, Any]) -> Optional[str]:
+    '''
+    X-Min-LSN клиента — X-Write-LSN его последней записи: реплика должна догнать этот LSN
+    '''
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    value = (headers.get('x-min-lsn') or '').strip()
+    return value if LSN_PATTERN.match(value) else None
+
+def get_read_connection(owner_id: Any, min_lsn: Optional[str] = None) -> Tuple[Any, str]:
+    '''
+    Соединение для чтения: реплика шарда, если лаг не больше REPLICA_MAX_LAG_SECONDS и она проиграла
+    min_lsn (чтение своих записей), иначе primary. Отставшая или недоступная реплика пропускается
+    на REPLICA_RETRY_SECONDS, чтобы не платить за проверку в каждом запросе
+    Returns: (conn, 'replica' | 'primary')
+    '''
+    shard, _ = resolve_shard(owner_id)
+    replica_dsn = REPLICA_DSNS.get(shard)
+    if replica_dsn and _replica_skip_until.get(shard, 0) <= time.monotonic():
+        try:
+            conn = psycopg2.connect(replica_dsn)
+        except psycopg2.OperationalError as e:
+            print(f"[DEBUG] Replica {shard} unavailable: {str(e).strip()}")
+            _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+        else:
+            cur = conn.cursor()
+            # Реплика, проигравшая все полученное, не отстает, даже если на primary давно не было записей
+            cur.execute('''
+                SELECT
+                    CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                         ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END,
+                    %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+            ''', (min_lsn, min_lsn))
+            lag_seconds, caught_up = cur.fetchone()
+            cur.close()
+            if lag_seconds <= REPLICA_MAX_LAG_SECONDS and caught_up:
+                return conn, 'replica'
+            conn.close()
+            if lag_seconds > REPLICA_MAX_LAG_SECONDS:
+                print(f"[DEBUG] Replica {shard} lag {float(lag_seconds):.1f}s, reading from primary")
+                _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+    return psycopg2.connect(shard_dsn(shard)), 'primary'
+
+def to_rubles(kopecks: int) -> float:
+    '''
+    Суммы считаются в копейках (SUM по BIGINT), в рубли переводятся только в ответе
+    '''
+    return kopecks / 100
+
+def build_summary(cur, owner_id: str, days: int) -> Dict[str, Any]:
+    '''
+    Сводка для главной страницы за один проход по каждой таблице (GROUPING SETS):
+    разбивки по статусу, провайдеру и дням плюс итоги, без выгрузки строк на клиент.
+    Платеж считается один раз — по последнему статусу; дни — только последние days
+    '''
+    since = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    
+    cur.execute('''
+        WITH latest AS (
+            SELECT DISTINCT ON (wp.integration_id, wp.payment_id)
+                wp.status, wp.amount_kopecks, wp.created_at, p.name AS provider
+            FROM t_p83864310_fintech_payment_reco.webhook_payments wp
+            JOIN t_p83864310_fintech_payment_reco.user_integrations ui ON ui.id = wp.integration_id
+            JOIN t_p83864310_fintech_payment_reco.integration_providers p ON p.id = ui.provider_id
+            WHERE wp.owner_id = %s
+            ORDER BY wp.integration_id, wp.payment_id, wp.created_at DESC
+        )
+        SELECT
+            GROUPING(status) AS g_status,
+            GROUPING(provider) AS g_provider,
+            GROUPING(day) AS g_day,
+            status,
+            provider,
+            day,
+            COUNT(*),
+            COALESCE(SUM(amount_kopecks), 0)::bigint,
+            COUNT(*) FILTER (WHERE status IN %s),
+            COALESCE(SUM(amount_kopecks) FILTER (WHERE status IN %s), 0)::bigint
+        FROM (
+            SELECT status, amount_kopecks, provider,
+                   CASE WHEN created_at >= %s THEN DATE(created_at) END AS day
+            FROM latest
+        ) l
+        GROUP BY GROUPING SETS ((status), (provider), (day), ())
+    ''', (owner_id, SUCCESS_STATUSES, SUCCESS_STATUSES, since))
+    
+    payments: Dict[str, Any] = {'total': 0, 'successful': 0, 'amount': 0.0, 'revenue': 0.0,
+                                'by_status': [], 'by_provider': [], 'by_day': []}
+    for g_status, g_provider, g_day, status, provider, day, count, amount, successful, revenue in cur.fetchall():
+        if g_status and g_provider and g_day:
+            payments.update({'total': count, 'amount': to_rubles(amount), 'successful': successful, 'revenue': to_rubles(revenue)})
+        elif not g_status:
+            payments['by_status'].append({'status': status, 'count': count, 'amount': to_rubles(amount)})
+        elif not g_provider:
+            payments['by_provider'].append({'provider': provider, 'count': count, 'successful': successful, 'revenue': to_rubles(revenue)})
+        elif day is not None:
+            payments['by_day'].append({'date': day.isoformat(), 'count': count, 'successful': successful, 'revenue': to_rubles(revenue)})
+    
+    cur.execute('''
+        SELECT
+            GROUPING(operation_type) AS g_type,
+            GROUPING(day) AS g_day,
+            operation_type,
+            day,
+            COUNT(*),
+            COALESCE(SUM(total_kopecks), 0)::bigint
+        FROM (
+            SELECT operation_type, total_kopecks,
+                   CASE WHEN doc_datetime >= %s THEN DATE(doc_datetime) END AS day
+            FROM t_p83864310_fintech_payment_reco.ofd_receipts
+            WHERE owner_id = %s
+        ) r
+        GROUP BY GROUPING SETS ((operation_type), (day), ())
+    ''', (since, owner_id))
+    
+    receipts: Dict[str, Any] = {'total': 0, 'sum': 0.0, 'by_operation_type': [], 'by_day': []}
+    for g_type, g_day, operation_type, day, count, total_sum in cur.fetchall():
+        if g_type and g_day:
+            receipts.update({'total': count, 'sum': to_rubles(total_sum)})
+        elif not g_type:
+            receipts['by_operation_type'].append({'operation_type': operation_type, 'count': count, 'sum': to_rubles(total_sum)})
+        elif day is not None:
+            receipts['by_day'].append({'date': day.isoformat(), 'count': count, 'sum': to_rubles(total_sum)})
+    
+    cur.execute('''
+        SELECT COUNT(*), COUNT(*) FILTER (WHERE status = 'active')
+        FROM t_p83864310_fintech_payment_reco.user_integrations
+        WHERE owner_id = %s
+    ''', (owner_id,))
+    integrations_total, integrations_active = cur.fetchone()
+    
+    for breakdown in (payments['by_day'], receipts['by_day']):
+        breakdown.sort(key=lambda item: item['date'])
+    payments['by_status'].sort(key=lambda item: -item['count'])
+    
+    return {
+        'days': days,
+        'since': since.date().isoformat(),
+        'payments': payments,
+        'receipts': receipts,
+        'integrations': {'total': integrations_total, 'active': integrations_active}
+    }
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Получение статистики для дашборда: платежи, чеки, выручка
-    Args: owner_id
+    Args: owner_id; view=summary&days=30 — агрегаты для главной страницы (build_summary)
     Returns: статистика за разные периоды
     '''
     
@@ -16,12 +222,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': CORS_PREFLIGHT_HEADERS,
             'body': '',
             'isBase64Encoded': False
         }
@@ -38,16 +239,35 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     owner_id = params.get('owner_id', '1')
     
     try:
-        dsn = os.environ['DATABASE_URL']
-        conn = psycopg2.connect(dsn)
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        return json_response(400, {'success': False, 'error': 'owner_id must be a number'})
+    
+    if params.get('view') == 'summary':
+        try:
+            days = max(1, min(int(params.get('days', SUMMARY_DEFAULT_DAYS)), SUMMARY_MAX_DAYS))
+        except ValueError:
+            return json_response(400, {'success': False, 'error': 'days must be a number'})
+    
+    try:
+        conn, read_source = get_read_connection(owner_id, read_min_lsn(event))
         cur = conn.cursor()
+    except psycopg2.OperationalError as e:
+        print(f"[DEBUG] Database unavailable: {str(e).strip()}")
+        return json_response(503, {'success': False, 'error': 'Database unavailable'})
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'success': False, 'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'success': False, 'error': str(e)})
+    
+    if params.get('view') == 'summary':
+        try:
+            summary = build_summary(cur, owner_id, days)
+        except Exception as e:
+            return json_response(500, {'success': False, 'error': str(e)})
+        finally:
+            cur.close()
+            conn.close()
+        
+        return json_response(200, {'success': True, 'summary': summary}, {**JSON_HEADERS, 'Cache-Control': 'private, max-age=30', 'X-Read-Source': read_source})
     
     now = datetime.now()
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -167,27 +387,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     conn.close()
     
-    return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({
-            'success': True,
-            'stats': {
-                'payments_today': webhooks_today or 0,
-                'payments_success_today': payments_success_today or 0,
-                'payments_pending_today': payments_pending_today or 0,
-                'revenue_month': revenue_month,
-                'revenue_growth': round(revenue_growth, 1),
-                'payments_month': payments_month or 0,
-                'receipts_month': receipts_month,
-                'receipts_sum': receipts_sum,
-                'active_integrations': active_integrations,
-                'daily_payments': daily_payments,
-                'recent_transactions': recent_transactions
-            }
-        }),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
+    return json_response(200, {
+        'success': True,
+        'stats': {
+            'payments_today': webhooks_today or 0,
+            'payments_success_today': payments_success_today or 0,
+            'payments_pending_today': payments_pending_today or 0,
+            'revenue_month': revenue_month,
+            'revenue_growth': round(revenue_growth, 1),
+            'payments_month': payments_month or 0,
+            'receipts_month': receipts_month,
+            'receipts_sum': receipts_sum,
+            'active_integrations': active_integrations,
+            'daily_payments': daily_payments,
+            'recent_transactions': recent_transactions
+        }
+    }, {**JSON_HEADERS, 'X-Read-Source': read_source})
\ No newline at end of file
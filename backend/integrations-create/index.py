@@ -1,8 +1,85 @@
 import json
 import os
+import time
 import secrets
 import psycopg2
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+class ShardMovingError(Exception):
+    '''
+    Данные владельца переносятся между шардами (scripts/shard_rebalance.py), запись временно запрещена
+    '''
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT shard, status FROM t_p83864310_fintech_payment_reco.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+def get_connection(owner_id: Any, write: bool = False):
+    '''
+    Соединение с шардом владельца; запись во время переноса — ShardMovingError
+    '''
+    shard, status = resolve_shard(owner_id)
+    if write and status == 'moving':
+        raise ShardMovingError(f'owner {owner_id} is being moved, retry later')
+    return psycopg2.connect(shard_dsn(shard))
+
+def write_lsn_headers(cur) -> Dict[str, str]:
+    '''
+    Заголовки ответа на запись: X-Write-LSN клиент возвращает в X-Min-LSN, чтобы читать свои записи с реплики
+    '''
+    cur.execute('SELECT pg_current_wal_lsn()')
+    return {**JSON_HEADERS, 'Access-Control-Expose-Headers': 'X-Write-LSN', 'X-Write-LSN': cur.fetchone()[0]}
+
+def register_integration_route(cur, integration_id: int, owner_id: Any, webhook_token: str) -> None:
+    cur.execute('''
+        INSERT INTO t_p83864310_fintech_payment_reco.integration_routes (integration_id, owner_id, webhook_token)
+        VALUES (%s, %s, %s)
+    ''', (integration_id, owner_id, webhook_token))
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -15,23 +92,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': CORS_PREFLIGHT_HEADERS,
             'body': '',
             'isBase64Encoded': False
         }
     
     if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return json_response(405, {'error': 'Method not allowed'})
     
     body = json.loads(event.get('body', '{}'))
     owner_id = body.get('owner_id')
@@ -47,17 +114,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     })
     
     if not owner_id or not provider_slug:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'owner_id and provider_slug required'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'owner_id and provider_slug required'})
+    
+    try:
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'owner_id must be a number'})
     
     webhook_token = secrets.token_urlsafe(32)
     
-    dsn = os.environ['DATABASE_URL']
-    conn = psycopg2.connect(dsn)
+    try:
+        conn = get_connection(owner_id, write=True)
+    except ShardMovingError as e:
+        return json_response(503, {'error': str(e)}, {**JSON_HEADERS, 'Retry-After': str(SHARD_CACHE_TTL_SECONDS)})
+    except psycopg2.OperationalError as e:
+        print(f"[DEBUG] Database unavailable: {str(e).strip()}")
+        return json_response(503, {'error': 'Database unavailable'})
+    
     cur = conn.cursor()
     
     try:
@@ -68,12 +141,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         provider_row = cur.fetchone()
         if not provider_row:
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Provider not found'}),
-                'isBase64Encoded': False
-            }
+            return json_response(404, {'error': 'Provider not found'})
         
         provider_id = provider_row[0]
         
@@ -93,30 +161,33 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         ))
         
         integration_id, token = cur.fetchone()
+        
+        # Маршрут токена к владельцу нужен webhook-receive до выбора шарда, поэтому он в основной БД.
+        # Для другого шарда маршрут фиксируется раньше интеграции: маршрут без интеграции дает 404, а не потерю вебхуков
+        if resolve_shard(owner_id)[0] == 'main':
+            register_integration_route(cur, integration_id, owner_id, token)
+        else:
+            main_conn = psycopg2.connect(os.environ['DATABASE_URL'])
+            try:
+                main_cur = main_conn.cursor()
+                register_integration_route(main_cur, integration_id, owner_id, token)
+                main_conn.commit()
+            finally:
+                main_conn.close()
         conn.commit()
         
         webhook_url = f"https://functions.poehali.dev/a923b457-57a6-4eb2-b566-9a9d65cb04e8?token={token}"
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'integration_id': integration_id,
-                'webhook_url': webhook_url,
-                'webhook_token': token
-            }),
-            'isBase64Encoded': False
-        }
+        return json_response(200, {
+            'success': True,
+            'integration_id': integration_id,
+            'webhook_url': webhook_url,
+            'webhook_token': token
+        }, write_lsn_headers(cur))
         
     except Exception as e:
         conn.rollback()
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'error': str(e)})
     finally:
         cur.close()
         conn.close()
\ No newline at end of file
@@ -1,11 +1,110 @@
 import json
 import os
+import time
 import psycopg2
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+class ShardMovingError(Exception):
+    '''
+    Данные владельца переносятся между шардами (scripts/shard_rebalance.py), запись временно запрещена
+    '''
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT shard, status FROM t_p83864310_fintech_payment_reco.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+def get_connection(owner_id: Any, write: bool = False):
+    '''
+    Соединение с шардом владельца; запись во время переноса — ShardMovingError
+    '''
+    shard, status = resolve_shard(owner_id)
+    if write and status == 'moving':
+        raise ShardMovingError(f'owner {owner_id} is being moved, retry later')
+    return psycopg2.connect(shard_dsn(shard))
+
+def write_lsn_headers(cur) -> Dict[str, str]:
+    '''
+    Заголовки ответа на запись: X-Write-LSN клиент возвращает в X-Min-LSN, чтобы читать свои записи с реплики
+    '''
+    cur.execute('SELECT pg_current_wal_lsn()')
+    return {**JSON_HEADERS, 'Access-Control-Expose-Headers': 'X-Write-LSN', 'X-Write-LSN': cur.fetchone()[0]}
+
+def deletion_progress(row: Optional[tuple]) -> Optional[Dict[str, Any]]:
+    '''
+    Прогресс фонового удаления из строки integration_deletions
+    '''
+    if not row:
+        return None
+    
+    status, payments_total, payments_deleted, forward_logs_deleted, receipts_deleted, last_error, requested_at, finished_at = row
+    percent = None
+    if payments_total:
+        percent = round(min(payments_deleted, payments_total) * 100.0 / payments_total, 1)
+    elif status == 'done':
+        percent = 100.0
+    
+    return {
+        'status': status,
+        'payments_total': payments_total,
+        'payments_deleted': payments_deleted,
+        'forward_logs_deleted': forward_logs_deleted,
+        'receipts_deleted': receipts_deleted,
+        'percent': percent,
+        'last_error': last_error,
+        'requested_at': requested_at.isoformat() if requested_at else None,
+        'finished_at': finished_at.isoformat() if finished_at else None
+    }
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Удаление интеграции пользователя
+    DELETE: помечает интеграцию как deleting и ставит в очередь integrations-purge, ответ 202 сразу
+    GET ?integration_id=&owner_id=: прогресс удаления
     '''
     
     method = event.get('httpMethod', 'DELETE')
@@ -13,91 +112,89 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': CORS_PREFLIGHT_HEADERS,
             'body': '',
             'isBase64Encoded': False
         }
     
-    if method != 'DELETE':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+    if method not in ('DELETE', 'GET'):
+        return json_response(405, {'error': 'Method not allowed'})
     
-    body_str = event.get('body', '{}')
-    if body_str:
-        body = json.loads(body_str)
+    if method == 'GET':
+        body = event.get('queryStringParameters', {}) or {}
     else:
-        body = {}
+        body_str = event.get('body', '{}')
+        if body_str:
+            body = json.loads(body_str)
+        else:
+            body = {}
     
     integration_id = body.get('integration_id')
     owner_id = body.get('owner_id')
     
     if not integration_id or not owner_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'integration_id and owner_id required'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'integration_id and owner_id required'})
+    
+    try:
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'owner_id must be a number'})
+    
+    try:
+        conn = get_connection(owner_id, write=method != 'GET')
+    except ShardMovingError as e:
+        return json_response(503, {'error': str(e)}, {**JSON_HEADERS, 'Retry-After': str(SHARD_CACHE_TTL_SECONDS)})
+    except psycopg2.OperationalError as e:
+        print(f"[DEBUG] Database unavailable: {str(e).strip()}")
+        return json_response(503, {'error': 'Database unavailable'})
     
-    dsn = os.environ['DATABASE_URL']
-    conn = psycopg2.connect(dsn)
     cur = conn.cursor()
     
     try:
         cur.execute('''
-            SELECT id FROM user_integrations
+            SELECT status, payments_total, payments_deleted, forward_logs_deleted,
+                   receipts_deleted, last_error, requested_at, finished_at
+            FROM integration_deletions
+            WHERE integration_id = %s AND owner_id = %s
+        ''', (integration_id, owner_id))
+        
+        progress = deletion_progress(cur.fetchone())
+        
+        if method == 'GET':
+            if not progress:
+                return json_response(404, {'error': 'Deletion not found'})
+            
+            return json_response(200, {'success': True, 'deletion': progress})
+        
+        cur.execute('''
+            UPDATE user_integrations
+            SET status = 'deleting', updated_at = NOW()
             WHERE id = %s AND owner_id = %s
+            RETURNING id
         ''', (integration_id, owner_id))
         
         exists = cur.fetchone()
         
         if not exists:
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Integration not found or access denied'}),
-                'isBase64Encoded': False
-            }
-        
-        cur.execute('''
-            DELETE FROM webhook_payments
-            WHERE integration_id = %s
-        ''', (integration_id,))
+            return json_response(404, {'error': 'Integration not found or access denied'})
         
         cur.execute('''
-            DELETE FROM user_integrations
-            WHERE id = %s
-        ''', (integration_id,))
+            INSERT INTO integration_deletions (integration_id, owner_id)
+            VALUES (%s, %s)
+            ON CONFLICT (integration_id) DO NOTHING
+        ''', (integration_id, owner_id))
         
         conn.commit()
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'message': 'Integration deleted successfully'
-            }),
-            'isBase64Encoded': False
-        }
-        
+        return json_response(202, {
+            'success': True,
+            'message': 'Integration deletion scheduled',
+            'deletion': progress or {'status': 'pending', 'percent': 0.0}
+        }, write_lsn_headers(cur))
+    
     except Exception as e:
         conn.rollback()
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'error': str(e)})
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        conn.close()
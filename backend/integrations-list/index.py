@@ -1,11 +1,192 @@
 import json
 import os
+import re
+import time
+import hashlib
 import psycopg2
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
+
+# Справочник категорий и провайдеров меняется только миграциями:
+# держим его в памяти процесса и перечитываем не чаще раза в CATALOG_TTL_SECONDS
+CATALOG_TTL_SECONDS = 600
+
+_catalog_cache: Dict[str, Any] = {'categories': None, 'version': None, 'loaded_at': 0.0}
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, If-None-Match, X-Min-LSN',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT shard, status FROM t_p83864310_fintech_payment_reco.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+# Реплики для чтения по шардам: {"main": "postgres://replica...", "shard-2": "..."}.
+# Шард без реплики, отставшая или недоступная реплика — чтение с primary
+REPLICA_DSNS: Dict[str, str] = json.loads(os.environ.get('REPLICA_DSNS') or '{}')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_RETRY_SECONDS = 10
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+_replica_skip_until: Dict[str, float] = {}
+
+def read_min_lsn(event: Dict[str, Any]) -> Optional[str]:
+    '''
+    X-Min-LSN клиента — X-Write-LSN его последней записи: реплика должна догнать этот LSN
+    '''
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    value = (headers.get('x-min-lsn') or '').strip()
+    return value if LSN_PATTERN.match(value) else None
+
+def get_read_connection(owner_id: Any, min_lsn: Optional[str] = None) -> Tuple[Any, str]:
+    '''
+    Соединение для чтения: реплика шарда, если лаг не больше REPLICA_MAX_LAG_SECONDS и она проиграла
+    min_lsn (чтение своих записей), иначе primary. Отставшая или недоступная реплика пропускается
+    на REPLICA_RETRY_SECONDS, чтобы не платить за проверку в каждом запросе
+    Returns: (conn, 'replica' | 'primary')
+    '''
+    shard, _ = resolve_shard(owner_id)
+    replica_dsn = REPLICA_DSNS.get(shard)
+    if replica_dsn and _replica_skip_until.get(shard, 0) <= time.monotonic():
+        try:
+            conn = psycopg2.connect(replica_dsn)
+        except psycopg2.OperationalError as e:
+            print(f"[DEBUG] Replica {shard} unavailable: {str(e).strip()}")
+            _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+        else:
+            cur = conn.cursor()
+            # Реплика, проигравшая все полученное, не отстает, даже если на primary давно не было записей
+            cur.execute('''
+                SELECT
+                    CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                         ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END,
+                    %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+            ''', (min_lsn, min_lsn))
+            lag_seconds, caught_up = cur.fetchone()
+            cur.close()
+            if lag_seconds <= REPLICA_MAX_LAG_SECONDS and caught_up:
+                return conn, 'replica'
+            conn.close()
+            if lag_seconds > REPLICA_MAX_LAG_SECONDS:
+                print(f"[DEBUG] Replica {shard} lag {float(lag_seconds):.1f}s, reading from primary")
+                _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+    return psycopg2.connect(shard_dsn(shard)), 'primary'
+
+def load_catalog(cur) -> Dict[str, Any]:
+    '''
+    Категории с активными провайдерами из кэша процесса, при устаревании — из БД
+    Returns: {'categories': [...], 'version': '...'}
+    '''
+    if _catalog_cache['categories'] is not None and time.monotonic() - _catalog_cache['loaded_at'] < CATALOG_TTL_SECONDS:
+        return _catalog_cache
+    
+    cur.execute('''
+        SELECT 
+            c.id as category_id,
+            c.name as category_name,
+            c.slug as category_slug,
+            c.icon as category_icon,
+            p.id as provider_id,
+            p.name as provider_name,
+            p.slug as provider_slug,
+            p.logo_url as provider_logo,
+            p.description as provider_description
+        FROM integration_categories c
+        LEFT JOIN integration_providers p ON p.category_id = c.id AND p.status = 'active'
+        ORDER BY c.sort_order, p.name
+    ''')
+    
+    rows = cur.fetchall()
+    
+    categories = {}
+    for row in rows:
+        cat_id = row[0]
+        if cat_id not in categories:
+            categories[cat_id] = {
+                'id': cat_id,
+                'name': row[1],
+                'slug': row[2],
+                'icon': row[3],
+                'providers': []
+            }
+        
+        if row[4]:
+            categories[cat_id]['providers'].append({
+                'id': row[4],
+                'name': row[5],
+                'slug': row[6],
+                'logo_url': row[7],
+                'description': row[8]
+            })
+    
+    categories_list = list(categories.values())
+    catalog_json = json.dumps(categories_list, sort_keys=True)
+    
+    _catalog_cache['categories'] = categories_list
+    _catalog_cache['version'] = hashlib.sha1(catalog_json.encode('utf-8')).hexdigest()[:12]
+    _catalog_cache['loaded_at'] = time.monotonic()
+    
+    return _catalog_cache
+
+def get_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    headers = event.get('headers') or {}
+    lowered = name.lower()
+    for key, value in headers.items():
+        if key.lower() == lowered:
+            return value
+    return None
+
+def make_etag(catalog_version: str, user_integrations: List[Dict[str, Any]]) -> str:
+    '''
+    ETag ответа: версия справочника + хэш интеграций владельца
+    '''
+    digest = hashlib.sha1(json.dumps(user_integrations, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return f'W/"{catalog_version}-{digest}"'
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Получение списка всех интеграций owner с группировкой по категориям
+    Справочник отдается из памяти процесса, ответ поддерживает If-None-Match (304)
     '''
     
     method = event.get('httpMethod', 'GET')
@@ -13,78 +194,34 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': CORS_PREFLIGHT_HEADERS,
             'body': '',
             'isBase64Encoded': False
         }
     
     if method != 'GET':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return json_response(405, {'error': 'Method not allowed'})
     
     params = event.get('queryStringParameters', {}) or {}
     owner_id = params.get('owner_id')
     
     if not owner_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'owner_id required'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'owner_id required'})
     
-    dsn = os.environ['DATABASE_URL']
-    conn = psycopg2.connect(dsn)
+    try:
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'owner_id must be a number'})
+    
+    try:
+        conn, read_source = get_read_connection(owner_id, read_min_lsn(event))
+    except psycopg2.OperationalError as e:
+        print(f"[DEBUG] Database unavailable: {str(e).strip()}")
+        return json_response(503, {'error': 'Database unavailable'})
     cur = conn.cursor()
     
     try:
-        cur.execute('''
-            SELECT 
-                c.id as category_id,
-                c.name as category_name,
-                c.slug as category_slug,
-                c.icon as category_icon,
-                p.id as provider_id,
-                p.name as provider_name,
-                p.slug as provider_slug,
-                p.logo_url as provider_logo,
-                p.description as provider_description
-            FROM integration_categories c
-            LEFT JOIN integration_providers p ON p.category_id = c.id AND p.status = 'active'
-            ORDER BY c.sort_order, p.name
-        ''')
-        
-        rows = cur.fetchall()
-        
-        categories = {}
-        for row in rows:
-            cat_id = row[0]
-            if cat_id not in categories:
-                categories[cat_id] = {
-                    'id': cat_id,
-                    'name': row[1],
-                    'slug': row[2],
-                    'icon': row[3],
-                    'providers': []
-                }
-            
-            if row[4]:
-                categories[cat_id]['providers'].append({
-                    'id': row[4],
-                    'name': row[5],
-                    'slug': row[6],
-                    'logo_url': row[7],
-                    'description': row[8]
-                })
+        catalog = load_catalog(cur)
         
         cur.execute('''
             SELECT 
@@ -128,23 +265,31 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'forward_url': row[13]
             })
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'categories': list(categories.values()),
-                'user_integrations': user_integrations
-            }),
-            'isBase64Encoded': False
+        etag = make_etag(catalog['version'], user_integrations)
+        cache_headers = {
+            'ETag': etag,
+            'Cache-Control': 'private, no-cache',
+            'Access-Control-Expose-Headers': 'ETag, X-Read-Source',
+            'Access-Control-Allow-Origin': '*',
+            'X-Read-Source': read_source
         }
         
+        if get_header(event, 'If-None-Match') == etag:
+            return {
+                'statusCode': 304,
+                'headers': cache_headers,
+                'body': '',
+                'isBase64Encoded': False
+            }
+        
+        return json_response(200, {
+            'categories': catalog['categories'],
+            'catalog_version': catalog['version'],
+            'user_integrations': user_integrations
+        }, {**JSON_HEADERS, **cache_headers})
+        
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'error': str(e)})
     finally:
         cur.close()
         conn.close()
\ No newline at end of file
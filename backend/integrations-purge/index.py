@@ -0,0 +1,357 @@
+import json
+import os
+import time
+import psycopg2
+from typing import Dict, Any, List
+
+SCHEMA = 't_p83864310_fintech_payment_reco'
+
+# Размер порции: каждая порция — отдельная короткая транзакция
+PURGE_BATCH_SIZE = 5000
+# Бюджет одного вызова, после него оставшаяся работа продолжается следующим вызовом по таймеру
+PURGE_TIME_BUDGET_SECONDS = 20
+LEASE_SECONDS = PURGE_TIME_BUDGET_SECONDS + 30
+# Срок хранения корзин webhook_forward_stats: самое длинное окно webhook-forward-stats — 7d
+FORWARD_STATS_RETENTION_DAYS = 8
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def shard_names() -> List[str]:
+    return ['main'] + sorted(SHARD_DSNS)
+
+def foreign_owners(cur, shard: str) -> List[int]:
+    '''
+    Владельцы, чьи строки на шарде shard обрабатывать нельзя: переносятся или уже перенесены на другой шард
+    (строки на старом шарде живут до удаления shard_rebalance.py). Запрос к основной БД через cur
+    '''
+    if not SHARD_DSNS:
+        return []
+    cur.execute(
+        f'SELECT owner_id FROM {SCHEMA}.owner_shards WHERE status = %s OR shard <> %s',
+        ('moving', shard)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+def purge_payments_batch(cur, integration_id: int) -> tuple:
+    '''
+    Удаление порции платежей вместе с их логами переадресации (логи первыми из-за FK)
+    Returns: (удалено логов, удалено платежей)
+    '''
+    cur.execute(f'''
+        SELECT id FROM {SCHEMA}.webhook_payments
+        WHERE integration_id = %s
+        ORDER BY id
+        LIMIT %s
+    ''', (integration_id, PURGE_BATCH_SIZE))
+    payment_ids = [row[0] for row in cur.fetchall()]
+    
+    if not payment_ids:
+        return 0, 0
+    
+    cur.execute(f'''
+        DELETE FROM {SCHEMA}.webhook_forward_logs
+        WHERE webhook_payment_id = ANY(%s)
+    ''', (payment_ids,))
+    logs_deleted = cur.rowcount
+    
+    cur.execute(f'''
+        DELETE FROM {SCHEMA}.webhook_payments
+        WHERE id = ANY(%s)
+    ''', (payment_ids,))
+    
+    return logs_deleted, cur.rowcount
+
+def purge_by_integration_batch(cur, table: str, integration_id: int) -> int:
+    '''
+    Порционное удаление строк таблицы по integration_id
+    '''
+    cur.execute(f'''
+        DELETE FROM {SCHEMA}.{table}
+        WHERE id IN (
+            SELECT id FROM {SCHEMA}.{table}
+            WHERE integration_id = %s
+            LIMIT %s
+        )
+    ''', (integration_id, PURGE_BATCH_SIZE))
+    return cur.rowcount
+
+def purge_table_until_empty(conn, cur, table: str, integration_id: int, deadline: float) -> bool:
+    '''
+    Порционное удаление строк интеграции из table, пока они есть и не исчерпан бюджет
+    Returns: True, если строк не осталось
+    '''
+    while time.monotonic() < deadline:
+        deleted = purge_by_integration_batch(cur, table, integration_id)
+        conn.commit()
+        if deleted == 0:
+            return True
+    return False
+
+def purge_matches_batch(cur, integration_id: int) -> int:
+    '''
+    Удаление сопоставлений сверки, в которые входят платежи или чеки интеграции.
+    Вторая сторона сопоставления освобождается для повторной сверки
+    '''
+    cur.execute(f'''
+        SELECT i.match_id
+        FROM {SCHEMA}.reconciliation_match_items i
+        JOIN {SCHEMA}.webhook_payments p ON i.item_type = 'payment' AND p.id = i.item_id
+        WHERE p.integration_id = %s
+        UNION
+        SELECT i.match_id
+        FROM {SCHEMA}.reconciliation_match_items i
+        JOIN {SCHEMA}.ofd_receipts r ON i.item_type = 'receipt' AND r.id = i.item_id
+        WHERE r.integration_id = %s
+        LIMIT %s
+    ''', (integration_id, integration_id, PURGE_BATCH_SIZE))
+    match_ids = [row[0] for row in cur.fetchall()]
+    
+    if not match_ids:
+        return 0
+    
+    # Освободившиеся платежи и чеки снова расхождения: их дни пересчитает следующая сверка
+    cur.execute(f'''
+        INSERT INTO {SCHEMA}.reconciliation_dirty_days (owner_id, day)
+        SELECT p.owner_id, p.created_at::date
+        FROM {SCHEMA}.reconciliation_match_items i
+        JOIN {SCHEMA}.webhook_payments p ON i.item_type = 'payment' AND p.id = i.item_id
+        WHERE i.match_id = ANY(%s)
+        UNION
+        SELECT r.owner_id, r.doc_datetime::date
+        FROM {SCHEMA}.reconciliation_match_items i
+        JOIN {SCHEMA}.ofd_receipts r ON i.item_type = 'receipt' AND r.id = i.item_id
+        WHERE i.match_id = ANY(%s) AND r.doc_datetime IS NOT NULL
+        ON CONFLICT (owner_id, day) DO NOTHING
+    ''', (match_ids, match_ids))
+    cur.execute(f'DELETE FROM {SCHEMA}.reconciliation_match_items WHERE match_id = ANY(%s)', (match_ids,))
+    cur.execute(f'DELETE FROM {SCHEMA}.reconciliation_matches WHERE id = ANY(%s)', (match_ids,))
+    return len(match_ids)
+
+def purge_integration(conn, integration_id: int, deadline: float) -> Dict[str, Any]:
+    '''
+    Удаление дочерних строк интеграции порциями до исчерпания бюджета времени.
+    Прогресс фиксируется после каждой порции, поэтому прерванный вызов ничего не теряет
+    '''
+    cur = conn.cursor()
+    stats = {'integration_id': integration_id, 'payments_deleted': 0, 'forward_logs_deleted': 0, 'receipts_deleted': 0, 'done': False}
+    
+    cur.execute(f'''
+        UPDATE {SCHEMA}.integration_deletions d
+        SET payments_total = (SELECT COUNT(*) FROM {SCHEMA}.webhook_payments WHERE integration_id = d.integration_id),
+            updated_at = NOW()
+        WHERE integration_id = %s AND payments_total IS NULL
+    ''', (integration_id,))
+    conn.commit()
+    
+    while time.monotonic() < deadline and purge_matches_batch(cur, integration_id) > 0:
+        conn.commit()
+    
+    while time.monotonic() < deadline:
+        logs_deleted, payments_deleted = purge_payments_batch(cur, integration_id)
+        
+        receipts_deleted = 0
+        if payments_deleted == 0:
+            receipts_deleted = purge_by_integration_batch(cur, 'ofd_receipts', integration_id)
+        
+        cur.execute(f'''
+            UPDATE {SCHEMA}.integration_deletions
+            SET payments_deleted = payments_deleted + %s,
+                forward_logs_deleted = forward_logs_deleted + %s,
+                receipts_deleted = receipts_deleted + %s,
+                lease_until = NOW() + %s * INTERVAL '1 second',
+                updated_at = NOW()
+            WHERE integration_id = %s
+        ''', (payments_deleted, logs_deleted, receipts_deleted, LEASE_SECONDS, integration_id))
+        conn.commit()
+        
+        stats['payments_deleted'] += payments_deleted
+        stats['forward_logs_deleted'] += logs_deleted
+        stats['receipts_deleted'] += receipts_deleted
+        
+        if payments_deleted == 0 and receipts_deleted == 0:
+            # outbox и расхождения тоже порциями в пределах бюджета: остаток дочистит следующий вызов
+            if not purge_table_until_empty(conn, cur, 'notification_outbox', integration_id, deadline):
+                break
+            if not purge_table_until_empty(conn, cur, 'reconciliation_discrepancies', integration_id, deadline):
+                break
+            
+            cur.execute(f'''
+                DELETE FROM {SCHEMA}.reconciliation_discrepancy_days
+                WHERE owner_id = (SELECT owner_id FROM {SCHEMA}.user_integrations WHERE id = %s)
+                  AND integration_id = %s
+            ''', (integration_id, integration_id))
+            
+            cur.execute(f'DELETE FROM {SCHEMA}.webhook_forward_stats WHERE integration_id = %s', (integration_id,))
+            cur.execute(f'DELETE FROM {SCHEMA}.ofd_sync_ranges WHERE integration_id = %s', (integration_id,))
+            cur.execute(f'DELETE FROM {SCHEMA}.ofd_sync_state WHERE integration_id = %s', (integration_id,))
+            cur.execute(f'DELETE FROM {SCHEMA}.ofd_sync_runs WHERE integration_id = %s', (integration_id,))
+            cur.execute(f'DELETE FROM {SCHEMA}.user_integrations WHERE id = %s', (integration_id,))
+            cur.execute(f'''
+                UPDATE {SCHEMA}.integration_deletions
+                SET status = 'done', finished_at = NOW(), lease_until = NULL, updated_at = NOW()
+                WHERE integration_id = %s
+            ''', (integration_id,))
+            conn.commit()
+            stats['done'] = True
+            break
+    
+    cur.close()
+    return stats
+
+def purge_forward_stats(conn, deadline: float) -> int:
+    '''
+    Удаление корзин webhook_forward_stats старше FORWARD_STATS_RETENTION_DAYS порциями до исчерпания бюджета
+    '''
+    cur = conn.cursor()
+    deleted = 0
+    
+    while time.monotonic() < deadline:
+        cur.execute(f'''
+            DELETE FROM {SCHEMA}.webhook_forward_stats
+            WHERE id IN (
+                SELECT id FROM {SCHEMA}.webhook_forward_stats
+                WHERE bucket_start < NOW() - %s * INTERVAL '1 day'
+                LIMIT %s
+            )
+        ''', (FORWARD_STATS_RETENTION_DAYS, PURGE_BATCH_SIZE))
+        batch = cur.rowcount
+        conn.commit()
+        deleted += batch
+        if batch < PURGE_BATCH_SIZE:
+            break
+    
+    cur.close()
+    return deleted
+
+def purge_shard(conn, main_conn, shard: str, deadline: float, processed: list) -> None:
+    '''
+    Очередь удалений одного шарда; интеграции переносимых или перенесенных владельцев пропускаются.
+    Маршрут токена в основной БД удаляется последним, когда строк интеграции на шарде не осталось
+    '''
+    cur = conn.cursor()
+    main_cur = main_conn.cursor()
+    excluded_owners = foreign_owners(main_cur, shard)
+    main_conn.commit()
+    
+    while time.monotonic() < deadline:
+        cur.execute(f'''
+            UPDATE {SCHEMA}.integration_deletions
+            SET status = 'running',
+                started_at = COALESCE(started_at, NOW()),
+                lease_until = NOW() + %s * INTERVAL '1 second',
+                updated_at = NOW()
+            WHERE integration_id = (
+                SELECT integration_id FROM {SCHEMA}.integration_deletions
+                WHERE status IN ('pending', 'running')
+                  AND (lease_until IS NULL OR lease_until < NOW())
+                  AND integration_id <> ALL(%s)
+                  AND owner_id <> ALL(%s)
+                ORDER BY requested_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING integration_id
+        ''', (LEASE_SECONDS, [p['integration_id'] for p in processed], excluded_owners))
+        
+        claimed = cur.fetchone()
+        conn.commit()
+        
+        if not claimed:
+            break
+        
+        integration_id = claimed[0]
+        
+        try:
+            stats = purge_integration(conn, integration_id, deadline)
+        except Exception as e:
+            conn.rollback()
+            cur.execute(f'''
+                UPDATE {SCHEMA}.integration_deletions
+                SET last_error = %s, lease_until = NULL, updated_at = NOW()
+                WHERE integration_id = %s
+            ''', (str(e), integration_id))
+            conn.commit()
+            stats = {'integration_id': integration_id, 'error': str(e), 'done': False}
+        
+        if stats['done']:
+            main_cur.execute(f'DELETE FROM {SCHEMA}.integration_routes WHERE integration_id = %s', (integration_id,))
+            main_conn.commit()
+        
+        stats['shard'] = shard
+        print(f"[DEBUG] Purge: {stats}")
+        processed.append(stats)
+    
+    cur.close()
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Фоновая очистка удаляемых интеграций (вызывается по таймеру)
+    Берет в работу интеграции из integration_deletions по аренде, удаляет логи переадресации,
+    платежи, чеки и outbox порциями по PURGE_BATCH_SIZE, затем саму интеграцию.
+    Остаток бюджета уходит на удаление устаревших корзин webhook_forward_stats
+    '''
+    
+    method = event.get('httpMethod', 'POST')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': CORS_PREFLIGHT_HEADERS,
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    if method != 'POST':
+        return json_response(405, {'error': 'Method not allowed'})
+    
+    deadline = time.monotonic() + PURGE_TIME_BUDGET_SECONDS
+    
+    main_conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    
+    processed = []
+    forward_stats_deleted = 0
+    
+    try:
+        for shard in shard_names():
+            if time.monotonic() >= deadline:
+                break
+            conn = main_conn if shard == 'main' else psycopg2.connect(shard_dsn(shard))
+            try:
+                purge_shard(conn, main_conn, shard, deadline, processed)
+                forward_stats_deleted += purge_forward_stats(conn, deadline)
+            finally:
+                if conn is not main_conn:
+                    conn.close()
+        
+        return json_response(200, {
+            'success': True,
+            'processed': processed,
+            'forward_stats_deleted': forward_stats_deleted
+        })
+        
+    except Exception as e:
+        main_conn.rollback()
+        return json_response(500, {'error': str(e)})
+    finally:
+        main_conn.close()
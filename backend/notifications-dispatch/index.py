@@ -0,0 +1,375 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import psycopg2
+from typing import Dict, Any, List, Optional, Tuple
+
+DEFAULT_SEND_MESSAGE_URL = 'https://functions.poehali.dev/a00f2a10-012a-4a96-9d0c-816207cb2726'
+
+DEFAULT_BATCH_SIZE = 200
+MAX_BATCH_SIZE = 500
+MAX_ATTEMPTS = 5
+# Событие в статусе processing дольше этого времени считается брошенным и забирается заново
+STALE_LOCK_MINUTES = 5
+
+EVENT_TEMPLATES = {
+    'CONFIRMED': 'Оплата заказа {order_id} на сумму {amount} ₽ подтверждена',
+    'REFUNDED': 'Возврат по заказу {order_id} на сумму {amount} ₽ выполнен'
+}
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def shard_names() -> List[str]:
+    return ['main'] + sorted(SHARD_DSNS)
+
+def foreign_owners(cur, shard: str) -> List[int]:
+    '''
+    Владельцы, чьи строки на шарде shard обрабатывать нельзя: переносятся или уже перенесены на другой шард
+    (строки на старом шарде живут до удаления shard_rebalance.py). Запрос к основной БД через cur
+    '''
+    if not SHARD_DSNS:
+        return []
+    cur.execute(
+        'SELECT owner_id FROM t_p83864310_fintech_payment_reco.owner_shards WHERE status = %s OR shard <> %s',
+        ('moving', shard)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+def format_amount(kopecks: int) -> str:
+    '''
+    Сумма в копейках -> "1 234,50"
+    '''
+    rubles, remainder = divmod(int(kopecks), 100)
+    return f'{rubles:,}'.replace(',', ' ') + f',{remainder:02d}'
+
+def render_event(event_type: str, payload: Dict[str, Any]) -> str:
+    template = EVENT_TEMPLATES.get(event_type, 'Статус заказа {order_id}: ' + event_type)
+    return template.format(
+        order_id=payload.get('order_id') or payload.get('payment_id') or '',
+        amount=format_amount(payload.get('amount_kopecks') or 0)
+    )
+
+def dispatch_key(shard: str, ids: List[int]) -> str:
+    '''
+    Ключ идемпотентности сообщения: id событий уникальны в пределах шарда
+    '''
+    return hashlib.md5(f"{shard}:{','.join(str(i) for i in sorted(ids))}".encode('utf-8')).hexdigest()
+
+def coalesce_events(rows: List[Tuple], shard: str) -> List[Dict[str, Any]]:
+    '''
+    Склейка событий одного получателя в одно сообщение.
+    События с dispatch_key уже отправлялись с неизвестным исходом: они склеиваются заново
+    по своему ключу, чтобы повтор был тем же сообщением с тем же ключом
+    rows: (id, provider, recipient, event_type, payload, dispatch_key)
+    '''
+    groups: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+    for row_id, provider, recipient, event_type, payload, key in rows:
+        payload = json.loads(payload) if isinstance(payload, str) else payload
+        group_key = ('key', key, '') if key else ('recipient', provider, recipient)
+        if group_key not in groups:
+            groups[group_key] = {'provider': provider, 'recipient': recipient, 'lines': [], 'ids': [], 'key': key}
+        groups[group_key]['lines'].append(render_event(event_type, payload))
+        groups[group_key]['ids'].append(row_id)
+
+    messages = []
+    for group in groups.values():
+        # Порция могла захватить не все события прежнего сообщения: другой состав — другой ключ,
+        # иначе шлюз принял бы укороченное сообщение за уже доставленное
+        key = dispatch_key(shard, group['ids'])
+        messages.append({
+            'provider': group['provider'],
+            'recipient': group['recipient'],
+            'message': '\n'.join(group['lines']),
+            'ids': group['ids'],
+            'idempotency_key': key,
+            'new_key': key != group['key']
+        })
+    return messages
+
+# Исходящий HTTP: постоянные соединения по хостам, одна попытка на запрос.
+# Одинаковый блок в webhook-receive, notifications-dispatch и ofd-sync-scheduler (общих модулей у функций нет):
+# повторы у них не в клиенте — outbox, следующий цикл планировщика, журнал webhook_forward_logs.
+# Клиент с повторами, gzip и token bucket — в ofd-fetch-receipts, проверка копий — scripts/http_client_check.py.
+# http.client/ssl импортируются при первом запросе: webhook-receive без пересылки их не загружает
+# (cold_start_budget.json)
+class HttpError(Exception):
+    '''
+    Ответ со статусом >= 400
+    '''
+    def __init__(self, status: int, body: bytes, headers: Dict[str, str]):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+        self.body = body
+        self.headers = headers
+
+class HttpResponse:
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+class HttpClient:
+    '''
+    Клиент с пулом keep-alive соединений на (scheme, host, port), одна попытка на запрос. Соединение,
+    закрытое сервером между вызовами, переоткрывается: запрос до сервера не дошел
+    '''
+    def __init__(self, timeout: float = 30.0, connect_timeout: float = 5.0, pool_size: int = 4):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.pool_size = pool_size
+        self._pools: Dict[Tuple[str, str, int], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def _checkout(self, key: Tuple[str, str, int]) -> Tuple[Any, bool]:
+        import http.client
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool:
+                return pool.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            import ssl
+            return http.client.HTTPSConnection(host, port, timeout=self.connect_timeout,
+                                               context=ssl.create_default_context()), False
+        return http.client.HTTPConnection(host, port, timeout=self.connect_timeout), False
+
+    def _checkin(self, key: Tuple[str, str, int], conn: Any) -> None:
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def _send(self, key: Tuple[str, str, int], method: str, target: str, body: Optional[bytes],
+              headers: Dict[str, str], timeout: float) -> Tuple[int, Dict[str, str], bytes]:
+        import http.client
+        for fresh_retry in (False, True):
+            conn, reused = self._checkout(key)
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(timeout)
+                conn.request(method, target, body=body, headers=headers)
+                response = conn.getresponse()
+                raw = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # Сервер закрыл простаивавшее соединение: повтор на новом
+                if reused and not fresh_retry:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(key, conn)
+            return response.status, {name.lower(): value for name, value in response.getheaders()}, raw
+        raise ConnectionError('connection closed by server')
+
+    def request(self, method: str, url: str, body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None,
+                timeout: Optional[float] = None) -> HttpResponse:
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        key = (scheme, parts.hostname or '', parts.port or (443 if scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        request_headers = {'Connection': 'keep-alive', **(headers or {})}
+
+        status, response_headers, raw = self._send(key, method, target, body, request_headers, timeout or self.timeout)
+        if status >= 400:
+            raise HttpError(status, raw, response_headers)
+        return HttpResponse(status, response_headers, raw)
+
+# Повторы отправки — дело outbox (next_attempt_at с экспоненциальной паузой), поэтому POST клиент
+# не повторяет; соединение с send-message переиспользуется между шардами одного вызова
+SEND_MESSAGE_HTTP = HttpClient(timeout=60.0, connect_timeout=5.0, pool_size=1)
+
+def send_batch(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+    Один пакетный вызов send-message, результаты в порядке сообщений
+    '''
+    url = os.environ.get('SEND_MESSAGE_URL', DEFAULT_SEND_MESSAGE_URL)
+    payload = {
+        'messages': [
+            {'provider': m['provider'], 'recipient': m['recipient'], 'message': m['message'],
+             'idempotency_key': m['idempotency_key']}
+            for m in messages
+        ]
+    }
+
+    response = SEND_MESSAGE_HTTP.request(
+        'POST', url, body=json.dumps(payload).encode('utf-8'), headers={'Content-Type': 'application/json'}
+    )
+    return json.loads(response.body.decode('utf-8')).get('results', [])
+
+def dispatch_shard(conn, shard: str, excluded_owners: List[int], batch_size: int) -> Dict[str, int]:
+    '''
+    Одна порция outbox шарда: забрать, сохранить ключи идемпотентности, отправить пакетом, проставить статусы
+    События переносимых и перенесенных владельцев (excluded_owners) не трогаются
+    '''
+    cur = conn.cursor()
+    try:
+        cur.execute('''
+            UPDATE t_p83864310_fintech_payment_reco.notification_outbox
+            SET status = 'processing', locked_at = NOW(), attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM t_p83864310_fintech_payment_reco.notification_outbox
+                WHERE ((status = 'pending' AND next_attempt_at <= NOW())
+                   OR (status = 'processing' AND locked_at < NOW() - %s * INTERVAL '1 minute'))
+                  AND owner_id <> ALL(%s)
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, provider, recipient, event_type, payload, dispatch_key, attempts
+        ''', (STALE_LOCK_MINUTES, excluded_owners, batch_size))
+
+        claimed = cur.fetchall()
+        conn.commit()
+
+        if not claimed:
+            return {'claimed': 0, 'messages': 0, 'sent': 0, 'retry': 0, 'failed': 0}
+
+        attempts_by_id = {row[0]: row[6] for row in claimed}
+        messages = coalesce_events([row[:6] for row in claimed], shard)
+
+        # Ключ фиксируется до отправки: если ответ send-message потеряется (таймаут), повтор уйдет
+        # с тем же ключом и шлюз не доставит сообщение дважды
+        for message in messages:
+            if message['new_key']:
+                cur.execute('''
+                    UPDATE t_p83864310_fintech_payment_reco.notification_outbox
+                    SET dispatch_key = %s
+                    WHERE id = ANY(%s)
+                ''', (message['idempotency_key'], message['ids']))
+        conn.commit()
+
+        try:
+            results = send_batch(messages)
+        except Exception as e:
+            print(f"[DEBUG] send-message call failed: {str(e)}")
+            results = [{'success': False, 'error': f'send-message unavailable: {str(e)}'} for _ in messages]
+
+        sent_ids: List[int] = []
+        errors: Dict[int, str] = {}
+        for index, message in enumerate(messages):
+            result = results[index] if index < len(results) else {'success': False, 'error': 'No result'}
+            if result.get('success'):
+                sent_ids.extend(message['ids'])
+            else:
+                for row_id in message['ids']:
+                    errors[row_id] = result.get('error') or 'Unknown error'
+
+        if sent_ids:
+            cur.execute('''
+                UPDATE t_p83864310_fintech_payment_reco.notification_outbox
+                SET status = 'sent', sent_at = NOW(), locked_at = NULL, last_error = NULL
+                WHERE id = ANY(%s)
+            ''', (sent_ids,))
+
+        retry_ids = [row_id for row_id in errors if attempts_by_id[row_id] < MAX_ATTEMPTS]
+        failed_ids = [row_id for row_id in errors if attempts_by_id[row_id] >= MAX_ATTEMPTS]
+
+        for row_id in errors:
+            cur.execute('''
+                UPDATE t_p83864310_fintech_payment_reco.notification_outbox
+                SET status = %s,
+                    last_error = %s,
+                    locked_at = NULL,
+                    next_attempt_at = NOW() + (power(2, attempts) * INTERVAL '30 seconds')
+                WHERE id = %s
+            ''', ('pending' if row_id in retry_ids else 'failed', errors[row_id], row_id))
+
+        conn.commit()
+        return {
+            'claimed': len(claimed),
+            'messages': len(messages),
+            'sent': len(sent_ids),
+            'retry': len(retry_ids),
+            'failed': len(failed_ids)
+        }
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Пакетная отправка уведомлений покупателям из notification_outbox
+    Вызывается по таймеру или вручную: POST {batch_size}
+    Returns: сколько событий забрано, отправлено, отложено и отброшено
+    '''
+    method = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': CORS_PREFLIGHT_HEADERS,
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'POST':
+        return json_response(405, {'error': 'Method not allowed'})
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+        batch_size = max(1, min(int(body.get('batch_size', DEFAULT_BATCH_SIZE)), MAX_BATCH_SIZE))
+    except (ValueError, TypeError, AttributeError):
+        return json_response(400, {'error': 'Body must be a JSON object with numeric batch_size'})
+
+    totals = {'claimed': 0, 'messages': 0, 'sent': 0, 'retry': 0, 'failed': 0}
+    main_conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    main_cur = main_conn.cursor()
+
+    try:
+        for shard in shard_names():
+            excluded_owners = foreign_owners(main_cur, shard)
+            main_conn.commit()
+            conn = main_conn if shard == 'main' else psycopg2.connect(shard_dsn(shard))
+            try:
+                counts = dispatch_shard(conn, shard, excluded_owners, batch_size)
+            finally:
+                if conn is not main_conn:
+                    conn.close()
+            for key in totals:
+                totals[key] += counts[key]
+
+        print(f"[DEBUG] Outbox dispatch: claimed={totals['claimed']}, messages={totals['messages']}, sent={totals['sent']}, retry={totals['retry']}, failed={totals['failed']}")
+
+        return json_response(200, {'success': True, **totals})
+
+    except Exception as e:
+        main_conn.rollback()
+        return json_response(500, {'error': str(e)})
+    finally:
+        main_cur.close()
+        main_conn.close()
@@ -1,17 +1,751 @@
 import json
 import os
+import time
+import functools
+import threading
 import psycopg2
-import urllib.request
-import urllib.error
 import urllib.parse
-from typing import Dict, Any
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
+# Трассировка запроса: SQL, внешние HTTP и сериализация попадают в заголовок Server-Timing.
+# Включается TRACE_ENABLED=1 на время разбора задержек: заголовок раскрывает клиенту время запросов к БД,
+# поэтому по умолчанию обертка не ставится и спаны пишутся в пустой _NULL_TRACER.
+# Если задан TRACE_SINK_PATH, спаны дописываются туда JSON-строкой на запрос.
+# Одинаковый блок только в payments-list, receipts-list и ofd-fetch-receipts: их задержку дают SQL, сериализация
+# и OFD, которые трассировка раскладывает. Остальные функции Server-Timing не отдают — записи и фоновые задачи
+# печатают длительность прогона в [DEBUG], а копия блока в каждой функции утяжелила бы холодный старт ради
+# выключенного в проде переключателя
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED', '') == '1'
+TRACE_SINK_PATH = os.environ.get('TRACE_SINK_PATH')
+
+_trace_state = threading.local()
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+SCHEMA = 't_p83864310_fintech_payment_reco'
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+class ShardMovingError(Exception):
+    '''
+    Данные владельца переносятся между шардами (scripts/shard_rebalance.py), запись временно запрещена
+    '''
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT shard, status FROM t_p83864310_fintech_payment_reco.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+def get_connection(owner_id: Any, write: bool = False):
+    '''
+    Соединение с шардом владельца; запись во время переноса — ShardMovingError
+    '''
+    shard, status = resolve_shard(owner_id)
+    if write and status == 'moving':
+        raise ShardMovingError(f'owner {owner_id} is being moved, retry later')
+    return psycopg2.connect(shard_dsn(shard))
+
+def resolve_integration_owner(integration_id: Any) -> Optional[int]:
+    '''
+    Владелец интеграции из integration_routes основной БД; без SHARD_DSNS запрос не нужен (None — шард main)
+    '''
+    if not SHARD_DSNS:
+        return None
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            'SELECT owner_id FROM t_p83864310_fintech_payment_reco.integration_routes WHERE integration_id = %s',
+            (int(integration_id),)
+        )
+        row = cur.fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+class Tracer:
+    def __init__(self, function_name: str):
+        self.function_name = function_name
+        self.started = time.perf_counter()
+        self.spans: List[tuple] = []
+
+    @contextmanager
+    def span(self, kind: str, label: str = ''):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((kind, label, (time.perf_counter() - started) * 1000))
+
+    def server_timing(self) -> str:
+        totals: Dict[str, List[float]] = {}
+        for kind, _, duration in self.spans:
+            totals.setdefault(kind, []).append(duration)
+        parts = [f'{kind};dur={sum(durations):.1f};desc="{len(durations)}"' for kind, durations in totals.items()]
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(parts)
+
+    def flush(self, status_code: Any) -> None:
+        if not TRACE_SINK_PATH:
+            return
+        record = {
+            'ts': time.time(),
+            'function': self.function_name,
+            'status': status_code,
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'spans': [{'kind': kind, 'label': label, 'ms': round(duration, 2)} for kind, label, duration in self.spans]
+        }
+        try:
+            with open(TRACE_SINK_PATH, 'a', encoding='utf-8') as sink:
+                sink.write(json.dumps(record, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"[DEBUG] Trace sink write failed: {str(e)}")
+
+class _NullTracer(Tracer):
+    def __init__(self):
+        super().__init__('')
+
+    @contextmanager
+    def span(self, kind: str, label: str = ''):
+        yield
+
+_NULL_TRACER = _NullTracer()
+
+def current_tracer() -> Tracer:
+    return getattr(_trace_state, 'tracer', None) or _NULL_TRACER
+
+def traced(function_name: str):
+    '''
+    Обертка handler: создает Tracer на запрос и добавляет Server-Timing в ответ; без TRACE_ENABLED — handler как есть
+    '''
+    def decorator(fn):
+        if not TRACE_ENABLED:
+            return fn
+        @functools.wraps(fn)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            tracer = Tracer(function_name)
+            _trace_state.tracer = tracer
+            try:
+                response = fn(event, context)
+            finally:
+                _trace_state.tracer = None
+            response['headers'] = {
+                **(response.get('headers') or {}),
+                'Server-Timing': tracer.server_timing(),
+                'Timing-Allow-Origin': '*'
+            }
+            tracer.flush(response.get('statusCode'))
+            return response
+        return wrapper
+    return decorator
+
+class TracedCursor:
+    '''
+    Курсор psycopg2, который пишет каждый execute в спан db
+    '''
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=None):
+        label = ' '.join(str(query).split())[:80]
+        with current_tracer().span('db', label):
+            return self._cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def traced_connect(route_owner_id: Optional[int]):
+    '''
+    Соединение с шардом владельца интеграции; без маршрута — основная БД
+    '''
+    with current_tracer().span('connect'):
+        if route_owner_id is None:
+            return psycopg2.connect(os.environ['DATABASE_URL'])
+        return get_connection(route_owner_id, write=True)
+
+# Исходящий HTTP: постоянные соединения по хостам, gzip, повторы с джиттером и token bucket на хост.
+# Полный клиент нужен только здесь и в scripts/ofd_backfill.py; у send-message копия без gzip и token bucket
+# на хост, у остальных функций — одна попытка без повторов. Проверка всех копий — scripts/http_client_check.py.
+# http.client/ssl/gzip импортируются при первом запросе (cold_start_budget.json)
+class HttpError(Exception):
+    '''
+    Ответ со статусом >= 400 после всех повторов
+    '''
+    def __init__(self, status: int, body: bytes, headers: Dict[str, str], attempts: int = 1):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+        self.body = body
+        self.headers = headers
+        self.attempts = attempts
+
+class HttpResponse:
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes, wire_bytes: int, attempts: int):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.wire_bytes = wire_bytes
+        self.attempts = attempts
+
+class TokenBucket:
+    '''
+    rate токенов в секунду, не больше burst в запасе; запрос ждет токен, но не дольше deadline
+    '''
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline: Optional[float] = None) -> bool:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                delay = (1 - self.tokens) / self.rate
+            if deadline is not None and now + delay > deadline:
+                return False
+            time.sleep(delay)
+
+class HttpClient:
+    '''
+    Клиент с пулом keep-alive соединений на (scheme, host, port). Соединение, закрытое сервером
+    между вызовами, переоткрывается без траты попытки. Повторяются статусы retry_statuses и сетевые
+    ошибки, только для retry_methods и запросов с заголовком Idempotency-Key (повтор такого запроса
+    получатель не выполнит второй раз); пауза — full jitter от backoff_base * 2^n, Retry-After сервера
+    важнее. deadline (time.monotonic()) ограничивает и ожидание токена, и паузы, и таймауты попыток.
+    Число сделанных попыток — в attempts ответа или исключения
+    '''
+    def __init__(self, timeout: float = 30.0, connect_timeout: float = 5.0, max_attempts: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, rate_per_host: float = 0.0, burst: int = 5,
+                 pool_size: int = 4, retry_statuses: Tuple[int, ...] = (429, 500, 502, 503, 504),
+                 retry_methods: Tuple[str, ...] = ('GET', 'HEAD')):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_per_host = rate_per_host
+        self.burst = burst
+        self.pool_size = pool_size
+        self.retry_statuses = retry_statuses
+        self.retry_methods = retry_methods
+        self._pools: Dict[Tuple[str, str, int], List[Any]] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+        self.metrics: Dict[str, Dict[str, int]] = {}
+
+    def _metric(self, host: str, name: str, value: int = 1) -> None:
+        with self._lock:
+            host_metrics = self.metrics.setdefault(host, {
+                'requests': 0, 'attempts': 0, 'retries': 0, 'reused': 0, 'errors': 0, 'wire_bytes': 0, 'body_bytes': 0
+            })
+            host_metrics[name] += value
+
+    def _bucket(self, host: str) -> Optional[TokenBucket]:
+        if self.rate_per_host <= 0:
+            return None
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate_per_host, self.burst)
+            return self._buckets[host]
+
+    def _checkout(self, key: Tuple[str, str, int]) -> Tuple[Any, bool]:
+        import http.client
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool:
+                return pool.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            import ssl
+            return http.client.HTTPSConnection(host, port, timeout=self.connect_timeout,
+                                               context=ssl.create_default_context()), False
+        return http.client.HTTPConnection(host, port, timeout=self.connect_timeout), False
+
+    def _checkin(self, key: Tuple[str, str, int], conn: Any) -> None:
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def _backoff(self, attempt: int, retry_after: Optional[str]) -> float:
+        import random
+        if retry_after and retry_after.strip().isdigit():
+            return min(float(retry_after.strip()), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def _send(self, key: Tuple[str, str, int], method: str, target: str, body: Optional[bytes],
+              headers: Dict[str, str], timeout: float) -> Tuple[int, Dict[str, str], bytes]:
+        import http.client
+        for fresh_retry in (False, True):
+            conn, reused = self._checkout(key)
+            if reused:
+                self._metric(key[1], 'reused')
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(timeout)
+                conn.request(method, target, body=body, headers=headers)
+                response = conn.getresponse()
+                raw = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # Сервер закрыл простаивавшее соединение: повтор на новом, попытка не тратится
+                if reused and not fresh_retry:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(key, conn)
+            return response.status, {name.lower(): value for name, value in response.getheaders()}, raw
+        raise ConnectionError('connection closed by server')
+
+    def request(self, method: str, url: str, body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None,
+                timeout: Optional[float] = None, deadline: Optional[float] = None) -> HttpResponse:
+        import gzip
+        import http.client
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        key = (scheme, parts.hostname or '', parts.port or (443 if scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        request_headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive', **(headers or {})}
+        host = key[1]
+        retryable = method.upper() in self.retry_methods or 'Idempotency-Key' in request_headers
+        self._metric(host, 'requests')
+
+        attempt = 0
+        while True:
+            attempt += 1
+            bucket = self._bucket(host)
+            if bucket and not bucket.acquire(deadline):
+                self._metric(host, 'errors')
+                raise TimeoutError(f'rate limit wait for {host} exceeds deadline')
+            attempt_timeout = timeout or self.timeout
+            if deadline is not None:
+                attempt_timeout = min(attempt_timeout, max(deadline - time.monotonic(), 0.1))
+            self._metric(host, 'attempts')
+
+            retry_after = None
+            try:
+                status, response_headers, raw = self._send(key, method, target, body, request_headers, attempt_timeout)
+            except (OSError, http.client.HTTPException) as e:
+                error: Exception = e
+            else:
+                wire_bytes = len(raw)
+                if response_headers.get('content-encoding', '').lower() == 'gzip':
+                    raw = gzip.decompress(raw)
+                self._metric(host, 'wire_bytes', wire_bytes)
+                self._metric(host, 'body_bytes', len(raw))
+                if status < 400:
+                    return HttpResponse(status, response_headers, raw, wire_bytes, attempt)
+                error = HttpError(status, raw, response_headers, attempt)
+                retry_after = response_headers.get('retry-after')
+                if status not in self.retry_statuses:
+                    self._metric(host, 'errors')
+                    raise error
+
+            delay = self._backoff(attempt, retry_after)
+            out_of_time = deadline is not None and time.monotonic() + delay >= deadline
+            if not retryable or attempt >= self.max_attempts or out_of_time:
+                self._metric(host, 'errors')
+                error.attempts = attempt
+                raise error
+            self._metric(host, 'retries')
+            time.sleep(delay)
+
+# OFD отдает чеки большим JSON (gzip сжимает его в разы); лимит запросов на хост общий для теплого инстанса.
+# Бюджет на все запросы одного вызова — чтобы повторы не вышли за таймаут функции
+OFD_HTTP = HttpClient(
+    timeout=30.0,
+    connect_timeout=5.0,
+    max_attempts=4,
+    rate_per_host=float(os.environ.get('OFD_RATE_PER_SECOND', '5')),
+    burst=5
+)
+OFD_REQUEST_BUDGET_SECONDS = float(os.environ.get('OFD_REQUEST_BUDGET_SECONDS', '25'))
+
+def traced_get(url: str, label: str, timeout: float, deadline: float) -> HttpResponse:
+    '''
+    GET через OFD_HTTP со спаном http; время включает повторы и паузы между ними
+    '''
+    with current_tracer().span('http', label):
+        return OFD_HTTP.request('GET', url, timeout=timeout, deadline=deadline)
+
+# Чеки последних часов OFD может досылать с задержкой: этот хвост периода не считается загруженным
+# и запрашивается повторно при следующем запуске
+SYNC_LAG_MINUTES = int(os.environ.get('OFD_SYNC_LAG_MINUTES', '120'))
+DEFAULT_PERIOD_DAYS = 30
+UPSERT_PAGE_SIZE = 500
+# Рубли (total_sum, cash_sum, ecash_sum) — точное деление копеек в numeric на стороне БД
+UPSERT_TEMPLATE = '(%s, %s, %s, %s, %s, %s, %s, %s::bigint / 100.0, %s::bigint / 100.0, %s::bigint / 100.0, %s, %s, %s, %s)'
+
+def parse_period_bound(value: Optional[str], default: datetime) -> datetime:
+    if not value:
+        return default
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        return default
+
+# Интервалы, между которыми не больше секунды, смежные: OFD принимает границы с точностью до секунды,
+# и кусок [день 00:00:00, день 23:59:59] стыкуется со следующим [день+1 00:00:00, ...] без промежутка
+RANGE_ADJACENT = timedelta(seconds=1)
+
+def uncovered_gaps(period_from: datetime, period_to: datetime,
+                   covered: List[Tuple[datetime, datetime]]) -> List[Tuple[datetime, datetime]]:
+    '''
+    Промежутки периода, не покрытые уже загруженными интервалами (covered отсортирован по началу).
+    Границы промежутков совпадают с границами интервалов: пересечение в одну секунду снимает upsert.
+    Стык смежных интервалов (RANGE_ADJACENT) промежутком не считается
+    '''
+    gaps = []
+    cursor = period_from
+    for range_from, range_to in covered:
+        if range_to < cursor:
+            continue
+        if range_from > period_to:
+            break
+        if range_from > cursor + RANGE_ADJACENT:
+            gaps.append((cursor, range_from))
+        cursor = max(cursor, range_to)
+    if cursor < period_to:
+        gaps.append((cursor, period_to))
+    return gaps
+
+def record_synced_range(cur, integration_id: int, kkt: str, range_from: datetime, range_to: datetime) -> None:
+    '''
+    Добавление загруженного интервала со слиянием пересекающихся и смежных (не дальше RANGE_ADJACENT)
+    '''
+    cur.execute('SELECT pg_advisory_xact_lock(%s)', (integration_id,))
+    cur.execute('''
+        SELECT id, range_from, range_to
+        FROM t_p83864310_fintech_payment_reco.ofd_sync_ranges
+        WHERE integration_id = %s AND kkt = %s AND range_from <= %s AND range_to >= %s
+    ''', (integration_id, kkt, range_to + RANGE_ADJACENT, range_from - RANGE_ADJACENT))
+    overlapping = cur.fetchall()
+    
+    if overlapping:
+        range_from = min([range_from] + [row[1] for row in overlapping])
+        range_to = max([range_to] + [row[2] for row in overlapping])
+        cur.execute('''
+            DELETE FROM t_p83864310_fintech_payment_reco.ofd_sync_ranges WHERE id = ANY(%s)
+        ''', ([row[0] for row in overlapping],))
+    
+    cur.execute('''
+        INSERT INTO t_p83864310_fintech_payment_reco.ofd_sync_ranges (integration_id, kkt, range_from, range_to)
+        VALUES (%s, %s, %s, %s)
+    ''', (integration_id, kkt, range_from, range_to))
+
+def parse_kopecks(value: Any) -> int:
+    '''
+    Сумма ОФД в копейках -> int. ОФД присылает и числа, и строки ("123450", "1234.50"): разбор через Decimal,
+    дробная часть округляется half-up. Пустое значение — 0, нечисловое — ValueError
+    '''
+    if value is None or value == '':
+        return 0
+    if isinstance(value, bool):
+        raise ValueError(f'invalid amount: {value!r}')
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f'invalid amount: {value!r}')
+    if not amount.is_finite():
+        raise ValueError(f'invalid amount: {value!r}')
+    return int(amount.quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+# Границы колонок ofd_receipts: строка за ними оборвала бы весь пакетный INSERT
+RECEIPT_TEXT_LIMITS = {'Id': 255, 'OperationType': 50, 'DocNumber': 50, 'FnNumber': 50}
+# DECIMAL(15, 2) в старых рублевых колонках
+MAX_RECEIPT_KOPECKS = 10 ** 15 - 1
+
+def receipt_row(integration_id: int, owner_id: int, receipt: Any) -> tuple:
+    '''
+    Строка upsert для одного чека ОФД; чек, который не ляжет в ofd_receipts, — ValueError с причиной
+    '''
+    if not isinstance(receipt, dict):
+        raise ValueError('receipt is not an object')
+    if receipt.get('Id') is None:
+        raise ValueError('Id missing')
+    for field, limit in RECEIPT_TEXT_LIMITS.items():
+        value = receipt.get(field)
+        if value is not None and len(str(value)) > limit:
+            raise ValueError(f'{field} longer than {limit}')
+    # Суммы ОФД уже в копейках; рубли для старых колонок считает сам INSERT (шаблон ниже)
+    total_kopecks = parse_kopecks(receipt.get('TotalSumm'))
+    cash_kopecks = parse_kopecks(receipt.get('CashSumm'))
+    ecash_kopecks = parse_kopecks(receipt.get('ECashSumm'))
+    if max(abs(total_kopecks), abs(cash_kopecks), abs(ecash_kopecks)) > MAX_RECEIPT_KOPECKS:
+        raise ValueError('amount out of range')
+    doc_datetime = receipt.get('DocDateTime')
+    if doc_datetime:
+        datetime.fromisoformat(str(doc_datetime).replace('Z', '+00:00'))
+    return (
+        integration_id,
+        owner_id,
+        str(receipt.get('Id')),
+        receipt.get('OperationType'),
+        total_kopecks,
+        cash_kopecks,
+        ecash_kopecks,
+        total_kopecks,
+        cash_kopecks,
+        ecash_kopecks,
+        receipt.get('DocNumber'),
+        doc_datetime or None,
+        receipt.get('FnNumber'),
+        json.dumps(receipt)
+    )
+
+def skipped_receipt(receipt: Any, error: Exception) -> Dict[str, Any]:
+    '''
+    Запись о пропущенном чеке: id, причина и день чека (None, если дату не разобрать)
+    '''
+    if not isinstance(receipt, dict):
+        return {'id': None, 'error': str(error), 'day': None}
+    receipt_id = receipt.get('Id')
+    try:
+        day = datetime.fromisoformat(str(receipt.get('DocDateTime')).replace('Z', '+00:00')).date().isoformat()
+    except ValueError:
+        day = None
+    return {'id': None if receipt_id is None else str(receipt_id), 'error': str(error), 'day': day}
+
+def synced_ranges(range_from: datetime, range_to: datetime,
+                  skipped: List[Dict[str, Any]]) -> List[Tuple[datetime, datetime]]:
+    '''
+    Куски загруженного интервала, которые можно отметить в ofd_sync_ranges: дни пропущенных чеков
+    не отмечаются, чтобы uncovered_gaps запросил их снова. Пропущенный чек без даты — не отмечается ничего
+    '''
+    if any(item['day'] is None for item in skipped):
+        return []
+    ranges = []
+    cursor = range_from
+    for day in sorted({item['day'] for item in skipped}):
+        day_start = datetime.fromisoformat(day)
+        if day_start + timedelta(days=1) <= cursor or day_start > range_to:
+            continue
+        if day_start - RANGE_ADJACENT > cursor:
+            ranges.append((cursor, day_start - RANGE_ADJACENT))
+        cursor = day_start + timedelta(days=1)
+    if cursor < range_to:
+        ranges.append((cursor, range_to))
+    return ranges
+
+def upsert_receipts(cur, integration_id: int, owner_id: int,
+                    receipts: List[Dict[str, Any]]) -> Tuple[int, int, int, set, List[Dict[str, Any]]]:
+    '''
+    Пакетный upsert чеков: новые вставляются, существующие обновляются только при изменении raw_data.
+    Чек с некорректными полями пропускается и попадает в skipped, остальные сохраняются
+    Returns: (уникальных чеков, вставлено, обновлено, дни вставленных и обновленных чеков, skipped)
+    '''
+    from psycopg2.extras import execute_values
+    
+    # Один чек может прийти в двух соседних промежутках; повтор ключа в одном INSERT ... ON CONFLICT недопустим
+    rows = {}
+    skipped = []
+    for receipt in receipts:
+        try:
+            row = receipt_row(integration_id, owner_id, receipt)
+        except ValueError as e:
+            skipped.append(skipped_receipt(receipt, e))
+            continue
+        rows[row[2]] = row
+    
+    if skipped:
+        print(f"[DEBUG] Skipped {len(skipped)} malformed receipts for integration={integration_id}: {skipped[:20]}")
+    
+    if not rows:
+        return 0, 0, 0, set(), skipped
+    
+    with current_tracer().span('db', f'upsert {len(rows)} receipts'):
+        result = execute_values(cur, '''
+            INSERT INTO t_p83864310_fintech_payment_reco.ofd_receipts AS r (
+                integration_id, owner_id, receipt_id, operation_type,
+                total_kopecks, cash_kopecks, ecash_kopecks,
+                total_sum, cash_sum, ecash_sum, doc_number, doc_datetime,
+                fn_number, raw_data
+            ) VALUES %s
+            ON CONFLICT (integration_id, receipt_id) DO UPDATE SET
+                operation_type = EXCLUDED.operation_type,
+                total_kopecks = EXCLUDED.total_kopecks,
+                cash_kopecks = EXCLUDED.cash_kopecks,
+                ecash_kopecks = EXCLUDED.ecash_kopecks,
+                total_sum = EXCLUDED.total_sum,
+                cash_sum = EXCLUDED.cash_sum,
+                ecash_sum = EXCLUDED.ecash_sum,
+                doc_number = EXCLUDED.doc_number,
+                doc_datetime = EXCLUDED.doc_datetime,
+                fn_number = EXCLUDED.fn_number,
+                raw_data = EXCLUDED.raw_data,
+                raw_archive_segment = NULL,
+                raw_archive_offset = NULL,
+                raw_archive_length = NULL,
+                raw_archive_md5 = NULL,
+                updated_at = NOW()
+            -- Чек с raw_data в архиве (scripts/raw_archive.py) сравнивается по md5, иначе повторная загрузка вернула бы его в таблицу
+            WHERE CASE WHEN r.raw_data IS NULL AND r.raw_archive_md5 IS NOT NULL
+                       THEN r.raw_archive_md5 <> md5(EXCLUDED.raw_data::text)
+                       ELSE r.raw_data IS DISTINCT FROM EXCLUDED.raw_data END
+            RETURNING (xmax = 0), doc_datetime::date
+        ''', list(rows.values()), template=UPSERT_TEMPLATE, page_size=UPSERT_PAGE_SIZE, fetch=True)
+    
+    inserted = sum(1 for (is_new, _) in result if is_new)
+    days = {day for (_, day) in result if day is not None}
+    return len(rows), inserted, len(result) - inserted, days, skipped
+
+# Отчет о расхождениях: пометка дней и пересчет порциями. Одинаковый блок в reconciliation-match
+# и ofd-fetch-receipts (общих модулей у функций нет, ofd_backfill вызывает копию ofd-fetch-receipts),
+# проверка копий — scripts/discrepancy_block_check.py.
+# За один вызов пересчитывается не больше стольких помеченных дней владельца (новые первыми)
+DISCREPANCY_REFRESH_MAX_DAYS = 62
+
+def mark_dirty_days(cur, owner_id: Any, days: Any) -> None:
+    cur.executemany(f'''
+        INSERT INTO {SCHEMA}.reconciliation_dirty_days (owner_id, day) VALUES (%s, %s)
+        ON CONFLICT (owner_id, day) DO NOTHING
+    ''', [(owner_id, day) for day in sorted(set(days))])
+
+def refresh_discrepancies(cur, owner_id: Any) -> int:
+    '''
+    Пересчет отчета о расхождениях за помеченные дни владельца: строки дня удаляются и собираются заново
+    из несопоставленных платежей и чеков и сопоставлений amount_mismatch. День, помеченный другой
+    транзакцией во время пересчета, остается помеченным до следующего вызова
+    Returns: число пересчитанных дней
+    '''
+    cur.execute(f'''
+        DELETE FROM {SCHEMA}.reconciliation_dirty_days
+        WHERE (owner_id, day) IN (
+            SELECT owner_id, day FROM {SCHEMA}.reconciliation_dirty_days
+            WHERE owner_id = %s
+            ORDER BY day DESC
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING day
+    ''', (owner_id, DISCREPANCY_REFRESH_MAX_DAYS))
+    days = [row[0] for row in cur.fetchall()]
+    if not days:
+        return 0
+
+    cur.execute(f'DELETE FROM {SCHEMA}.reconciliation_discrepancies WHERE owner_id = %s AND day = ANY(%s)', (owner_id, days))
+    cur.execute(f'DELETE FROM {SCHEMA}.reconciliation_discrepancy_days WHERE owner_id = %s AND day = ANY(%s)', (owner_id, days))
+
+    # Диапазоны по дням, а не created_at::date: так работают индексы (owner_id, created_at / doc_datetime)
+    cur.execute(f'''
+        WITH days AS (SELECT unnest(%(days)s::date[]) AS day)
+        INSERT INTO {SCHEMA}.reconciliation_discrepancies (
+            owner_id, integration_id, day, kind, direction, item_type, item_id, match_id,
+            reference, occurred_at, amount_kopecks, difference_kopecks
+        )
+        SELECT wp.owner_id, wp.integration_id, d.day, 'missing_receipt',
+               CASE wp.status WHEN 'REFUNDED' THEN 'refund' ELSE 'income' END,
+               'payment', wp.id, NULL, wp.payment_id, wp.created_at, wp.amount_kopecks, 0
+        FROM days d
+        JOIN {SCHEMA}.webhook_payments wp
+          ON wp.owner_id = %(owner_id)s AND wp.created_at >= d.day AND wp.created_at < d.day + 1
+        WHERE wp.status IN ('CONFIRMED', 'REFUNDED')
+          AND NOT EXISTS (
+              SELECT 1 FROM {SCHEMA}.reconciliation_match_items i
+              WHERE i.item_type = 'payment' AND i.item_id = wp.id
+          )
+        UNION ALL
+        SELECT r.owner_id, r.integration_id, d.day, 'missing_payment',
+               CASE r.operation_type WHEN 'RefundIncome' THEN 'refund' ELSE 'income' END,
+               'receipt', r.id, NULL, r.doc_number, r.doc_datetime,
+               COALESCE(NULLIF(r.ecash_kopecks, 0), r.total_kopecks), 0
+        FROM days d
+        JOIN {SCHEMA}.ofd_receipts r
+          ON r.owner_id = %(owner_id)s AND r.doc_datetime >= d.day AND r.doc_datetime < d.day + 1
+        WHERE r.operation_type IN ('Income', 'RefundIncome')
+          AND NOT EXISTS (
+              SELECT 1 FROM {SCHEMA}.reconciliation_match_items i
+              WHERE i.item_type = 'receipt' AND i.item_id = r.id
+          )
+        UNION ALL
+        SELECT m.owner_id, wp.integration_id, d.day, 'amount_mismatch', m.direction,
+               'payment', wp.id, m.id, wp.payment_id, wp.created_at, m.payments_kopecks, m.difference_kopecks
+        FROM days d
+        JOIN {SCHEMA}.webhook_payments wp
+          ON wp.owner_id = %(owner_id)s AND wp.created_at >= d.day AND wp.created_at < d.day + 1
+        JOIN {SCHEMA}.reconciliation_match_items i ON i.item_type = 'payment' AND i.item_id = wp.id
+        JOIN {SCHEMA}.reconciliation_matches m ON m.id = i.match_id AND m.match_type = 'amount_mismatch'
+    ''', {'owner_id': owner_id, 'days': days})
+
+    cur.execute(f'''
+        INSERT INTO {SCHEMA}.reconciliation_discrepancy_days (
+            owner_id, day, integration_id, kind, items, amount_kopecks, difference_kopecks
+        )
+        SELECT owner_id, day, integration_id, kind, COUNT(*), SUM(amount_kopecks), SUM(difference_kopecks)
+        FROM {SCHEMA}.reconciliation_discrepancies
+        WHERE owner_id = %s AND day = ANY(%s)
+        GROUP BY owner_id, day, integration_id, kind
+    ''', (owner_id, days))
+    return len(days)
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    with current_tracer().span('json'):
+        body = json.dumps(payload)
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+@traced('ofd-fetch-receipts')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Загрузка чеков из OFD.RU за указанный период
-    Args: integration_id, date_from (ISO), date_to (ISO)
-    Returns: список чеков и статистика загрузки
+    Запрашиваются только промежутки, еще не загруженные для этой ККТ (ofd_sync_ranges); force — весь период
+    Args: integration_id, date_from (ISO), date_to (ISO), force
+    Returns: статистика загрузки и запрошенные промежутки
     '''
     
     method = event.get('httpMethod', 'POST')
@@ -19,12 +753,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': CORS_PREFLIGHT_HEADERS,
             'body': '',
             'isBase64Encoded': False
         }
@@ -41,18 +770,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     integration_id = body_data.get('integration_id')
     date_from = body_data.get('date_from')
     date_to = body_data.get('date_to')
+    force = bool(body_data.get('force'))
     
     if not integration_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'integration_id required'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'integration_id required'})
     
-    dsn = os.environ['DATABASE_URL']
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
+    try:
+        conn = traced_connect(resolve_integration_owner(integration_id))
+    except ShardMovingError as e:
+        return json_response(503, {'error': str(e)}, {**JSON_HEADERS, 'Retry-After': str(SHARD_CACHE_TTL_SECONDS)})
+    cur = TracedCursor(conn.cursor())
     
     cur.execute('''
         SELECT config, owner_id, provider_id
@@ -63,12 +790,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     integration_row = cur.fetchone()
     if not integration_row:
         conn.close()
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Integration not found'}),
-            'isBase64Encoded': False
-        }
+        return json_response(404, {'error': 'Integration not found'})
     
     config, owner_id, provider_id = integration_row
     config = json.loads(config) if isinstance(config, str) else config
@@ -80,198 +802,186 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     if not all([inn, kkt, auth_token]):
         conn.close()
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Missing INN, KKT or auth_token in config'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'Missing INN, KKT or auth_token in config'})
     
-    if not date_from:
-        dt_from = datetime.now() - timedelta(days=30)
-        date_from = dt_from.strftime('%d.%m.%Y')
-    else:
-        try:
-            dt = datetime.fromisoformat(date_from.replace('Z', '+00:00'))
-            date_from = dt.strftime('%d.%m.%Y')
-        except:
-            dt_from = datetime.now() - timedelta(days=30)
-            date_from = dt_from.strftime('%d.%m.%Y')
+    now = datetime.now()
+    period_from = parse_period_bound(date_from, now - timedelta(days=DEFAULT_PERIOD_DAYS))
+    period_from = period_from.replace(hour=0, minute=0, second=0, microsecond=0)
+    period_to = parse_period_bound(date_to, now).replace(hour=23, minute=59, second=59, microsecond=0)
+    iso_from = period_from.strftime('%Y-%m-%dT%H:%M:%S')
+    iso_to = period_to.strftime('%Y-%m-%dT%H:%M:%S')
+    covered_until = min(period_to, now - timedelta(minutes=SYNC_LAG_MINUTES))
     
-    if not date_to:
-        date_to = datetime.now().strftime('%d.%m.%Y')
-    else:
-        try:
-            dt = datetime.fromisoformat(date_to.replace('Z', '+00:00'))
-            date_to = dt.strftime('%d.%m.%Y')
-        except:
-            date_to = datetime.now().strftime('%d.%m.%Y')
+    covered = []
+    if not force:
+        cur.execute('''
+            SELECT range_from, range_to
+            FROM t_p83864310_fintech_payment_reco.ofd_sync_ranges
+            WHERE integration_id = %s AND kkt = %s AND range_to >= %s AND range_from <= %s
+            ORDER BY range_from
+        ''', (integration_id, str(kkt), period_from, period_to))
+        covered = cur.fetchall()
     
-    test_url = f'{api_url}/api/integration/v2/inn/{inn}/kkts'
-    test_params = urllib.parse.urlencode({'AuthToken': auth_token})
-    test_full_url = f'{test_url}?{test_params}'
+    gaps = uncovered_gaps(period_from, period_to, covered)
+    print(f"[DEBUG] OFD sync period {iso_from}..{iso_to}, covered={len(covered)}, gaps={len(gaps)}, force={force}")
     
-    print(f"[DEBUG] Testing token with kkts endpoint: {test_full_url[:100]}...")
+    deadline = time.monotonic() + OFD_REQUEST_BUDGET_SECONDS
     
-    try:
-        test_req = urllib.request.Request(test_full_url, method='GET')
-        with urllib.request.urlopen(test_req, timeout=10) as test_response:
-            test_body = test_response.read().decode('utf-8')
+    if gaps:
+        test_url = f'{api_url}/api/integration/v2/inn/{inn}/kkts'
+        test_params = urllib.parse.urlencode({'AuthToken': auth_token})
+        test_full_url = f'{test_url}?{test_params}'
+        
+        print(f"[DEBUG] Testing token with kkts endpoint: {test_full_url[:100]}...")
+        
+        try:
+            test_response = traced_get(test_full_url, 'ofd kkts', 10, deadline)
+            test_body = test_response.body.decode('utf-8')
             print(f"[DEBUG] Token test successful! Response: {test_body[:200]}")
-    except Exception as test_error:
-        print(f"[DEBUG] Token test failed: {str(test_error)}")
-    
-    dt_from_obj = datetime.strptime(date_from, '%d.%m.%Y')
-    dt_to_obj = datetime.strptime(date_to, '%d.%m.%Y')
-    
-    iso_from = dt_from_obj.strftime('%Y-%m-%dT00:00:00')
-    iso_to = dt_to_obj.strftime('%Y-%m-%dT23:59:59')
+        except Exception as test_error:
+            print(f"[DEBUG] Token test failed: {str(test_error)}")
     
     ofd_url = f'{api_url}/api/integration/v2/inn/{inn}/kkt/{kkt}/receipts-with-fpd-short'
+    receipts = []
+    fetched_gaps = []
+    bytes_received = 0
+    bytes_decoded = 0
     
-    params = urllib.parse.urlencode({
-        'dateFrom': iso_from,
-        'dateTo': iso_to,
-        'AuthToken': auth_token
-    })
-    
-    full_url = f'{ofd_url}?{params}'
-    print(f"[DEBUG] OFD Request: {full_url[:100]}...")
-    
-    try:
-        req = urllib.request.Request(
-            full_url,
-            method='GET'
-        )
+    for gap_from, gap_to in gaps:
+        gap_iso_from = gap_from.strftime('%Y-%m-%dT%H:%M:%S')
+        gap_iso_to = gap_to.strftime('%Y-%m-%dT%H:%M:%S')
+        
+        params = urllib.parse.urlencode({
+            'dateFrom': gap_iso_from,
+            'dateTo': gap_iso_to,
+            'AuthToken': auth_token
+        })
         
-        print(f"[DEBUG] Auth token length: {len(auth_token) if auth_token else 0}")
+        full_url = f'{ofd_url}?{params}'
+        print(f"[DEBUG] OFD Request: {full_url[:100]}...")
         
-        with urllib.request.urlopen(req, timeout=30) as response:
-            response_body = response.read().decode('utf-8')
-            print(f"[DEBUG] Response status: {response.status}")
-            print(f"[DEBUG] Response body: {response_body[:500]}")
+        try:
+            response = traced_get(full_url, 'ofd receipts', 30, deadline)
+            bytes_received += response.wire_bytes
+            bytes_decoded += len(response.body)
+            response_body = response.body.decode('utf-8')
+            print(f"[DEBUG] Response status: {response.status}, bytes: {response.wire_bytes} "
+                  f"({len(response.body)} decoded), attempts: {response.attempts}")
             
-            receipts_data = json.loads(response_body)
+            with current_tracer().span('json', 'parse ofd'):
+                receipts_data = json.loads(response_body)
             
             if isinstance(receipts_data, dict) and receipts_data.get('Status') == 'Failed':
                 conn.close()
-                return {
-                    'statusCode': 200,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({
-                        'success': False,
-                        'error': f'OFD API returned error: {receipts_data.get("Errors", [])}',
-                        'error_details': receipts_data,
-                        'raw_response': response_body,
-                        'debug': {
-                            'full_url': full_url,
-                            'iso_from': iso_from,
-                            'iso_to': iso_to,
-                            'api_url': api_url,
-                            'inn': inn,
-                            'kkt': kkt,
-                            'token_length': len(auth_token) if auth_token else 0
-                        }
-                    }),
-                    'isBase64Encoded': False
-                }
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8') if e.fp else str(e)
-        conn.close()
-        
-        error_data = {}
-        try:
-            error_data = json.loads(error_body)
-        except:
-            error_data = {'raw_error': error_body}
-        
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
+                return json_response(200, {
+                    'success': False,
+                    'error': f'OFD API returned error: {receipts_data.get("Errors", [])}',
+                    'error_details': receipts_data,
+                    'raw_response': response_body,
+                    'debug': {
+                        'full_url': full_url,
+                        'iso_from': gap_iso_from,
+                        'iso_to': gap_iso_to,
+                        'api_url': api_url,
+                        'inn': inn,
+                        'kkt': kkt,
+                        'token_length': len(auth_token) if auth_token else 0
+                    }
+                })
+        except HttpError as e:
+            error_body = e.body.decode('utf-8', 'replace')
+            conn.close()
+            
+            error_data = {}
+            try:
+                error_data = json.loads(error_body)
+            except:
+                error_data = {'raw_error': error_body}
+            
+            return json_response(200, {
                 'success': False,
                 'error': f'OFD API error: {error_body}',
                 'error_details': error_data,
                 'debug': {
-                    'http_code': e.code,
+                    'http_code': e.status,
                     'full_url': full_url,
-                    'iso_from': iso_from,
-                    'iso_to': iso_to,
+                    'iso_from': gap_iso_from,
+                    'iso_to': gap_iso_to,
                     'has_token': bool(auth_token),
                     'api_url': api_url,
                     'inn': inn,
                     'kkt': kkt
                 }
-            }),
-            'isBase64Encoded': False
-        }
+            })
+        except Exception as e:
+            conn.close()
+            return json_response(500, {'error': str(e)})
+        
+        if isinstance(receipts_data, dict) and 'Data' in receipts_data:
+            receipts.extend(receipts_data.get('Data') or [])
+        elif isinstance(receipts_data, list):
+            receipts.extend(receipts_data)
+        
+        fetched_gaps.append({'from': gap_iso_from, 'to': gap_iso_to})
+    
+    print(f"[DEBUG] OFD HTTP metrics: {OFD_HTTP.metrics}")
+    
+    try:
+        unique_count, inserted_count, updated_count, changed_days, skipped = upsert_receipts(cur, integration_id, owner_id, receipts)
+        mark_dirty_days(cur, owner_id, changed_days)
+        if covered_until > period_from:
+            for range_from, range_to in synced_ranges(period_from, covered_until, skipped):
+                record_synced_range(cur, integration_id, str(kkt), range_from, range_to)
+        if inserted_count or updated_count:
+            # Одно событие на загрузку, а не на чек: payload NOTIFY ограничен 8000 байт
+            cur.execute("SELECT pg_notify('owner_events', %s)", (json.dumps({
+                'type': 'receipts',
+                'owner_id': owner_id,
+                'integration_id': integration_id,
+                'inserted': inserted_count,
+                'updated': updated_count
+            }),))
+        conn.commit()
     except Exception as e:
+        conn.rollback()
         conn.close()
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
-    
-    if isinstance(receipts_data, dict) and 'Data' in receipts_data:
-        receipts = receipts_data.get('Data', [])
-    elif isinstance(receipts_data, list):
-        receipts = receipts_data
-    else:
-        receipts = []
+        return json_response(500, {'error': str(e)})
     
-    inserted_count = 0
-    for receipt in receipts:
-        try:
-            cur.execute('''
-                INSERT INTO t_p83864310_fintech_payment_reco.ofd_receipts (
-                    integration_id, owner_id, receipt_id, operation_type,
-                    total_sum, cash_sum, ecash_sum, doc_number, doc_datetime,
-                    fn_number, raw_data
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (integration_id, receipt_id) DO NOTHING
-                RETURNING id
-            ''', (
-                integration_id,
-                owner_id,
-                receipt.get('Id'),
-                receipt.get('OperationType'),
-                float(receipt.get('TotalSumm', 0)) / 100,
-                float(receipt.get('CashSumm', 0)) / 100,
-                float(receipt.get('ECashSumm', 0)) / 100,
-                receipt.get('DocNumber'),
-                receipt.get('DocDateTime'),
-                receipt.get('FnNumber'),
-                json.dumps(receipt)
-            ))
-            
-            if cur.fetchone():
-                inserted_count += 1
-        except Exception as e:
-            continue
+    refreshed_days = 0
+    try:
+        refreshed_days = refresh_discrepancies(cur, owner_id)
+        conn.commit()
+    except psycopg2.Error as e:
+        # Чеки уже сохранены, дни остаются помеченными до следующего пересчета
+        conn.rollback()
+        print(f"[DEBUG] Discrepancy refresh failed for owner={owner_id}: {str(e)}")
     
-    conn.commit()
+    # Клиент вернет его в X-Min-LSN: receipts-list не прочитает с реплики чеки старее этой загрузки
+    cur.execute('SELECT pg_current_wal_lsn()')
+    write_lsn = cur.fetchone()[0]
     conn.close()
     
-    return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({
-            'success': True,
-            'total_receipts': len(receipts),
-            'inserted': inserted_count,
-            'iso_from': iso_from,
-            'iso_to': iso_to
-        }),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
+    # Для планировщика ofd-sync-scheduler: новая отметка загруженности интеграции (только по сохраненным чекам)
+    skipped_ids = {item['id'] for item in skipped}
+    max_doc_datetime = max((
+        str(r.get('DocDateTime')) for r in receipts
+        if isinstance(r, dict) and r.get('DocDateTime') and str(r.get('Id')) not in skipped_ids
+    ), default=None)
+    
+    return json_response(200, {
+        'success': True,
+        'total_receipts': len(receipts),
+        'inserted': inserted_count,
+        'updated': updated_count,
+        'unchanged': unique_count - inserted_count - updated_count,
+        'skipped': len(skipped),
+        'skipped_receipts': skipped[:20],
+        'iso_from': iso_from,
+        'iso_to': iso_to,
+        'gaps': fetched_gaps,
+        'force': force,
+        'bytes_received': bytes_received,
+        'bytes_decoded': bytes_decoded,
+        'refreshed_days': refreshed_days,
+        'max_doc_datetime': max_doc_datetime
+    }, {**JSON_HEADERS, 'Access-Control-Expose-Headers': 'X-Write-LSN', 'X-Write-LSN': write_lsn})
@@ -0,0 +1,370 @@
+import json
+import os
+import threading
+import time
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+SCHEMA = 't_p83864310_fintech_payment_reco'
+
+DEFAULT_OFD_FETCH_URL = 'https://functions.poehali.dev/c7fad594-b60b-47fb-8f73-31b629f1e0a2'
+
+# Таймер вызывает планировщик раз в SLOT_SECONDS; интеграция попадает в слот id % SYNC_SLOTS,
+# так что каждая синхронизируется раз в SYNC_SLOTS * SLOT_SECONDS (по умолчанию раз в час),
+# а нагрузка на OFD и БД размазана по слотам равномерно
+SYNC_SLOTS = int(os.environ.get('OFD_SYNC_SLOTS', '12'))
+SLOT_SECONDS = int(os.environ.get('OFD_SYNC_SLOT_SECONDS', '300'))
+CYCLE_SECONDS = SYNC_SLOTS * SLOT_SECONDS
+# Пропустившие свой слот (аренда, сбой таймера) догоняются в любом слоте после трех циклов
+OVERDUE_CYCLES = 3
+SYNC_CONCURRENCY = 4
+# Ожидание ответа ofd-fetch-receipts: бюджет ее запросов к OFD (тот же OFD_REQUEST_BUDGET_SECONDS)
+# плюс upsert чеков и пересчет расхождений после него; иначе успешная загрузка считалась бы ошибкой
+OFD_FETCH_BUDGET_SECONDS = float(os.environ.get('OFD_REQUEST_BUDGET_SECONDS', '25'))
+FETCH_DB_ALLOWANCE_SECONDS = 20
+FETCH_TIMEOUT_SECONDS = OFD_FETCH_BUDGET_SECONDS + FETCH_DB_ALLOWANCE_SECONDS
+LEASE_SECONDS = int(FETCH_TIMEOUT_SECONDS * 4)
+# Все взятые интеграции должны успеть отработать до конца аренды, даже если каждая ждет полный таймаут:
+# SYNC_CONCURRENCY потоков успевают LEASE_SECONDS / FETCH_TIMEOUT_SECONDS волн, одна волна — запас
+# на запись результатов. Иначе аренда истекает, пока интеграция ждет в очереди пула, и следующий
+# запуск берет ее повторно
+MAX_INTEGRATIONS_PER_RUN = SYNC_CONCURRENCY * max(1, int(LEASE_SECONDS // FETCH_TIMEOUT_SECONDS) - 1)
+# Повторы после ошибок реже: через 1, 2, 4 ... циклов, но не реже раза в сутки
+MAX_BACKOFF_CYCLES = max(1, 86400 // CYCLE_SECONDS)
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def shard_names() -> List[str]:
+    return ['main'] + sorted(SHARD_DSNS)
+
+def foreign_owners(cur, shard: str) -> List[int]:
+    '''
+    Владельцы, чьи строки на шарде shard обрабатывать нельзя: переносятся или уже перенесены на другой шард
+    (строки на старом шарде живут до удаления shard_rebalance.py). Запрос к основной БД через cur
+    '''
+    if not SHARD_DSNS:
+        return []
+    cur.execute(
+        f'SELECT owner_id FROM {SCHEMA}.owner_shards WHERE status = %s OR shard <> %s',
+        ('moving', shard)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+def current_slot() -> int:
+    return int(time.time() // SLOT_SECONDS) % SYNC_SLOTS
+
+# Исходящий HTTP: постоянные соединения по хостам, одна попытка на запрос.
+# Одинаковый блок в webhook-receive, notifications-dispatch и ofd-sync-scheduler (общих модулей у функций нет):
+# повторы у них не в клиенте — outbox, следующий цикл планировщика, журнал webhook_forward_logs.
+# Клиент с повторами, gzip и token bucket — в ofd-fetch-receipts, проверка копий — scripts/http_client_check.py.
+# http.client/ssl импортируются при первом запросе: webhook-receive без пересылки их не загружает
+# (cold_start_budget.json)
+class HttpError(Exception):
+    '''
+    Ответ со статусом >= 400
+    '''
+    def __init__(self, status: int, body: bytes, headers: Dict[str, str]):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+        self.body = body
+        self.headers = headers
+
+class HttpResponse:
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+class HttpClient:
+    '''
+    Клиент с пулом keep-alive соединений на (scheme, host, port), одна попытка на запрос. Соединение,
+    закрытое сервером между вызовами, переоткрывается: запрос до сервера не дошел
+    '''
+    def __init__(self, timeout: float = 30.0, connect_timeout: float = 5.0, pool_size: int = 4):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.pool_size = pool_size
+        self._pools: Dict[Tuple[str, str, int], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def _checkout(self, key: Tuple[str, str, int]) -> Tuple[Any, bool]:
+        import http.client
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool:
+                return pool.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            import ssl
+            return http.client.HTTPSConnection(host, port, timeout=self.connect_timeout,
+                                               context=ssl.create_default_context()), False
+        return http.client.HTTPConnection(host, port, timeout=self.connect_timeout), False
+
+    def _checkin(self, key: Tuple[str, str, int], conn: Any) -> None:
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def _send(self, key: Tuple[str, str, int], method: str, target: str, body: Optional[bytes],
+              headers: Dict[str, str], timeout: float) -> Tuple[int, Dict[str, str], bytes]:
+        import http.client
+        for fresh_retry in (False, True):
+            conn, reused = self._checkout(key)
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(timeout)
+                conn.request(method, target, body=body, headers=headers)
+                response = conn.getresponse()
+                raw = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # Сервер закрыл простаивавшее соединение: повтор на новом
+                if reused and not fresh_retry:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(key, conn)
+            return response.status, {name.lower(): value for name, value in response.getheaders()}, raw
+        raise ConnectionError('connection closed by server')
+
+    def request(self, method: str, url: str, body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None,
+                timeout: Optional[float] = None) -> HttpResponse:
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        key = (scheme, parts.hostname or '', parts.port or (443 if scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        request_headers = {'Connection': 'keep-alive', **(headers or {})}
+
+        status, response_headers, raw = self._send(key, method, target, body, request_headers, timeout or self.timeout)
+        if status >= 400:
+            raise HttpError(status, raw, response_headers)
+        return HttpResponse(status, response_headers, raw)
+
+# Соединения с ofd-fetch-receipts переиспользуются потоками пула; POST не повторяется:
+# неудачная интеграция уходит на повтор через consecutive_failures в следующих циклах
+OFD_FETCH_HTTP = HttpClient(timeout=FETCH_TIMEOUT_SECONDS, connect_timeout=5.0, pool_size=SYNC_CONCURRENCY)
+
+def fetch_receipts(integration_id: int, date_from: Optional[str]) -> Dict[str, Any]:
+    '''
+    Вызов ofd-fetch-receipts для одной интеграции, догрузка от отметки date_from
+    Returns: ответ функции с добавленными duration_ms и error
+    '''
+    url = os.environ.get('OFD_FETCH_URL', DEFAULT_OFD_FETCH_URL)
+    payload = {'integration_id': integration_id}
+    if date_from:
+        payload['date_from'] = date_from
+
+    started = time.monotonic()
+    try:
+        response = OFD_FETCH_HTTP.request(
+            'POST', url, body=json.dumps(payload).encode('utf-8'), headers={'Content-Type': 'application/json'}
+        )
+        result = json.loads(response.body.decode('utf-8'))
+    except HttpError as e:
+        error_body = e.body.decode('utf-8', errors='replace')
+        result = {'success': False, 'error': f'HTTP {e.status}: {error_body[:500]}'}
+    except Exception as e:
+        result = {'success': False, 'error': str(e)}
+
+    result['duration_ms'] = int((time.monotonic() - started) * 1000)
+    if not result.get('success') and not result.get('error'):
+        result['error'] = 'Unknown error'
+    return result
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Фоновая синхронизация чеков всех активных OFD-интеграций на всех шардах (вызывается по таймеру)
+    POST {} — текущий слот; {slot} — заданный слот; {integration_id} — одна интеграция вне очереди
+    Каждая интеграция догружается от своей отметки high_water_mark, статистика пишется в ofd_sync_runs
+    '''
+    method = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': CORS_PREFLIGHT_HEADERS,
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'POST':
+        return json_response(405, {'error': 'Method not allowed'})
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+        slot = int(body['slot']) % SYNC_SLOTS if body.get('slot') is not None else current_slot()
+        only_integration_id = int(body['integration_id']) if body.get('integration_id') is not None else None
+    except (ValueError, TypeError, AttributeError):
+        return json_response(400, {'error': 'Body must be a JSON object with numeric slot and integration_id'})
+
+    main_conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conns = {'main': main_conn}
+
+    try:
+        if only_integration_id:
+            condition = 'ui.id = %s'
+            condition_params = [only_integration_id]
+        else:
+            condition = '''
+                (ui.id %% %s = %s OR s.last_run_at < NOW() - %s * INTERVAL '1 second')
+                AND (
+                    COALESCE(s.consecutive_failures, 0) = 0
+                    OR s.last_run_at < NOW() - LEAST(power(2, s.consecutive_failures - 1), %s) * %s * INTERVAL '1 second'
+                )
+            '''
+            condition_params = [SYNC_SLOTS, slot, OVERDUE_CYCLES * CYCLE_SECONDS, MAX_BACKOFF_CYCLES, CYCLE_SECONDS]
+
+        candidates_total = 0
+        claimed = []
+        # MAX_INTEGRATIONS_PER_RUN — на весь запуск, а не на шард: аренда рассчитана на столько интеграций.
+        # Обход начинается с шарда по слоту, чтобы остаток бюджета не доставался всегда одним и тем же
+        remaining = MAX_INTEGRATIONS_PER_RUN
+        shards = shard_names()
+        first = slot % len(shards)
+        for shard in shards[first:] + shards[:first]:
+            if remaining <= 0:
+                break
+            excluded_owners = foreign_owners(main_conn.cursor(), shard)
+            main_conn.commit()
+            if shard not in conns:
+                conns[shard] = psycopg2.connect(shard_dsn(shard))
+            conn = conns[shard]
+            cur = conn.cursor()
+
+            cur.execute(f'''
+                SELECT ui.id, ui.owner_id
+                FROM {SCHEMA}.user_integrations ui
+                JOIN {SCHEMA}.integration_providers p ON p.id = ui.provider_id
+                LEFT JOIN {SCHEMA}.ofd_sync_state s ON s.integration_id = ui.id
+                WHERE p.slug = 'ofdru'
+                  AND ui.status = 'active'
+                  AND ui.owner_id <> ALL(%s)
+                  AND (s.lease_until IS NULL OR s.lease_until < NOW())
+                  AND {condition}
+                ORDER BY s.last_run_at NULLS FIRST
+                LIMIT %s
+            ''', [excluded_owners] + condition_params + [remaining])
+            candidates = cur.fetchall()
+            candidates_total += len(candidates)
+
+            for integration_id, owner_id in candidates:
+                cur.execute(f'''
+                    INSERT INTO {SCHEMA}.ofd_sync_state AS s (integration_id, owner_id, lease_until)
+                    VALUES (%s, %s, NOW() + %s * INTERVAL '1 second')
+                    ON CONFLICT (integration_id) DO UPDATE SET
+                        lease_until = EXCLUDED.lease_until,
+                        updated_at = NOW()
+                    WHERE s.lease_until IS NULL OR s.lease_until < NOW()
+                    RETURNING integration_id, owner_id, high_water_mark
+                ''', (integration_id, owner_id, LEASE_SECONDS))
+                row = cur.fetchone()
+                if row:
+                    claimed.append((shard,) + row)
+                    remaining -= 1
+            conn.commit()
+
+        with ThreadPoolExecutor(max_workers=SYNC_CONCURRENCY) as executor:
+            futures = [
+                (row, executor.submit(fetch_receipts, row[1], row[3].isoformat() if row[3] else None))
+                for row in claimed
+            ]
+            results = [(row, future.result()) for row, future in futures]
+
+        runs: List[Dict[str, Any]] = []
+        for (shard, integration_id, owner_id, high_water_mark), result in results:
+            ok = bool(result.get('success'))
+            run = {
+                'integration_id': integration_id,
+                'status': 'success' if ok else 'failed',
+                'date_from': high_water_mark.isoformat() if high_water_mark else None,
+                'receipts_fetched': int(result.get('total_receipts') or 0),
+                'inserted': int(result.get('inserted') or 0),
+                'updated': int(result.get('updated') or 0),
+                'bytes_received': int(result.get('bytes_received') or 0),
+                'duration_ms': result['duration_ms'],
+                'error': None if ok else str(result.get('error'))[:1000]
+            }
+
+            cur = conns[shard].cursor()
+            cur.execute(f'''
+                INSERT INTO {SCHEMA}.ofd_sync_runs (
+                    integration_id, owner_id, slot, status, date_from, receipts_fetched,
+                    inserted, updated, bytes_received, duration_ms, error
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ''', (
+                integration_id, owner_id, slot, run['status'], high_water_mark, run['receipts_fetched'],
+                run['inserted'], run['updated'], run['bytes_received'], run['duration_ms'], run['error']
+            ))
+
+            cur.execute(f'''
+                UPDATE {SCHEMA}.ofd_sync_state
+                SET high_water_mark = GREATEST(high_water_mark, %s::timestamp),
+                    last_run_at = NOW(),
+                    last_success_at = CASE WHEN %s THEN NOW() ELSE last_success_at END,
+                    last_status = %s,
+                    last_error = %s,
+                    consecutive_failures = CASE WHEN %s THEN 0 ELSE consecutive_failures + 1 END,
+                    lease_until = NULL,
+                    updated_at = NOW()
+                WHERE integration_id = %s
+            ''', (
+                result.get('max_doc_datetime') if ok else None,
+                ok, run['status'], run['error'], ok, integration_id
+            ))
+            run['shard'] = shard
+            runs.append(run)
+
+        for conn in conns.values():
+            conn.commit()
+
+        print(f"[DEBUG] OFD sync slot={slot}: candidates={candidates_total}, claimed={len(claimed)}, "
+              f"failed={sum(1 for r in runs if r['status'] == 'failed')}, "
+              f"inserted={sum(r['inserted'] for r in runs)}, bytes={sum(r['bytes_received'] for r in runs)}")
+
+        return json_response(200, {
+            'success': True,
+            'slot': slot,
+            'slots': SYNC_SLOTS,
+            'runs': runs
+        })
+
+    except Exception as e:
+        for conn in conns.values():
+            conn.rollback()
+        return json_response(500, {'error': str(e)})
+    finally:
+        for conn in conns.values():
+            conn.close()
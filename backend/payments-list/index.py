@@ -1,8 +1,246 @@
 import json
 import os
+import re
+import time
+import functools
+import threading
 import psycopg2
-from typing import Dict, Any
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Any, List, Tuple, Optional
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Min-LSN',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT shard, status FROM t_p83864310_fintech_payment_reco.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+# Реплики для чтения по шардам: {"main": "postgres://replica...", "shard-2": "..."}.
+# Шард без реплики, отставшая или недоступная реплика — чтение с primary
+REPLICA_DSNS: Dict[str, str] = json.loads(os.environ.get('REPLICA_DSNS') or '{}')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_RETRY_SECONDS = 10
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+_replica_skip_until: Dict[str, float] = {}
+
+def read_min_lsn(event: Dict[str, Any]) -> Optional[str]:
+    '''
+    X-Min-LSN клиента — X-Write-LSN его последней записи: реплика должна догнать этот LSN
+    '''
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    value = (headers.get('x-min-lsn') or '').strip()
+    return value if LSN_PATTERN.match(value) else None
+
+def get_read_connection(owner_id: Any, min_lsn: Optional[str] = None) -> Tuple[Any, str]:
+    '''
+    Соединение для чтения: реплика шарда, если лаг не больше REPLICA_MAX_LAG_SECONDS и она проиграла
+    min_lsn (чтение своих записей), иначе primary. Отставшая или недоступная реплика пропускается
+    на REPLICA_RETRY_SECONDS, чтобы не платить за проверку в каждом запросе
+    Returns: (conn, 'replica' | 'primary')
+    '''
+    shard, _ = resolve_shard(owner_id)
+    replica_dsn = REPLICA_DSNS.get(shard)
+    if replica_dsn and _replica_skip_until.get(shard, 0) <= time.monotonic():
+        try:
+            conn = psycopg2.connect(replica_dsn)
+        except psycopg2.OperationalError as e:
+            print(f"[DEBUG] Replica {shard} unavailable: {str(e).strip()}")
+            _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+        else:
+            cur = conn.cursor()
+            # Реплика, проигравшая все полученное, не отстает, даже если на primary давно не было записей
+            cur.execute('''
+                SELECT
+                    CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                         ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END,
+                    %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+            ''', (min_lsn, min_lsn))
+            lag_seconds, caught_up = cur.fetchone()
+            cur.close()
+            if lag_seconds <= REPLICA_MAX_LAG_SECONDS and caught_up:
+                return conn, 'replica'
+            conn.close()
+            if lag_seconds > REPLICA_MAX_LAG_SECONDS:
+                print(f"[DEBUG] Replica {shard} lag {float(lag_seconds):.1f}s, reading from primary")
+                _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+    return psycopg2.connect(shard_dsn(shard)), 'primary'
+
+def json_default(value: Any) -> Any:
+    '''
+    Decimal и даты из psycopg2 сериализуются энкодером, без обхода строк вручную
+    '''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def dumps(payload: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload, default=json_default).decode('utf-8')
+    return json.dumps(payload, default=json_default)
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    with current_tracer().span('json'):
+        body = dumps(payload)
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+# Трассировка запроса: SQL, внешние HTTP и сериализация попадают в заголовок Server-Timing.
+# Включается TRACE_ENABLED=1 на время разбора задержек: заголовок раскрывает клиенту время запросов к БД,
+# поэтому по умолчанию обертка не ставится и спаны пишутся в пустой _NULL_TRACER.
+# Если задан TRACE_SINK_PATH, спаны дописываются туда JSON-строкой на запрос.
+# Одинаковый блок только в payments-list, receipts-list и ofd-fetch-receipts: их задержку дают SQL, сериализация
+# и OFD, которые трассировка раскладывает. Остальные функции Server-Timing не отдают — записи и фоновые задачи
+# печатают длительность прогона в [DEBUG], а копия блока в каждой функции утяжелила бы холодный старт ради
+# выключенного в проде переключателя
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED', '') == '1'
+TRACE_SINK_PATH = os.environ.get('TRACE_SINK_PATH')
+
+_trace_state = threading.local()
+
+class Tracer:
+    def __init__(self, function_name: str):
+        self.function_name = function_name
+        self.started = time.perf_counter()
+        self.spans: List[tuple] = []
+
+    @contextmanager
+    def span(self, kind: str, label: str = ''):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((kind, label, (time.perf_counter() - started) * 1000))
+
+    def server_timing(self) -> str:
+        totals: Dict[str, List[float]] = {}
+        for kind, _, duration in self.spans:
+            totals.setdefault(kind, []).append(duration)
+        parts = [f'{kind};dur={sum(durations):.1f};desc="{len(durations)}"' for kind, durations in totals.items()]
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(parts)
+
+    def flush(self, status_code: Any) -> None:
+        if not TRACE_SINK_PATH:
+            return
+        record = {
+            'ts': time.time(),
+            'function': self.function_name,
+            'status': status_code,
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'spans': [{'kind': kind, 'label': label, 'ms': round(duration, 2)} for kind, label, duration in self.spans]
+        }
+        try:
+            with open(TRACE_SINK_PATH, 'a', encoding='utf-8') as sink:
+                sink.write(json.dumps(record, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"[DEBUG] Trace sink write failed: {str(e)}")
+
+class _NullTracer(Tracer):
+    def __init__(self):
+        super().__init__('')
+
+    @contextmanager
+    def span(self, kind: str, label: str = ''):
+        yield
+
+_NULL_TRACER = _NullTracer()
+
+def current_tracer() -> Tracer:
+    return getattr(_trace_state, 'tracer', None) or _NULL_TRACER
+
+def traced(function_name: str):
+    '''
+    Обертка handler: создает Tracer на запрос и добавляет Server-Timing в ответ; без TRACE_ENABLED — handler как есть
+    '''
+    def decorator(fn):
+        if not TRACE_ENABLED:
+            return fn
+        @functools.wraps(fn)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            tracer = Tracer(function_name)
+            _trace_state.tracer = tracer
+            try:
+                response = fn(event, context)
+            finally:
+                _trace_state.tracer = None
+            response['headers'] = {
+                **(response.get('headers') or {}),
+                'Server-Timing': tracer.server_timing(),
+                'Timing-Allow-Origin': '*'
+            }
+            tracer.flush(response.get('statusCode'))
+            return response
+        return wrapper
+    return decorator
+
+class TracedCursor:
+    '''
+    Курсор psycopg2, который пишет каждый execute в спан db
+    '''
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=None):
+        label = ' '.join(str(query).split())[:80]
+        with current_tracer().span('db', label):
+            return self._cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def traced_connect(owner_id: Any, min_lsn: Optional[str]) -> Tuple[Any, str]:
+    with current_tracer().span('connect'):
+        return get_read_connection(owner_id, min_lsn)
+
+@traced('payments-list')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Получение списка платежей из вебхуков с фильтрацией
@@ -13,23 +251,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': CORS_PREFLIGHT_HEADERS,
             'body': '',
             'isBase64Encoded': False
         }
     
     if method != 'GET':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return json_response(405, {'error': 'Method not allowed'})
     
     params = event.get('queryStringParameters', {}) or {}
     owner_id = params.get('owner_id')
@@ -38,16 +266,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     offset = int(params.get('offset', 0))
     
     if not owner_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'owner_id required'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'owner_id required'})
+    
+    try:
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'owner_id must be a number'})
     
-    dsn = os.environ['DATABASE_URL']
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
+    try:
+        conn, read_source = traced_connect(owner_id, read_min_lsn(event))
+    except psycopg2.OperationalError as e:
+        print(f"[DEBUG] Database unavailable: {str(e).strip()}")
+        return json_response(503, {'error': 'Database unavailable'})
+    cur = TracedCursor(conn.cursor())
     
     try:
         where_clause = 'WHERE wp.owner_id = %s'
@@ -61,7 +292,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             SELECT 
                 wp.id,
                 wp.payment_id,
-                wp.amount,
+                wp.amount_kopecks,
                 wp.order_id,
                 wp.status,
                 wp.payment_status,
@@ -76,7 +307,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 wp.receipt_id,
                 wp.created_at,
                 ui.integration_name,
-                p.name as provider_name
+                p.name as provider_name,
+                wp.raw_archive_segment IS NOT NULL AS raw_archived
             FROM webhook_payments wp
             JOIN user_integrations ui ON ui.id = wp.integration_id
             JOIN integration_providers p ON p.id = ui.provider_id
@@ -90,7 +322,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             payments.append({
                 'id': row[0],
                 'payment_id': row[1],
-                'amount': float(row[2]) if row[2] else 0,
+                'amount': row[2] / 100,
+                'amount_kopecks': row[2],
                 'order_id': row[3],
                 'status': row[4],
                 'payment_status': row[5],
@@ -103,9 +336,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'terminal_key': row[12],
                 'raw_data': row[13],
                 'receipt_id': row[14],
-                'created_at': row[15].isoformat() if row[15] else None,
+                'created_at': row[15],
                 'integration_name': row[16],
-                'provider_name': row[17]
+                'provider_name': row[17],
+                # raw_data старого платежа в архиве (null): карточка загружает его через raw-payload-fetch
+                'raw_archived': row[18]
             })
         
         cur.execute(f'''
@@ -116,25 +351,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         total = cur.fetchone()[0]
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'payments': payments,
-                'total': total,
-                'limit': limit,
-                'offset': offset
-            }),
-            'isBase64Encoded': False
-        }
+        return json_response(200, {
+            'payments': payments,
+            'total': total,
+            'limit': limit,
+            'offset': offset
+        }, {**JSON_HEADERS, 'X-Read-Source': read_source})
         
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'error': str(e)})
     finally:
         cur.close()
         conn.close()
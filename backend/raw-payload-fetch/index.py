@@ -0,0 +1,358 @@
+import hashlib
+import json
+import os
+import re
+import time
+import psycopg2
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Any, List, Tuple, Optional
+from urllib.parse import urlsplit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Min-LSN',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+SCHEMA = 't_p83864310_fintech_payment_reco'
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute(f'SELECT shard, status FROM {SCHEMA}.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+# Реплики для чтения по шардам: {"main": "postgres://replica...", "shard-2": "..."}.
+# Шард без реплики, отставшая или недоступная реплика — чтение с primary
+REPLICA_DSNS: Dict[str, str] = json.loads(os.environ.get('REPLICA_DSNS') or '{}')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_RETRY_SECONDS = 10
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+_replica_skip_until: Dict[str, float] = {}
+
+def read_min_lsn(event: Dict[str, Any]) -> Optional[str]:
+    '''
+    X-Min-LSN клиента — X-Write-LSN его последней записи: реплика должна догнать этот LSN
+    '''
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    value = (headers.get('x-min-lsn') or '').strip()
+    return value if LSN_PATTERN.match(value) else None
+
+def get_read_connection(owner_id: Any, min_lsn: Optional[str] = None) -> Tuple[Any, str]:
+    '''
+    Соединение для чтения: реплика шарда, если лаг не больше REPLICA_MAX_LAG_SECONDS и она проиграла
+    min_lsn (чтение своих записей), иначе primary. Отставшая или недоступная реплика пропускается
+    на REPLICA_RETRY_SECONDS, чтобы не платить за проверку в каждом запросе
+    Returns: (conn, 'replica' | 'primary')
+    '''
+    shard, _ = resolve_shard(owner_id)
+    replica_dsn = REPLICA_DSNS.get(shard)
+    if replica_dsn and _replica_skip_until.get(shard, 0) <= time.monotonic():
+        try:
+            conn = psycopg2.connect(replica_dsn)
+        except psycopg2.OperationalError as e:
+            print(f"[DEBUG] Replica {shard} unavailable: {str(e).strip()}")
+            _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+        else:
+            cur = conn.cursor()
+            # Реплика, проигравшая все полученное, не отстает, даже если на primary давно не было записей
+            cur.execute('''
+                SELECT
+                    CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                         ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END,
+                    %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+            ''', (min_lsn, min_lsn))
+            lag_seconds, caught_up = cur.fetchone()
+            cur.close()
+            if lag_seconds <= REPLICA_MAX_LAG_SECONDS and caught_up:
+                return conn, 'replica'
+            conn.close()
+            if lag_seconds > REPLICA_MAX_LAG_SECONDS:
+                print(f"[DEBUG] Replica {shard} lag {float(lag_seconds):.1f}s, reading from primary")
+                _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+    return psycopg2.connect(shard_dsn(shard)), 'primary'
+
+def json_default(value: Any) -> Any:
+    '''
+    Decimal и даты из psycopg2 сериализуются энкодером, без обхода строк вручную
+    '''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def dumps(payload: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload, default=json_default).decode('utf-8')
+    return json.dumps(payload, default=json_default)
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': dumps(payload),
+        'isBase64Encoded': False
+    }
+
+# Архив raw_data (scripts/raw_archive.py). Сегмент — объект из подряд записанных блоков, каждый блок сжат
+# отдельно (gzip или zstd, по расширению ключа) и содержит строки "id\traw_data::text". Строка таблицы
+# хранит ключ сегмента, смещение и длину своего блока: чтение одного payload — range-запрос одного блока.
+# RAW_ARCHIVE_URL — s3://bucket/prefix (endpoint — RAW_ARCHIVE_S3_ENDPOINT) или каталог (file:///var/lib/raw-archive)
+RAW_ARCHIVE_URL = os.environ.get('RAW_ARCHIVE_URL', '')
+ARCHIVE_TABLES = {'payment': 'webhook_payments', 'receipt': 'ofd_receipts'}
+ARCHIVE_CODECS = {'gzip': '.gz', 'zstd': '.zst'}
+# Соседние чеки и платежи открывают подряд — блок, уже распакованный этим процессом, читается из памяти
+BLOCK_CACHE_SIZE = 32
+
+class LocalArchiveStore:
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split('/'))
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as segment_file:
+            segment_file.write(data)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        os.replace(tmp_path, path)
+
+    def read_range(self, key: str, offset: int, length: int) -> bytes:
+        with open(self.path(key), 'rb') as segment_file:
+            segment_file.seek(offset)
+            data = segment_file.read(length)
+        if len(data) != length:
+            raise OSError(f'Short read from {key}: {len(data)} of {length} bytes')
+        return data
+
+class S3ArchiveStore:
+    '''
+    S3-совместимое хранилище (Yandex Object Storage, MinIO): ключи из AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY,
+    endpoint — RAW_ARCHIVE_S3_ENDPOINT. boto3 импортируется при первом обращении, не при холодном старте
+    '''
+    def __init__(self, bucket: str, prefix: str):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self._client = None
+
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3', endpoint_url=os.environ.get('RAW_ARCHIVE_S3_ENDPOINT') or None)
+        return self._client
+
+    def object_key(self, key: str) -> str:
+        return f'{self.prefix}/{key}' if self.prefix else key
+
+    def put(self, key: str, data: bytes) -> None:
+        self.client().put_object(Bucket=self.bucket, Key=self.object_key(key), Body=data)
+
+    def read_range(self, key: str, offset: int, length: int) -> bytes:
+        response = self.client().get_object(
+            Bucket=self.bucket, Key=self.object_key(key), Range=f'bytes={offset}-{offset + length - 1}'
+        )
+        return response['Body'].read()
+
+def open_archive_store(url: str):
+    parts = urlsplit(url)
+    if parts.scheme == 's3':
+        return S3ArchiveStore(parts.netloc, parts.path)
+    return LocalArchiveStore(parts.path if parts.scheme == 'file' else url)
+
+_archive_store = None
+
+def archive_store():
+    global _archive_store
+    if _archive_store is None:
+        if not RAW_ARCHIVE_URL:
+            raise RuntimeError('RAW_ARCHIVE_URL is not configured')
+        _archive_store = open_archive_store(RAW_ARCHIVE_URL)
+    return _archive_store
+
+def segment_codec(key: str) -> str:
+    for codec, suffix in ARCHIVE_CODECS.items():
+        if key.endswith(suffix):
+            return codec
+    raise ValueError(f'Unknown archive codec: {key}')
+
+def compress_block(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    import gzip
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+def decompress_block(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    import gzip
+    return gzip.decompress(data)
+
+def encode_block(rows: List[Tuple[int, str]]) -> bytes:
+    '''
+    jsonb::text не содержит переводов строк и табуляций (в строках JSON они экранированы)
+    '''
+    return '\n'.join(f'{row_id}\t{raw_text}' for row_id, raw_text in rows).encode('utf-8')
+
+def payload_md5(raw_text: str) -> str:
+    return hashlib.md5(raw_text.encode('utf-8')).hexdigest()
+
+_block_cache: 'OrderedDict[Tuple[str, int], Dict[int, str]]' = OrderedDict()
+
+def read_archived_payload(store: Any, segment: str, offset: int, length: int, row_id: int, expected_md5: str) -> str:
+    '''
+    raw_data::text строки из блока сегмента; md5 сверяется с записанным архиватором
+    '''
+    cache_key = (segment, offset)
+    block = _block_cache.get(cache_key)
+    if block is None:
+        data = decompress_block(store.read_range(segment, offset, length), segment_codec(segment))
+        block = {}
+        for line in data.decode('utf-8').split('\n'):
+            if line:
+                block_row_id, _, raw_text = line.partition('\t')
+                block[int(block_row_id)] = raw_text
+        _block_cache[cache_key] = block
+        if len(_block_cache) > BLOCK_CACHE_SIZE:
+            _block_cache.popitem(last=False)
+    else:
+        _block_cache.move_to_end(cache_key)
+
+    raw_text = block.get(row_id)
+    if raw_text is None:
+        raise LookupError(f'Row {row_id} not found in {segment} at {offset}')
+    if payload_md5(raw_text) != expected_md5:
+        raise ValueError(f'md5 mismatch for row {row_id} in {segment}')
+    return raw_text
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    raw_data платежа или чека для карточки: из строки таблицы, а если payload уже в архиве — из блока сегмента
+    GET /raw-payload-fetch?owner_id=123&type=payment&id=456 (type: payment | receipt)
+    Returns: raw_data и source ('hot' | 'archive')
+    '''
+    method: str = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': CORS_PREFLIGHT_HEADERS,
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'GET':
+        return json_response(405, {'error': 'Method not allowed'})
+
+    params = event.get('queryStringParameters', {}) or {}
+    owner_id = params.get('owner_id')
+    kind = params.get('type')
+
+    if not owner_id:
+        return json_response(400, {'error': 'owner_id required'})
+
+    try:
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'owner_id must be a number'})
+
+    if kind not in ARCHIVE_TABLES:
+        return json_response(400, {'error': f'type must be one of: {", ".join(ARCHIVE_TABLES)}'})
+
+    try:
+        row_id = int(params.get('id') or '')
+    except ValueError:
+        return json_response(400, {'error': 'Invalid id'})
+
+    try:
+        conn, read_source = get_read_connection(owner_id, read_min_lsn(event))
+    except psycopg2.OperationalError as e:
+        print(f"[DEBUG] Database unavailable: {str(e).strip()}")
+        return json_response(503, {'error': 'Database unavailable'})
+    cur = conn.cursor()
+    try:
+        cur.execute(f'''
+            SELECT raw_data::text, raw_archive_segment, raw_archive_offset, raw_archive_length, raw_archive_md5
+            FROM {SCHEMA}.{ARCHIVE_TABLES[kind]}
+            WHERE id = %s AND owner_id = %s
+        ''', (row_id, owner_id))
+        row = cur.fetchone()
+    except Exception as e:
+        return json_response(500, {'error': str(e)})
+    finally:
+        cur.close()
+        conn.close()
+
+    if row is None:
+        return json_response(404, {'error': 'Not found'})
+
+    raw_text, segment, offset, length, expected_md5 = row
+    headers = {**JSON_HEADERS, 'X-Read-Source': read_source}
+    if raw_text is not None or segment is None:
+        return json_response(200, {
+            'success': True,
+            'type': kind,
+            'id': row_id,
+            'source': 'hot',
+            'raw_data': json.loads(raw_text) if raw_text is not None else None
+        }, headers)
+
+    started = time.perf_counter()
+    try:
+        raw_text = read_archived_payload(archive_store(), segment, offset, length, row_id, expected_md5)
+    except Exception as e:
+        print(f"[DEBUG] Archive read failed for {kind} {row_id} ({segment}): {str(e)}")
+        return json_response(502, {'error': f'Archive read failed: {str(e)}'})
+    print(f"[DEBUG] Archived {kind} {row_id} read from {segment} in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    # Архивный payload больше не меняется: карточку можно кэшировать в браузере
+    return json_response(200, {
+        'success': True,
+        'type': kind,
+        'id': row_id,
+        'source': 'archive',
+        'raw_data': json.loads(raw_text)
+    }, {**headers, 'Cache-Control': 'private, max-age=3600'})
@@ -1,9 +1,246 @@
 import json
 import os
+import re
+import time
+import functools
+import threading
 import psycopg2
-from typing import Dict, Any
+from contextlib import contextmanager
+from typing import Dict, Any, List, Tuple, Optional
+from datetime import date, datetime
 from decimal import Decimal
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Min-LSN',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT shard, status FROM t_p83864310_fintech_payment_reco.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+# Реплики для чтения по шардам: {"main": "postgres://replica...", "shard-2": "..."}.
+# Шард без реплики, отставшая или недоступная реплика — чтение с primary
+REPLICA_DSNS: Dict[str, str] = json.loads(os.environ.get('REPLICA_DSNS') or '{}')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_RETRY_SECONDS = 10
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+_replica_skip_until: Dict[str, float] = {}
+
+def read_min_lsn(event: Dict[str, Any]) -> Optional[str]:
+    '''
+    X-Min-LSN клиента — X-Write-LSN его последней записи: реплика должна догнать этот LSN
+    '''
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    value = (headers.get('x-min-lsn') or '').strip()
+    return value if LSN_PATTERN.match(value) else None
+
+def get_read_connection(owner_id: Any, min_lsn: Optional[str] = None) -> Tuple[Any, str]:
+    '''
+    Соединение для чтения: реплика шарда, если лаг не больше REPLICA_MAX_LAG_SECONDS и она проиграла
+    min_lsn (чтение своих записей), иначе primary. Отставшая или недоступная реплика пропускается
+    на REPLICA_RETRY_SECONDS, чтобы не платить за проверку в каждом запросе
+    Returns: (conn, 'replica' | 'primary')
+    '''
+    shard, _ = resolve_shard(owner_id)
+    replica_dsn = REPLICA_DSNS.get(shard)
+    if replica_dsn and _replica_skip_until.get(shard, 0) <= time.monotonic():
+        try:
+            conn = psycopg2.connect(replica_dsn)
+        except psycopg2.OperationalError as e:
+            print(f"[DEBUG] Replica {shard} unavailable: {str(e).strip()}")
+            _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+        else:
+            cur = conn.cursor()
+            # Реплика, проигравшая все полученное, не отстает, даже если на primary давно не было записей
+            cur.execute('''
+                SELECT
+                    CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                         ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END,
+                    %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+            ''', (min_lsn, min_lsn))
+            lag_seconds, caught_up = cur.fetchone()
+            cur.close()
+            if lag_seconds <= REPLICA_MAX_LAG_SECONDS and caught_up:
+                return conn, 'replica'
+            conn.close()
+            if lag_seconds > REPLICA_MAX_LAG_SECONDS:
+                print(f"[DEBUG] Replica {shard} lag {float(lag_seconds):.1f}s, reading from primary")
+                _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+    return psycopg2.connect(shard_dsn(shard)), 'primary'
+
+def json_default(value: Any) -> Any:
+    '''
+    Decimal и даты из psycopg2 сериализуются энкодером, без обхода строк вручную
+    '''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def dumps(payload: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload, default=json_default).decode('utf-8')
+    return json.dumps(payload, default=json_default)
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    with current_tracer().span('json'):
+        body = dumps(payload)
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+# Трассировка запроса: SQL, внешние HTTP и сериализация попадают в заголовок Server-Timing.
+# Включается TRACE_ENABLED=1 на время разбора задержек: заголовок раскрывает клиенту время запросов к БД,
+# поэтому по умолчанию обертка не ставится и спаны пишутся в пустой _NULL_TRACER.
+# Если задан TRACE_SINK_PATH, спаны дописываются туда JSON-строкой на запрос.
+# Одинаковый блок только в payments-list, receipts-list и ofd-fetch-receipts: их задержку дают SQL, сериализация
+# и OFD, которые трассировка раскладывает. Остальные функции Server-Timing не отдают — записи и фоновые задачи
+# печатают длительность прогона в [DEBUG], а копия блока в каждой функции утяжелила бы холодный старт ради
+# выключенного в проде переключателя
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED', '') == '1'
+TRACE_SINK_PATH = os.environ.get('TRACE_SINK_PATH')
+
+_trace_state = threading.local()
+
+class Tracer:
+    def __init__(self, function_name: str):
+        self.function_name = function_name
+        self.started = time.perf_counter()
+        self.spans: List[tuple] = []
+
+    @contextmanager
+    def span(self, kind: str, label: str = ''):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((kind, label, (time.perf_counter() - started) * 1000))
+
+    def server_timing(self) -> str:
+        totals: Dict[str, List[float]] = {}
+        for kind, _, duration in self.spans:
+            totals.setdefault(kind, []).append(duration)
+        parts = [f'{kind};dur={sum(durations):.1f};desc="{len(durations)}"' for kind, durations in totals.items()]
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(parts)
+
+    def flush(self, status_code: Any) -> None:
+        if not TRACE_SINK_PATH:
+            return
+        record = {
+            'ts': time.time(),
+            'function': self.function_name,
+            'status': status_code,
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'spans': [{'kind': kind, 'label': label, 'ms': round(duration, 2)} for kind, label, duration in self.spans]
+        }
+        try:
+            with open(TRACE_SINK_PATH, 'a', encoding='utf-8') as sink:
+                sink.write(json.dumps(record, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"[DEBUG] Trace sink write failed: {str(e)}")
+
+class _NullTracer(Tracer):
+    def __init__(self):
+        super().__init__('')
+
+    @contextmanager
+    def span(self, kind: str, label: str = ''):
+        yield
+
+_NULL_TRACER = _NullTracer()
+
+def current_tracer() -> Tracer:
+    return getattr(_trace_state, 'tracer', None) or _NULL_TRACER
+
+def traced(function_name: str):
+    '''
+    Обертка handler: создает Tracer на запрос и добавляет Server-Timing в ответ; без TRACE_ENABLED — handler как есть
+    '''
+    def decorator(fn):
+        if not TRACE_ENABLED:
+            return fn
+        @functools.wraps(fn)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            tracer = Tracer(function_name)
+            _trace_state.tracer = tracer
+            try:
+                response = fn(event, context)
+            finally:
+                _trace_state.tracer = None
+            response['headers'] = {
+                **(response.get('headers') or {}),
+                'Server-Timing': tracer.server_timing(),
+                'Timing-Allow-Origin': '*'
+            }
+            tracer.flush(response.get('statusCode'))
+            return response
+        return wrapper
+    return decorator
+
+class TracedCursor:
+    '''
+    Курсор psycopg2, который пишет каждый execute в спан db
+    '''
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=None):
+        label = ' '.join(str(query).split())[:80]
+        with current_tracer().span('db', label):
+            return self._cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def traced_connect(owner_id: Any, min_lsn: Optional[str]) -> Tuple[Any, str]:
+    with current_tracer().span('connect'):
+        return get_read_connection(owner_id, min_lsn)
+
+@traced('receipts-list')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Получение списка чеков из всех источников (касса + ОФД)
@@ -16,12 +253,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': CORS_PREFLIGHT_HEADERS,
             'body': '',
             'isBase64Encoded': False
         }
@@ -41,16 +273,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     source_filter = params.get('source')
     
     if not owner_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'owner_id required'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'owner_id required'})
     
-    dsn = os.environ['DATABASE_URL']
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
+    try:
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'owner_id must be a number'})
+    
+    try:
+        conn, read_source = traced_connect(owner_id, read_min_lsn(event))
+    except psycopg2.OperationalError as e:
+        print(f"[DEBUG] Database unavailable: {str(e).strip()}")
+        return json_response(503, {'error': 'Database unavailable'})
+    cur = TracedCursor(conn.cursor())
     
     query_parts = []
     
@@ -63,14 +298,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 ui.integration_name,
                 ofd.receipt_id as document_id,
                 ofd.operation_type,
-                ofd.total_sum,
-                ofd.cash_sum,
-                ofd.ecash_sum,
+                ofd.total_kopecks,
+                ofd.cash_kopecks,
+                ofd.ecash_kopecks,
+                -- Рубли для отображения: float8 из копеек, чтобы psycopg2 не создавал Decimal на каждую строку
+                ofd.total_kopecks::float8 / 100 AS total_sum,
+                ofd.cash_kopecks::float8 / 100 AS cash_sum,
+                ofd.ecash_kopecks::float8 / 100 AS ecash_sum,
                 ofd.doc_number,
                 ofd.doc_datetime as document_datetime,
                 ofd.fn_number,
                 ofd.created_at,
-                ofd.raw_data
+                ofd.raw_data,
+                -- raw_data старого чека в архиве (null): признаки для списка сохранены архиватором в колонках,
+                -- полный payload карточка загружает через raw-payload-fetch
+                ofd.raw_archive_segment IS NOT NULL AS raw_archived,
+                ofd.is_correction,
+                ofd.calculation_method
             FROM t_p83864310_fintech_payment_reco.ofd_receipts ofd
             JOIN t_p83864310_fintech_payment_reco.user_integrations ui ON ui.id = ofd.integration_id
             WHERE ofd.owner_id = %s
@@ -92,17 +336,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     rows = cur.fetchall()
     columns = [desc[0] for desc in cur.description] if cur.description else []
     
-    receipts = []
-    for row in rows:
-        receipt = {}
-        for col, val in zip(columns, row):
-            if isinstance(val, Decimal):
-                receipt[col] = float(val)
-            elif hasattr(val, 'isoformat'):
-                receipt[col] = val.isoformat()
-            else:
-                receipt[col] = val
-        receipts.append(receipt)
+    receipts = [dict(zip(columns, row)) for row in rows]
     
     cur.execute('''
         SELECT COUNT(*) FROM t_p83864310_fintech_payment_reco.ofd_receipts WHERE owner_id = %s
@@ -112,18 +346,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     conn.close()
     
-    return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({
-            'success': True,
-            'receipts': receipts,
-            'total': total_count,
-            'limit': limit,
-            'offset': offset
-        }),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
+    return json_response(200, {
+        'success': True,
+        'receipts': receipts,
+        'total': total_count,
+        'limit': limit,
+        'offset': offset
+    }, {**JSON_HEADERS, 'X-Read-Source': read_source})
\ No newline at end of file
@@ -0,0 +1,582 @@
+import json
+import os
+import time
+import bisect
+import psycopg2
+from typing import Dict, Any, List, Optional, Set, Tuple
+from datetime import datetime, timedelta
+
+SCHEMA = 't_p83864310_fintech_payment_reco'
+
+DEFAULT_PERIOD_DAYS = 7
+DEFAULT_WINDOW_MINUTES = 30
+MAX_WINDOW_MINUTES = 1440
+
+# Ограничения перебора: в окне берется не больше MAX_CANDIDATES ближайших по времени элементов,
+# в подмножестве не больше MAX_SUBSET_SIZE, на один поиск не больше SUBSET_SEARCH_BUDGET шагов.
+# Поэтому сверка остается почти линейной по числу платежей и чеков
+MAX_CANDIDATES = 12
+MAX_SUBSET_SIZE = 4
+SUBSET_SEARCH_BUDGET = 2000
+# Сумма расходится не больше чем на 5% (и не больше 500 ₽) — сопоставление amount_mismatch
+MISMATCH_TOLERANCE = 0.05
+MISMATCH_MAX_KOPECKS = 50000
+# Ключ pg_try_advisory_xact_lock(ключ, owner_id): одна сверка на владельца одновременно
+RECONCILIATION_LOCK_KEY = 4001
+
+# Платеж и чек одного направления: подтверждение — приход, возврат — возврат прихода
+DIRECTIONS = {
+    'income': ('CONFIRMED', 'Income'),
+    'refund': ('REFUNDED', 'RefundIncome')
+}
+
+BASE_CONFIDENCE = {
+    'one_to_one': 1.0,
+    'one_to_many': 0.85,
+    'many_to_one': 0.8,
+    'amount_mismatch': 0.6
+}
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+class ShardMovingError(Exception):
+    '''
+    Данные владельца переносятся между шардами (scripts/shard_rebalance.py), запись временно запрещена
+    '''
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute(f'SELECT shard, status FROM {SCHEMA}.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+def get_connection(owner_id: Any, write: bool = False):
+    '''
+    Соединение с шардом владельца; запись во время переноса — ShardMovingError
+    '''
+    shard, status = resolve_shard(owner_id)
+    if write and status == 'moving':
+        raise ShardMovingError(f'owner {owner_id} is being moved, retry later')
+    return psycopg2.connect(shard_dsn(shard))
+
+def write_lsn_headers(cur) -> Dict[str, str]:
+    '''
+    Заголовки ответа на запись: X-Write-LSN клиент возвращает в X-Min-LSN, чтобы читать свои записи с реплики
+    '''
+    cur.execute('SELECT pg_current_wal_lsn()')
+    return {**JSON_HEADERS, 'Access-Control-Expose-Headers': 'X-Write-LSN', 'X-Write-LSN': cur.fetchone()[0]}
+
+def confidence(match_type: str, size: int, delta_seconds: float, window_seconds: int, difference: int = 0,
+               amount: int = 0) -> float:
+    '''
+    Уверенность 0..1: база по типу, минус за каждый элемент сверх двух и за удаленность по времени
+    '''
+    score = BASE_CONFIDENCE[match_type] - 0.05 * max(0, size - 2)
+    score *= 1 - 0.5 * min(1.0, delta_seconds / window_seconds)
+    if difference and amount:
+        score *= 1 - min(1.0, abs(difference) / (amount * MISMATCH_TOLERANCE))
+    return round(max(score, 0.01), 3)
+
+class TimeIndex:
+    '''
+    Элементы, отсортированные по времени, с пометкой использованных; окно — через bisect
+    '''
+    def __init__(self, items: List[Dict[str, Any]]):
+        self.items = sorted(items, key=lambda item: item['at'])
+        self.times = [item['at'] for item in self.items]
+        self.used = set()
+
+    def window(self, at: datetime, window: timedelta, limit: int,
+               exclude: Set[int] = frozenset()) -> List[Dict[str, Any]]:
+        start = bisect.bisect_left(self.times, at - window)
+        end = bisect.bisect_right(self.times, at + window)
+        candidates = [item for item in self.items[start:end] if item['id'] not in self.used and item['id'] not in exclude]
+        candidates.sort(key=lambda item: abs((item['at'] - at).total_seconds()))
+        return candidates[:limit]
+
+    def unused(self) -> List[Dict[str, Any]]:
+        return [item for item in self.items if item['id'] not in self.used]
+
+def find_subset(target: int, candidates: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+    '''
+    Подмножество из 2..MAX_SUBSET_SIZE кандидатов с суммой ровно target, перебор с отсечениями
+    '''
+    ordered = sorted((c for c in candidates if 0 < c['kopecks'] < target), key=lambda c: -c['kopecks'])
+    suffix = [0] * (len(ordered) + 1)
+    for index in range(len(ordered) - 1, -1, -1):
+        suffix[index] = suffix[index + 1] + ordered[index]['kopecks']
+
+    steps = 0
+    chosen: List[Dict[str, Any]] = []
+
+    def search(start: int, remaining: int) -> bool:
+        nonlocal steps
+        if remaining == 0:
+            return len(chosen) >= 2
+        if len(chosen) >= MAX_SUBSET_SIZE:
+            return False
+        for index in range(start, len(ordered)):
+            steps += 1
+            if steps > SUBSET_SEARCH_BUDGET or suffix[index] < remaining:
+                return False
+            value = ordered[index]['kopecks']
+            if value > remaining:
+                continue
+            chosen.append(ordered[index])
+            if search(index + 1, remaining - value):
+                return True
+            chosen.pop()
+        return False
+
+    return list(chosen) if search(0, target) else None
+
+def build_match(direction: str, match_type: str, payments: List[Dict[str, Any]], receipts: List[Dict[str, Any]],
+                window_seconds: int) -> Dict[str, Any]:
+    payments_kopecks = sum(p['kopecks'] for p in payments)
+    receipts_kopecks = sum(r['kopecks'] for r in receipts)
+    delta = max(abs((p['at'] - r['at']).total_seconds()) for p in payments for r in receipts)
+    difference = receipts_kopecks - payments_kopecks
+    return {
+        'direction': direction,
+        'match_type': match_type,
+        'payments': payments,
+        'receipts': receipts,
+        'payments_kopecks': payments_kopecks,
+        'receipts_kopecks': receipts_kopecks,
+        'difference_kopecks': difference,
+        'time_delta_seconds': int(delta),
+        'confidence': confidence(match_type, len(payments) + len(receipts) - 1, delta, window_seconds,
+                                 difference, payments_kopecks)
+    }
+
+def reconcile(direction: str, payments: List[Dict[str, Any]], receipts: List[Dict[str, Any]],
+              window_seconds: int) -> List[Dict[str, Any]]:
+    '''
+    Сопоставление платежей и чеков одного направления по шагам:
+    разбиения (один платеж — несколько чеков, несколько платежей — один чек) для элементов без пары
+    той же суммы, 1:1 по точной сумме (хеш по копейкам), повтор разбиений для оставшихся,
+    затем 1:1 с расхождением суммы. На каждом шаге берутся только еще не сопоставленные элементы
+    '''
+    window = timedelta(seconds=window_seconds)
+    payment_index = TimeIndex(payments)
+    receipt_index = TimeIndex(receipts)
+    matches: List[Dict[str, Any]] = []
+
+    def take(match_type: str, matched_payments: List[Dict[str, Any]], matched_receipts: List[Dict[str, Any]]) -> None:
+        payment_index.used.update(p['id'] for p in matched_payments)
+        receipt_index.used.update(r['id'] for r in matched_receipts)
+        matches.append(build_match(direction, match_type, matched_payments, matched_receipts, window_seconds))
+
+    def by_amount(index: TimeIndex) -> Dict[int, TimeIndex]:
+        grouped: Dict[int, List[Dict[str, Any]]] = {}
+        for item in index.items:
+            grouped.setdefault(item['kopecks'], []).append(item)
+        result: Dict[int, TimeIndex] = {}
+        for kopecks, group in grouped.items():
+            result[kopecks] = TimeIndex(group)
+            result[kopecks].used = index.used
+        return result
+
+    receipts_by_amount = by_amount(receipt_index)
+    payments_by_amount = by_amount(payment_index)
+
+    def same_amount(item: Dict[str, Any], index_by_amount: Dict[int, TimeIndex], limit: int) -> List[Dict[str, Any]]:
+        group = index_by_amount.get(item['kopecks'])
+        return group.window(item['at'], window, limit) if group else []
+
+    # Пары 1:1 резервируются только после поиска разбиений: иначе ближайший чек той же суммы уходит в 1:1,
+    # хотя у платежа есть другой такой же чек, а без этого собирался платеж из нескольких чеков.
+    # Разбиения не берут только единственного кандидата 1:1 какого-то элемента
+    payment_candidates = {p['id']: same_amount(p, receipts_by_amount, MAX_CANDIDATES) for p in payment_index.items}
+    receipt_candidates = {r['id']: same_amount(r, payments_by_amount, MAX_CANDIDATES) for r in receipt_index.items}
+    pinned_receipts = {c[0]['id'] for c in payment_candidates.values() if len(c) == 1}
+    pinned_payments = {c[0]['id'] for c in receipt_candidates.values() if len(c) == 1}
+
+    for payment in payment_index.unused():
+        if not payment_candidates[payment['id']]:
+            candidates = receipt_index.window(payment['at'], window, MAX_CANDIDATES, pinned_receipts)
+            subset = find_subset(payment['kopecks'], candidates)
+            if subset:
+                take('one_to_many', [payment], subset)
+
+    for receipt in receipt_index.unused():
+        if not receipt_candidates[receipt['id']]:
+            candidates = payment_index.window(receipt['at'], window, MAX_CANDIDATES, pinned_payments)
+            subset = find_subset(receipt['kopecks'], candidates)
+            if subset:
+                take('many_to_one', subset, [receipt])
+
+    # Первыми платежи с меньшим числом свободных чеков той же суммы: у остальных есть запасные
+    pending = [
+        (sum(1 for r in payment_candidates[p['id']] if r['id'] not in receipt_index.used), p)
+        for p in payment_index.unused() if payment_candidates[p['id']]
+    ]
+    for _, payment in sorted(pending, key=lambda pair: pair[0]):
+        nearest = same_amount(payment, receipts_by_amount, 1)
+        if nearest:
+            take('one_to_one', [payment], nearest)
+
+    for payment in payment_index.unused():
+        subset = find_subset(payment['kopecks'], receipt_index.window(payment['at'], window, MAX_CANDIDATES))
+        if subset:
+            take('one_to_many', [payment], subset)
+
+    for receipt in receipt_index.unused():
+        subset = find_subset(receipt['kopecks'], payment_index.window(receipt['at'], window, MAX_CANDIDATES))
+        if subset:
+            take('many_to_one', subset, [receipt])
+
+    for payment in payment_index.unused():
+        tolerance = min(MISMATCH_MAX_KOPECKS, int(payment['kopecks'] * MISMATCH_TOLERANCE))
+        close = [
+            r for r in receipt_index.window(payment['at'], window, MAX_CANDIDATES)
+            if abs(r['kopecks'] - payment['kopecks']) <= tolerance
+        ]
+        if close:
+            best = min(close, key=lambda r: (abs(r['kopecks'] - payment['kopecks']), abs(r['at'] - payment['at'])))
+            take('amount_mismatch', [payment], [best])
+
+    return matches
+
+def load_items(cur, owner_id: int, period_from: datetime, period_to: datetime, window: timedelta) -> Dict[str, Tuple]:
+    '''
+    Несопоставленные платежи и чеки владельца за период (с запасом на окно) по направлениям
+    '''
+    cur.execute(f'''
+        SELECT wp.id, wp.status, wp.amount_kopecks, wp.created_at, wp.payment_id
+        FROM {SCHEMA}.webhook_payments wp
+        WHERE wp.owner_id = %s
+          AND wp.status IN ('CONFIRMED', 'REFUNDED')
+          AND wp.created_at BETWEEN %s AND %s
+          AND NOT EXISTS (
+              SELECT 1 FROM {SCHEMA}.reconciliation_match_items i
+              WHERE i.item_type = 'payment' AND i.item_id = wp.id
+          )
+    ''', (owner_id, period_from - window, period_to + window))
+    payment_rows = cur.fetchall()
+
+    # Безналичная часть чека (ecash_kopecks) — то, что прошло через эквайринг; наличные платежом не покрываются
+    cur.execute(f'''
+        SELECT r.id, r.operation_type, COALESCE(NULLIF(r.ecash_kopecks, 0), r.total_kopecks), r.doc_datetime, r.doc_number
+        FROM {SCHEMA}.ofd_receipts r
+        WHERE r.owner_id = %s
+          AND r.operation_type IN ('Income', 'RefundIncome')
+          AND r.doc_datetime BETWEEN %s AND %s
+          AND NOT EXISTS (
+              SELECT 1 FROM {SCHEMA}.reconciliation_match_items i
+              WHERE i.item_type = 'receipt' AND i.item_id = r.id
+          )
+    ''', (owner_id, period_from - window, period_to + window))
+    receipt_rows = cur.fetchall()
+
+    items = {}
+    for direction, (payment_status, operation_type) in DIRECTIONS.items():
+        payments = [
+            {'id': row[0], 'kopecks': row[2], 'at': row[3], 'ref': row[4]}
+            for row in payment_rows if row[1] == payment_status
+        ]
+        receipts = [
+            {'id': row[0], 'kopecks': row[2], 'at': row[3], 'ref': row[4]}
+            for row in receipt_rows if row[1] == operation_type
+        ]
+        items[direction] = (payments, receipts)
+    return items
+
+def save_matches(cur, owner_id: int, matches: List[Dict[str, Any]]) -> int:
+    '''
+    Запись сопоставлений; элемент, успевший попасть в другое сопоставление, откатывает только свое
+    '''
+    saved = 0
+    for match in matches:
+        cur.execute('SAVEPOINT match')
+        try:
+            cur.execute(f'''
+                INSERT INTO {SCHEMA}.reconciliation_matches (
+                    owner_id, direction, match_type, payments_kopecks, receipts_kopecks,
+                    difference_kopecks, time_delta_seconds, confidence
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            ''', (
+                owner_id, match['direction'], match['match_type'], match['payments_kopecks'],
+                match['receipts_kopecks'], match['difference_kopecks'], match['time_delta_seconds'],
+                match['confidence']
+            ))
+            match_id = cur.fetchone()[0]
+            items = [(match_id, 'payment', p['id'], p['kopecks']) for p in match['payments']] + \
+                    [(match_id, 'receipt', r['id'], r['kopecks']) for r in match['receipts']]
+            cur.executemany(f'''
+                INSERT INTO {SCHEMA}.reconciliation_match_items (match_id, item_type, item_id, kopecks)
+                VALUES (%s, %s, %s, %s)
+            ''', items)
+            cur.execute('RELEASE SAVEPOINT match')
+            match['id'] = match_id
+            saved += 1
+        except psycopg2.IntegrityError:
+            cur.execute('ROLLBACK TO SAVEPOINT match')
+    return saved
+
+# Отчет о расхождениях: пометка дней и пересчет порциями. Одинаковый блок в reconciliation-match
+# и ofd-fetch-receipts (общих модулей у функций нет, ofd_backfill вызывает копию ofd-fetch-receipts),
+# проверка копий — scripts/discrepancy_block_check.py.
+# За один вызов пересчитывается не больше стольких помеченных дней владельца (новые первыми)
+DISCREPANCY_REFRESH_MAX_DAYS = 62
+
+def mark_dirty_days(cur, owner_id: Any, days: Any) -> None:
+    cur.executemany(f'''
+        INSERT INTO {SCHEMA}.reconciliation_dirty_days (owner_id, day) VALUES (%s, %s)
+        ON CONFLICT (owner_id, day) DO NOTHING
+    ''', [(owner_id, day) for day in sorted(set(days))])
+
+def refresh_discrepancies(cur, owner_id: Any) -> int:
+    '''
+    Пересчет отчета о расхождениях за помеченные дни владельца: строки дня удаляются и собираются заново
+    из несопоставленных платежей и чеков и сопоставлений amount_mismatch. День, помеченный другой
+    транзакцией во время пересчета, остается помеченным до следующего вызова
+    Returns: число пересчитанных дней
+    '''
+    cur.execute(f'''
+        DELETE FROM {SCHEMA}.reconciliation_dirty_days
+        WHERE (owner_id, day) IN (
+            SELECT owner_id, day FROM {SCHEMA}.reconciliation_dirty_days
+            WHERE owner_id = %s
+            ORDER BY day DESC
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING day
+    ''', (owner_id, DISCREPANCY_REFRESH_MAX_DAYS))
+    days = [row[0] for row in cur.fetchall()]
+    if not days:
+        return 0
+
+    cur.execute(f'DELETE FROM {SCHEMA}.reconciliation_discrepancies WHERE owner_id = %s AND day = ANY(%s)', (owner_id, days))
+    cur.execute(f'DELETE FROM {SCHEMA}.reconciliation_discrepancy_days WHERE owner_id = %s AND day = ANY(%s)', (owner_id, days))
+
+    # Диапазоны по дням, а не created_at::date: так работают индексы (owner_id, created_at / doc_datetime)
+    cur.execute(f'''
+        WITH days AS (SELECT unnest(%(days)s::date[]) AS day)
+        INSERT INTO {SCHEMA}.reconciliation_discrepancies (
+            owner_id, integration_id, day, kind, direction, item_type, item_id, match_id,
+            reference, occurred_at, amount_kopecks, difference_kopecks
+        )
+        SELECT wp.owner_id, wp.integration_id, d.day, 'missing_receipt',
+               CASE wp.status WHEN 'REFUNDED' THEN 'refund' ELSE 'income' END,
+               'payment', wp.id, NULL, wp.payment_id, wp.created_at, wp.amount_kopecks, 0
+        FROM days d
+        JOIN {SCHEMA}.webhook_payments wp
+          ON wp.owner_id = %(owner_id)s AND wp.created_at >= d.day AND wp.created_at < d.day + 1
+        WHERE wp.status IN ('CONFIRMED', 'REFUNDED')
+          AND NOT EXISTS (
+              SELECT 1 FROM {SCHEMA}.reconciliation_match_items i
+              WHERE i.item_type = 'payment' AND i.item_id = wp.id
+          )
+        UNION ALL
+        SELECT r.owner_id, r.integration_id, d.day, 'missing_payment',
+               CASE r.operation_type WHEN 'RefundIncome' THEN 'refund' ELSE 'income' END,
+               'receipt', r.id, NULL, r.doc_number, r.doc_datetime,
+               COALESCE(NULLIF(r.ecash_kopecks, 0), r.total_kopecks), 0
+        FROM days d
+        JOIN {SCHEMA}.ofd_receipts r
+          ON r.owner_id = %(owner_id)s AND r.doc_datetime >= d.day AND r.doc_datetime < d.day + 1
+        WHERE r.operation_type IN ('Income', 'RefundIncome')
+          AND NOT EXISTS (
+              SELECT 1 FROM {SCHEMA}.reconciliation_match_items i
+              WHERE i.item_type = 'receipt' AND i.item_id = r.id
+          )
+        UNION ALL
+        SELECT m.owner_id, wp.integration_id, d.day, 'amount_mismatch', m.direction,
+               'payment', wp.id, m.id, wp.payment_id, wp.created_at, m.payments_kopecks, m.difference_kopecks
+        FROM days d
+        JOIN {SCHEMA}.webhook_payments wp
+          ON wp.owner_id = %(owner_id)s AND wp.created_at >= d.day AND wp.created_at < d.day + 1
+        JOIN {SCHEMA}.reconciliation_match_items i ON i.item_type = 'payment' AND i.item_id = wp.id
+        JOIN {SCHEMA}.reconciliation_matches m ON m.id = i.match_id AND m.match_type = 'amount_mismatch'
+    ''', {'owner_id': owner_id, 'days': days})
+
+    cur.execute(f'''
+        INSERT INTO {SCHEMA}.reconciliation_discrepancy_days (
+            owner_id, day, integration_id, kind, items, amount_kopecks, difference_kopecks
+        )
+        SELECT owner_id, day, integration_id, kind, COUNT(*), SUM(amount_kopecks), SUM(difference_kopecks)
+        FROM {SCHEMA}.reconciliation_discrepancies
+        WHERE owner_id = %s AND day = ANY(%s)
+        GROUP BY owner_id, day, integration_id, kind
+    ''', (owner_id, days))
+    return len(days)
+
+def serialize_match(match: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'id': match.get('id'),
+        'direction': match['direction'],
+        'match_type': match['match_type'],
+        'confidence': match['confidence'],
+        'payment_ids': [p['id'] for p in match['payments']],
+        'payment_refs': [p['ref'] for p in match['payments']],
+        'receipt_ids': [r['id'] for r in match['receipts']],
+        'receipt_refs': [r['ref'] for r in match['receipts']],
+        'payments_amount': match['payments_kopecks'] / 100,
+        'receipts_amount': match['receipts_kopecks'] / 100,
+        'difference': match['difference_kopecks'] / 100,
+        'payments_kopecks': match['payments_kopecks'],
+        'receipts_kopecks': match['receipts_kopecks'],
+        'difference_kopecks': match['difference_kopecks'],
+        'time_delta_seconds': match['time_delta_seconds']
+    }
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Сверка платежей с чеками OFD, включая частичные и составные случаи
+    POST {owner_id, date_from, date_to, window_minutes, dry_run}
+    Returns: сопоставления с уверенностью и сводка по типам
+    '''
+    method = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': CORS_PREFLIGHT_HEADERS,
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'POST':
+        return json_response(405, {'error': 'Method not allowed'})
+
+    body_str = event.get('body') or '{}'
+    body = json.loads(body_str)
+    owner_id = body.get('owner_id')
+
+    if not owner_id:
+        return json_response(400, {'error': 'owner_id required'})
+
+    try:
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'owner_id must be a number'})
+
+    now = datetime.now()
+    try:
+        period_from = datetime.fromisoformat(body['date_from']) if body.get('date_from') else now - timedelta(days=DEFAULT_PERIOD_DAYS)
+        period_to = datetime.fromisoformat(body['date_to']) if body.get('date_to') else now
+        window_minutes = max(1, min(int(body.get('window_minutes', DEFAULT_WINDOW_MINUTES)), MAX_WINDOW_MINUTES))
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'Invalid date_from, date_to or window_minutes'})
+    dry_run = bool(body.get('dry_run'))
+    window_seconds = window_minutes * 60
+
+    try:
+        conn = get_connection(owner_id, write=not dry_run)
+    except ShardMovingError as e:
+        return json_response(503, {'error': str(e)}, {**JSON_HEADERS, 'Retry-After': str(SHARD_CACHE_TTL_SECONDS)})
+    except psycopg2.OperationalError as e:
+        print(f"[DEBUG] Database unavailable: {str(e).strip()}")
+        return json_response(503, {'error': 'Database unavailable'})
+
+    cur = conn.cursor()
+
+    try:
+        # Параллельные прогоны одного владельца конкурировали бы за те же элементы
+        cur.execute('SELECT pg_try_advisory_xact_lock(%s, %s)', (RECONCILIATION_LOCK_KEY, int(owner_id)))
+        if not cur.fetchone()[0]:
+            return json_response(409, {'error': 'Reconciliation already running for this owner'})
+
+        items = load_items(cur, owner_id, period_from, period_to, timedelta(seconds=window_seconds))
+
+        matches: List[Dict[str, Any]] = []
+        unmatched = {}
+        for direction, (payments, receipts) in items.items():
+            direction_matches = reconcile(direction, payments, receipts, window_seconds)
+            matches.extend(direction_matches)
+            unmatched[direction] = {
+                'payments': len(payments) - sum(len(m['payments']) for m in direction_matches),
+                'receipts': len(receipts) - sum(len(m['receipts']) for m in direction_matches)
+            }
+
+        saved = 0
+        refreshed_days = 0
+        headers = JSON_HEADERS
+        if dry_run:
+            conn.rollback()
+        else:
+            saved = save_matches(cur, owner_id, matches)
+            mark_dirty_days(cur, owner_id, [
+                item['at'].date() for m in matches if m.get('id') for item in m['payments'] + m['receipts']
+            ])
+            conn.commit()
+            try:
+                refreshed_days = refresh_discrepancies(cur, owner_id)
+                conn.commit()
+            except psycopg2.Error as e:
+                # Сверка уже сохранена, дни остаются помеченными до следующего пересчета
+                conn.rollback()
+                print(f"[DEBUG] Discrepancy refresh failed for owner={owner_id}: {str(e)}")
+            headers = write_lsn_headers(cur)
+
+        summary: Dict[str, Dict[str, Any]] = {}
+        for match in matches:
+            entry = summary.setdefault(match['match_type'], {'count': 0, 'avg_confidence': 0.0})
+            entry['count'] += 1
+            entry['avg_confidence'] += match['confidence']
+        for entry in summary.values():
+            entry['avg_confidence'] = round(entry['avg_confidence'] / entry['count'], 3)
+
+        print(f"[DEBUG] Reconciliation owner={owner_id}: matches={len(matches)}, saved={saved}, refreshed_days={refreshed_days}, unmatched={unmatched}")
+
+        return json_response(200, {
+            'success': True,
+            'dry_run': dry_run,
+            'period': {'from': period_from.isoformat(), 'to': period_to.isoformat(), 'window_minutes': window_minutes},
+            'saved': saved,
+            'refreshed_days': refreshed_days,
+            'summary': summary,
+            'unmatched': unmatched,
+            'matches': [serialize_match(m) for m in matches]
+        }, headers)
+
+    except Exception as e:
+        conn.rollback()
+        return json_response(500, {'error': str(e)})
+    finally:
+        cur.close()
+        conn.close()
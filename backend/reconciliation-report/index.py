@@ -0,0 +1,304 @@
+import json
+import os
+import re
+import time
+import psycopg2
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Any, List, Tuple, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Min-LSN',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+SCHEMA = 't_p83864310_fintech_payment_reco'
+
+DEFAULT_PERIOD_DAYS = 31
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+KINDS = ('missing_receipt', 'missing_payment', 'amount_mismatch')
+# Курсор страницы — день и id последней строки: "2024-05-01:12345"
+CURSOR_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2}):(\d+)$')
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute(f'SELECT shard, status FROM {SCHEMA}.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+# Реплики для чтения по шардам: {"main": "postgres://replica...", "shard-2": "..."}.
+# Шард без реплики, отставшая или недоступная реплика — чтение с primary
+REPLICA_DSNS: Dict[str, str] = json.loads(os.environ.get('REPLICA_DSNS') or '{}')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_RETRY_SECONDS = 10
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+_replica_skip_until: Dict[str, float] = {}
+
+def read_min_lsn(event: Dict[str, Any]) -> Optional[str]:
+    '''
+    X-Min-LSN клиента — X-Write-LSN его последней записи: реплика должна догнать этот LSN
+    '''
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    value = (headers.get('x-min-lsn') or '').strip()
+    return value if LSN_PATTERN.match(value) else None
+
+def get_read_connection(owner_id: Any, min_lsn: Optional[str] = None) -> Tuple[Any, str]:
+    '''
+    Соединение для чтения: реплика шарда, если лаг не больше REPLICA_MAX_LAG_SECONDS и она проиграла
+    min_lsn (чтение своих записей), иначе primary. Отставшая или недоступная реплика пропускается
+    на REPLICA_RETRY_SECONDS, чтобы не платить за проверку в каждом запросе
+    Returns: (conn, 'replica' | 'primary')
+    '''
+    shard, _ = resolve_shard(owner_id)
+    replica_dsn = REPLICA_DSNS.get(shard)
+    if replica_dsn and _replica_skip_until.get(shard, 0) <= time.monotonic():
+        try:
+            conn = psycopg2.connect(replica_dsn)
+        except psycopg2.OperationalError as e:
+            print(f"[DEBUG] Replica {shard} unavailable: {str(e).strip()}")
+            _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+        else:
+            cur = conn.cursor()
+            # Реплика, проигравшая все полученное, не отстает, даже если на primary давно не было записей
+            cur.execute('''
+                SELECT
+                    CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                         ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END,
+                    %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+            ''', (min_lsn, min_lsn))
+            lag_seconds, caught_up = cur.fetchone()
+            cur.close()
+            if lag_seconds <= REPLICA_MAX_LAG_SECONDS and caught_up:
+                return conn, 'replica'
+            conn.close()
+            if lag_seconds > REPLICA_MAX_LAG_SECONDS:
+                print(f"[DEBUG] Replica {shard} lag {float(lag_seconds):.1f}s, reading from primary")
+                _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+    return psycopg2.connect(shard_dsn(shard)), 'primary'
+
+def json_default(value: Any) -> Any:
+    '''
+    Decimal и даты из psycopg2 сериализуются энкодером, без обхода строк вручную
+    '''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def dumps(payload: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload, default=json_default).decode('utf-8')
+    return json.dumps(payload, default=json_default)
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': dumps(payload),
+        'isBase64Encoded': False
+    }
+
+def fetch_summary(cur, owner_id: str, date_from: date, date_to: date, integration_id: Optional[int]) -> Dict[str, Any]:
+    '''
+    Итоги за период из reconciliation_discrepancy_days: по типам и по интеграциям
+    '''
+    query = f'''
+        SELECT d.integration_id, ui.integration_name, d.kind,
+               SUM(d.items), SUM(d.amount_kopecks), SUM(d.difference_kopecks)
+        FROM {SCHEMA}.reconciliation_discrepancy_days d
+        LEFT JOIN {SCHEMA}.user_integrations ui ON ui.id = d.integration_id
+        WHERE d.owner_id = %s AND d.day BETWEEN %s AND %s
+    '''
+    params_list: List[Any] = [owner_id, date_from, date_to]
+    if integration_id is not None:
+        query += ' AND d.integration_id = %s'
+        params_list.append(integration_id)
+    query += ' GROUP BY d.integration_id, ui.integration_name, d.kind ORDER BY d.integration_id, d.kind'
+    cur.execute(query, params_list)
+
+    totals = {kind: {'items': 0, 'amount': 0.0, 'difference': 0.0} for kind in KINDS}
+    integrations: Dict[int, Dict[str, Any]] = {}
+    for integration, name, kind, items, amount_kopecks, difference_kopecks in cur.fetchall():
+        totals[kind]['items'] += int(items)
+        totals[kind]['amount'] = round(totals[kind]['amount'] + int(amount_kopecks) / 100, 2)
+        totals[kind]['difference'] = round(totals[kind]['difference'] + int(difference_kopecks) / 100, 2)
+        entry = integrations.setdefault(integration, {'integration_id': integration, 'integration_name': name, 'kinds': {}})
+        entry['kinds'][kind] = {
+            'items': int(items),
+            'amount': int(amount_kopecks) / 100,
+            'difference': int(difference_kopecks) / 100
+        }
+    return {'totals': totals, 'integrations': list(integrations.values())}
+
+def fetch_page(cur, owner_id: str, date_from: date, date_to: date, kind: Optional[str], integration_id: Optional[int],
+               after: Optional[Tuple[date, int]], limit: int) -> List[Dict[str, Any]]:
+    '''
+    Страница расхождений от новых к старым: keyset по (day, id), без OFFSET — любая страница
+    читает только свои limit строк индекса
+    '''
+    query = f'''
+        SELECT d.id, d.day, d.kind, d.direction, d.integration_id, ui.integration_name, d.item_type, d.item_id,
+               d.match_id, d.reference, d.occurred_at, d.amount_kopecks, d.difference_kopecks
+        FROM {SCHEMA}.reconciliation_discrepancies d
+        LEFT JOIN {SCHEMA}.user_integrations ui ON ui.id = d.integration_id
+        WHERE d.owner_id = %s AND d.day BETWEEN %s AND %s
+    '''
+    params_list: List[Any] = [owner_id, date_from, date_to]
+    if kind:
+        query += ' AND d.kind = %s'
+        params_list.append(kind)
+    if integration_id is not None:
+        query += ' AND d.integration_id = %s'
+        params_list.append(integration_id)
+    if after:
+        query += ' AND (d.day, d.id) < (%s, %s)'
+        params_list.extend(after)
+    query += ' ORDER BY d.day DESC, d.id DESC LIMIT %s'
+    params_list.append(limit)
+    cur.execute(query, params_list)
+
+    return [{
+        'id': row[0],
+        'day': row[1],
+        'kind': row[2],
+        'direction': row[3],
+        'integration_id': row[4],
+        'integration_name': row[5],
+        'item_type': row[6],
+        'item_id': row[7],
+        'match_id': row[8],
+        'reference': row[9],
+        'occurred_at': row[10],
+        'amount': row[11] / 100,
+        'difference': row[12] / 100
+    } for row in cur.fetchall()]
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Отчет о расхождениях сверки: платежи без чека, чеки без платежа, расхождения суммы по дням и интеграциям
+    GET /reconciliation-report?owner_id=123&date_from=2024-05-01&date_to=2024-05-31&kind=missing_receipt&integration_id=456&limit=100
+    GET ...&cursor=2024-05-20:789 — следующая страница
+    Returns: summary за период, страница discrepancies, next_cursor и pending_days (дни, ожидающие пересчета)
+    '''
+    method: str = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': CORS_PREFLIGHT_HEADERS,
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'GET':
+        return json_response(405, {'error': 'Method not allowed'})
+
+    params = event.get('queryStringParameters', {}) or {}
+    owner_id = params.get('owner_id')
+    kind = params.get('kind') or None
+
+    if not owner_id:
+        return json_response(400, {'error': 'owner_id required'})
+
+    try:
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'owner_id must be a number'})
+
+    if kind and kind not in KINDS:
+        return json_response(400, {'error': f'kind must be one of: {", ".join(KINDS)}'})
+
+    try:
+        today = date.today()
+        date_to = date.fromisoformat(params['date_to']) if params.get('date_to') else today
+        date_from = date.fromisoformat(params['date_from']) if params.get('date_from') else date_to - timedelta(days=DEFAULT_PERIOD_DAYS - 1)
+        integration_id = int(params['integration_id']) if params.get('integration_id') else None
+        limit = max(1, min(int(params.get('limit', DEFAULT_LIMIT)), MAX_LIMIT))
+    except ValueError:
+        return json_response(400, {'error': 'Invalid date_from, date_to, integration_id or limit'})
+
+    after = None
+    if params.get('cursor'):
+        cursor_match = CURSOR_PATTERN.match(params['cursor'])
+        try:
+            after = (date.fromisoformat(cursor_match.group(1)), int(cursor_match.group(2))) if cursor_match else None
+        except ValueError:
+            after = None
+        if after is None:
+            return json_response(400, {'error': 'Invalid cursor'})
+
+    try:
+        conn, read_source = get_read_connection(owner_id, read_min_lsn(event))
+    except psycopg2.OperationalError as e:
+        print(f"[DEBUG] Database unavailable: {str(e).strip()}")
+        return json_response(503, {'error': 'Database unavailable'})
+    cur = conn.cursor()
+
+    try:
+        # Первая страница несет сводку; следующие страницы ее не пересчитывают
+        summary = None if after else fetch_summary(cur, owner_id, date_from, date_to, integration_id)
+        discrepancies = fetch_page(cur, owner_id, date_from, date_to, kind, integration_id, after, limit)
+
+        cur.execute(f'''
+            SELECT COUNT(*) FROM {SCHEMA}.reconciliation_dirty_days
+            WHERE owner_id = %s AND day BETWEEN %s AND %s
+        ''', (owner_id, date_from, date_to))
+        pending_days = cur.fetchone()[0]
+
+        next_cursor = None
+        if len(discrepancies) == limit:
+            last = discrepancies[-1]
+            next_cursor = f"{last['day'].isoformat()}:{last['id']}"
+
+        return json_response(200, {
+            'success': True,
+            'period': {'from': date_from, 'to': date_to},
+            'summary': summary,
+            'discrepancies': discrepancies,
+            'next_cursor': next_cursor,
+            'pending_days': pending_days
+        }, {**JSON_HEADERS, 'X-Read-Source': read_source})
+
+    except Exception as e:
+        return json_response(500, {'error': str(e)})
+    finally:
+        cur.close()
+        conn.close()
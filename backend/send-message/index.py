@@ -1,63 +1,360 @@
 import json
 import os
-import urllib.request
-import urllib.error
-from typing import Dict, Any
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+DEFAULT_MESSENGER_API_URL = 'https://functions.poehali.dev/ace36e55-b169-41f2-9d2b-546f92221bb7'
+
+# Ограничения шлюза мессенджеров: сообщений в секунду на провайдера
+PROVIDER_RATE_LIMITS = {
+    'ek_max': 20,
+    'ek_wa': 10,
+    'ek_tg': 25
+}
+
+BULK_MAX_MESSAGES = 500
+BULK_CONCURRENCY = 8
+BULK_MAX_ATTEMPTS = 3
+# Retry-After шлюза соблюдается, но пауза не длиннее этого предела: пакет должен уложиться в таймаут функции
+RETRY_AFTER_MAX_SECONDS = 10.0
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+# Исходящий HTTP: постоянные соединения по хостам, повторы с джиттером для запросов с Idempotency-Key.
+# Повторы, Retry-After и пул — как у клиента ofd-fetch-receipts, без gzip, token bucket на хост и метрик:
+# шлюз отвечает коротким JSON, лимиты провайдеров держит send_bulk. Проверка — scripts/http_client_check.py.
+# http.client/ssl импортируются при первом запросе (cold_start_budget.json)
+class HttpError(Exception):
+    '''
+    Ответ со статусом >= 400 после всех повторов
+    '''
+    def __init__(self, status: int, body: bytes, headers: Dict[str, str], attempts: int = 1):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+        self.body = body
+        self.headers = headers
+        self.attempts = attempts
+
+class HttpResponse:
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes, attempts: int):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.attempts = attempts
+
+class TokenBucket:
+    '''
+    rate токенов в секунду, не больше burst в запасе; acquire ждет, пока появится токен
+    '''
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+class HttpClient:
+    '''
+    Клиент с пулом keep-alive соединений на (scheme, host, port). Соединение, закрытое сервером
+    между вызовами, переоткрывается без траты попытки. Повторяются статусы retry_statuses и сетевые
+    ошибки, только для retry_methods и запросов с заголовком Idempotency-Key (повтор такого запроса
+    получатель не выполнит второй раз); пауза — full jitter от backoff_base * 2^n, Retry-After сервера
+    важнее. Число сделанных попыток — в attempts ответа или исключения
+    '''
+    def __init__(self, timeout: float = 30.0, connect_timeout: float = 5.0, max_attempts: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, pool_size: int = 4,
+                 retry_statuses: Tuple[int, ...] = (429, 500, 502, 503, 504),
+                 retry_methods: Tuple[str, ...] = ('GET', 'HEAD')):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.retry_statuses = retry_statuses
+        self.retry_methods = retry_methods
+        self._pools: Dict[Tuple[str, str, int], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def _checkout(self, key: Tuple[str, str, int]) -> Tuple[Any, bool]:
+        import http.client
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool:
+                return pool.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            import ssl
+            return http.client.HTTPSConnection(host, port, timeout=self.connect_timeout,
+                                               context=ssl.create_default_context()), False
+        return http.client.HTTPConnection(host, port, timeout=self.connect_timeout), False
+
+    def _checkin(self, key: Tuple[str, str, int], conn: Any) -> None:
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def _backoff(self, attempt: int, retry_after: Optional[str]) -> float:
+        import random
+        if retry_after and retry_after.strip().isdigit():
+            return min(float(retry_after.strip()), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def _send(self, key: Tuple[str, str, int], method: str, target: str, body: Optional[bytes],
+              headers: Dict[str, str], timeout: float) -> Tuple[int, Dict[str, str], bytes]:
+        import http.client
+        for fresh_retry in (False, True):
+            conn, reused = self._checkout(key)
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(timeout)
+                conn.request(method, target, body=body, headers=headers)
+                response = conn.getresponse()
+                raw = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # Сервер закрыл простаивавшее соединение: повтор на новом, попытка не тратится
+                if reused and not fresh_retry:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(key, conn)
+            return response.status, {name.lower(): value for name, value in response.getheaders()}, raw
+        raise ConnectionError('connection closed by server')
+
+    def request(self, method: str, url: str, body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None,
+                timeout: Optional[float] = None) -> HttpResponse:
+        import http.client
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        key = (scheme, parts.hostname or '', parts.port or (443 if scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        request_headers = {'Connection': 'keep-alive', **(headers or {})}
+        retryable = method.upper() in self.retry_methods or 'Idempotency-Key' in request_headers
+
+        attempt = 0
+        while True:
+            attempt += 1
+            retry_after = None
+            try:
+                status, response_headers, raw = self._send(key, method, target, body, request_headers,
+                                                            timeout or self.timeout)
+            except (OSError, http.client.HTTPException) as e:
+                error: Exception = e
+            else:
+                if status < 400:
+                    return HttpResponse(status, response_headers, raw, attempt)
+                error = HttpError(status, raw, response_headers, attempt)
+                retry_after = response_headers.get('retry-after')
+                if status not in self.retry_statuses:
+                    raise error
+
+            if not retryable or attempt >= self.max_attempts:
+                error.attempts = attempt
+                raise error
+            time.sleep(self._backoff(attempt, retry_after))
+
+# Шлюз мессенджеров: один хост, лимиты у него на провайдера, поэтому token bucket на хост не нужен —
+# send_bulk держит свой TokenBucket на каждого провайдера. POST повторяется на 429/5xx/сетевых ошибках
+# только с Idempotency-Key (сообщения notifications-dispatch): без ключа шлюз мог доставить сообщение
+# и не успеть ответить, повтор отправил бы его клиенту второй раз
+MESSENGER_HTTP = HttpClient(
+    timeout=10.0,
+    connect_timeout=5.0,
+    max_attempts=BULK_MAX_ATTEMPTS,
+    backoff_base=0.2,
+    backoff_max=RETRY_AFTER_MAX_SECONDS,
+    pool_size=BULK_CONCURRENCY,
+    retry_methods=()
+)
+
+def send_to_gateway(api_url: str, api_key: str, payload: Dict[str, Any],
+                    idempotency_key: Optional[str] = None) -> HttpResponse:
+    '''
+    POST в шлюз мессенджеров через MESSENGER_HTTP.
+    idempotency_key уходит заголовком Idempotency-Key: только такой запрос повторяется, повтор с тем же ключом
+    шлюз не доставляет второй раз
+    '''
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Api-Key': api_key
+    }
+    if idempotency_key:
+        headers['Idempotency-Key'] = idempotency_key
+    return MESSENGER_HTTP.request('POST', api_url, body=json.dumps(payload).encode('utf-8'), headers=headers)
+
+def gateway_message_id(response: HttpResponse) -> str:
+    '''
+    id сообщения из ответа шлюза; сообщение уже принято, поэтому нечитаемый ответ — 'unknown', а не ошибка
+    '''
+    try:
+        response_data = json.loads(response.body.decode('utf-8'))
+    except ValueError:
+        print(f'[DEBUG] Messenger API returned undecodable body: {response.body[:200]!r}')
+        return 'unknown'
+    return str(response_data.get('id', 'unknown')) if isinstance(response_data, dict) else 'unknown'
+
+def send_with_retries(api_url: str, api_key: str, index: int, item: Dict[str, Any],
+                      buckets: Dict[str, TokenBucket]) -> Dict[str, Any]:
+    '''
+    Отправка одного сообщения пакета с учетом лимита провайдера; сообщения с idempotency_key MESSENGER_HTTP
+    повторяет на 429/5xx/сетевых ошибках (Retry-After шлюза важнее экспоненциальной паузы)
+    '''
+    if not isinstance(item, dict):
+        return {'index': index, 'success': False, 'attempts': 0, 'error': 'Message must be an object'}
+
+    provider = item.get('provider')
+    recipient = item.get('recipient')
+    message = item.get('message')
+    result = {'index': index, 'provider': provider, 'recipient': recipient}
+
+    if not all([provider, recipient, message]):
+        result.update({'success': False, 'attempts': 0, 'error': 'Missing required fields: provider, recipient, message'})
+        return result
+
+    if provider not in buckets:
+        result.update({'success': False, 'attempts': 0, 'error': f'Unknown provider: {provider}'})
+        return result
+
+    payload = {'provider': provider, 'recipient': recipient, 'message': message}
+    buckets[provider].acquire()
+    try:
+        response = send_to_gateway(api_url, api_key, payload, idempotency_key=item.get('idempotency_key'))
+    except HttpError as e:
+        result.update({'success': False, 'attempts': e.attempts, 'error': f'Messenger API error: {e.status}'})
+        return result
+    except Exception as e:
+        result.update({'success': False, 'attempts': getattr(e, 'attempts', 1), 'error': str(e)})
+        return result
+    result.update({'success': True, 'attempts': response.attempts, 'message_id': gateway_message_id(response)})
+    return result
+
+def send_bulk(api_url: str, api_key: str, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+    Параллельная отправка пакета сообщений, результаты в порядке входного списка.
+    Исключение при отправке одного сообщения становится его ошибкой, а не ошибкой пакета
+    '''
+    buckets = {provider: TokenBucket(rate, rate) for provider, rate in PROVIDER_RATE_LIMITS.items()}
+
+    with ThreadPoolExecutor(max_workers=min(BULK_CONCURRENCY, max(1, len(items)))) as executor:
+        futures = [
+            executor.submit(send_with_retries, api_url, api_key, index, item, buckets)
+            for index, item in enumerate(items)
+        ]
+        results = []
+        for index, future in enumerate(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({'index': index, 'success': False, 'attempts': 0, 'error': str(e)})
+        return results
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Отправка сообщений в мессенджеры через API
     Принимает: provider (ek_max/ek_wa/ek_tg), recipient (номер телефона), message (текст)
     Возвращает: результат отправки с ID сообщения
+    Пакетный режим: messages [{provider, recipient, message, idempotency_key?}] или provider + message + recipients [...]
+    Возвращает: итог по каждому сообщению (частичные ошибки не прерывают пакет)
     '''
     method: str = event.get('httpMethod', 'POST')
     
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': CORS_PREFLIGHT_HEADERS,
             'body': '',
             'isBase64Encoded': False
         }
     
     if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return json_response(405, {'error': 'Method not allowed'})
     
     api_key = os.environ.get('MESSENGER_API_KEY', '')
     if not api_key:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'MESSENGER_API_KEY not configured'}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'error': 'MESSENGER_API_KEY not configured'})
+    
+    api_url = os.environ.get('MESSENGER_API_URL', DEFAULT_MESSENGER_API_URL)
     
     try:
         body_data = json.loads(event.get('body', '{}'))
         
+        if 'messages' in body_data or 'recipients' in body_data:
+            if 'messages' in body_data:
+                items = body_data.get('messages') or []
+            elif not isinstance(body_data.get('recipients'), list):
+                return json_response(400, {'error': 'recipients must be a list'})
+            else:
+                items = [
+                    {'provider': body_data.get('provider'), 'recipient': recipient, 'message': body_data.get('message')}
+                    for recipient in body_data.get('recipients') or []
+                ]
+            
+            if not isinstance(items, list) or not items:
+                return json_response(400, {'error': 'messages must be a non-empty list'})
+            
+            if len(items) > BULK_MAX_MESSAGES:
+                return json_response(400, {'error': f'Too many messages: max {BULK_MAX_MESSAGES} per request'})
+            
+            started_at = time.monotonic()
+            results = send_bulk(api_url, api_key, items)
+            sent = sum(1 for r in results if r['success'])
+            
+            print(f"[DEBUG] Bulk send: total={len(results)}, sent={sent}, duration_ms={int((time.monotonic() - started_at) * 1000)}")
+            
+            return json_response(200, {
+                'success': sent == len(results),
+                'total': len(results),
+                'sent': sent,
+                'failed': len(results) - sent,
+                'results': results
+            })
+        
         provider = body_data.get('provider')
         recipient = body_data.get('recipient')
         message = body_data.get('message')
         
         if not all([provider, recipient, message]):
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Missing required fields: provider, recipient, message'}),
-                'isBase64Encoded': False
-            }
-        
-        api_url = 'https://functions.poehali.dev/ace36e55-b169-41f2-9d2b-546f92221bb7'
+            return json_response(400, {'error': 'Missing required fields: provider, recipient, message'})
         
         payload = {
             'provider': provider,
@@ -65,46 +362,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'message': message
         }
         
-        req = urllib.request.Request(
-            api_url,
-            data=json.dumps(payload).encode('utf-8'),
-            headers={
-                'Content-Type': 'application/json',
-                'X-Api-Key': api_key
-            },
-            method='POST'
-        )
+        response = send_to_gateway(api_url, api_key, payload, idempotency_key=body_data.get('idempotency_key'))
         
-        with urllib.request.urlopen(req, timeout=10) as response:
-            response_data = json.loads(response.read().decode('utf-8'))
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'message_id': response_data.get('id', 'unknown'),
-                    'provider': provider,
-                    'recipient': recipient
-                }),
-                'isBase64Encoded': False
-            }
-            
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        return {
-            'statusCode': e.code,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'error': f'Messenger API error: {e.code}',
-                'details': error_body
-            }),
-            'isBase64Encoded': False
-        }
+        return json_response(200, {
+            'success': True,
+            'message_id': gateway_message_id(response),
+            'provider': provider,
+            'recipient': recipient
+        })
+        
+    except HttpError as e:
+        return json_response(e.status, {
+            'error': f'Messenger API error: {e.status}',
+            'details': e.body.decode('utf-8', errors='replace')
+        })
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'error': str(e)})
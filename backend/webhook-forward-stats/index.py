@@ -0,0 +1,246 @@
+import json
+import os
+import time
+import psycopg2
+from typing import Dict, Any, List, Tuple
+
+# Верхние границы корзин гистограммы (мс), должны совпадать с webhook-receive и миграцией V0010
+FORWARD_LATENCY_BUCKETS_MS = [25, 50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000]
+
+WINDOW_MINUTES = {
+    '5m': 5,
+    '15m': 15,
+    '1h': 60,
+    '6h': 360,
+    '24h': 1440,
+    '7d': 10080
+}
+
+DEFAULT_WINDOWS = '15m,1h,24h'
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT shard, status FROM t_p83864310_fintech_payment_reco.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+def get_connection(owner_id: Any):
+    '''
+    Соединение с primary шарда владельца; функция только читает, поэтому перенос владельца ей не мешает
+    '''
+    shard, _ = resolve_shard(owner_id)
+    return psycopg2.connect(shard_dsn(shard))
+
+def histogram_percentile(hist: List[int], total: int, quantile: float, max_ms: int) -> int:
+    '''
+    Перцентиль по гистограмме с линейной интерполяцией внутри корзины
+    '''
+    if total <= 0:
+        return 0
+
+    rank = quantile * total
+    cumulative = 0
+    lower = 0
+
+    for index, count in enumerate(hist):
+        upper = FORWARD_LATENCY_BUCKETS_MS[index] if index < len(FORWARD_LATENCY_BUCKETS_MS) else max_ms
+        upper = max(min(upper, max_ms), lower)
+
+        if count and cumulative + count >= rank:
+            fraction = (rank - cumulative) / count
+            return int(round(lower + (upper - lower) * fraction))
+
+        cumulative += count
+        lower = upper
+
+    return max_ms
+
+def summarize_window(buckets: List[Dict[str, Any]], minutes: int) -> Dict[str, Any]:
+    '''
+    Сводка по окну: количество, доля ошибок, пропускная способность и перцентили
+    '''
+    requests = 0
+    errors = 0
+    latency_sum = 0
+    max_ms = 0
+    hist = [0] * (len(FORWARD_LATENCY_BUCKETS_MS) + 1)
+
+    for bucket in buckets:
+        requests += bucket['request_count']
+        errors += bucket['error_count']
+        latency_sum += bucket['latency_sum_ms']
+        max_ms = max(max_ms, bucket['latency_max_ms'])
+        for index, count in enumerate(bucket['latency_hist']):
+            hist[index] += count
+
+    return {
+        'requests': requests,
+        'errors': errors,
+        'error_rate': round(errors / requests, 4) if requests else 0.0,
+        'throughput_per_min': round(requests / minutes, 3),
+        'avg_ms': int(round(latency_sum / requests)) if requests else 0,
+        'p50_ms': histogram_percentile(hist, requests, 0.50, max_ms),
+        'p95_ms': histogram_percentile(hist, requests, 0.95, max_ms),
+        'p99_ms': histogram_percentile(hist, requests, 0.99, max_ms),
+        'max_ms': max_ms
+    }
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Здоровье переадресации вебхуков по каждому forward_url за скользящие окна
+    GET /webhook-forward-stats?owner_id=123&integration_id=456&windows=15m,1h,24h
+    Считается по инкрементальным гистограммам webhook_forward_stats без сканирования логов.
+    Корзины старше FORWARD_STATS_RETENTION_DAYS удаляет integrations-purge
+    '''
+    method: str = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': CORS_PREFLIGHT_HEADERS,
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'GET':
+        return json_response(405, {'error': 'Method not allowed'})
+
+    params = event.get('queryStringParameters', {}) or {}
+    owner_id = params.get('owner_id')
+    integration_id = params.get('integration_id')
+    windows = [w.strip() for w in params.get('windows', DEFAULT_WINDOWS).split(',') if w.strip()]
+
+    if not owner_id:
+        return json_response(400, {'error': 'owner_id required'})
+
+    try:
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'owner_id must be a number'})
+
+    unknown_windows = [w for w in windows if w not in WINDOW_MINUTES]
+    if not windows or unknown_windows:
+        return json_response(400, {'error': f'Unsupported windows: {unknown_windows}', 'supported': list(WINDOW_MINUTES.keys())})
+
+    max_minutes = max(WINDOW_MINUTES[w] for w in windows)
+
+    try:
+        conn = get_connection(owner_id)
+    except psycopg2.OperationalError as e:
+        print(f"[DEBUG] Database unavailable: {str(e).strip()}")
+        return json_response(503, {'error': 'Database unavailable'})
+    cur = conn.cursor()
+
+    try:
+        query = '''
+            SELECT
+                s.integration_id,
+                ui.integration_name,
+                s.forward_url,
+                EXTRACT(EPOCH FROM (NOW() - s.bucket_start)) / 60 AS age_minutes,
+                s.request_count,
+                s.error_count,
+                s.latency_sum_ms,
+                s.latency_max_ms,
+                s.latency_hist
+            FROM t_p83864310_fintech_payment_reco.webhook_forward_stats s
+            LEFT JOIN t_p83864310_fintech_payment_reco.user_integrations ui ON ui.id = s.integration_id
+            WHERE s.owner_id = %s
+              AND s.bucket_start >= NOW() - %s * INTERVAL '1 minute'
+        '''
+
+        params_list = [owner_id, max_minutes]
+
+        if integration_id:
+            query += ' AND s.integration_id = %s'
+            params_list.append(integration_id)
+
+        cur.execute(query, params_list)
+
+        destinations = {}
+        for row in cur.fetchall():
+            key = (row[0], row[2])
+            if key not in destinations:
+                destinations[key] = {
+                    'integration_id': row[0],
+                    'integration_name': row[1],
+                    'forward_url': row[2],
+                    'buckets': []
+                }
+            destinations[key]['buckets'].append({
+                'age_minutes': float(row[3]),
+                'request_count': row[4],
+                'error_count': row[5],
+                'latency_sum_ms': row[6],
+                'latency_max_ms': row[7],
+                'latency_hist': row[8]
+            })
+
+        result = []
+        for destination in destinations.values():
+            buckets = destination.pop('buckets')
+            destination['windows'] = {
+                window: summarize_window(
+                    [b for b in buckets if b['age_minutes'] < WINDOW_MINUTES[window]],
+                    WINDOW_MINUTES[window]
+                )
+                for window in windows
+            }
+            result.append(destination)
+
+        result.sort(key=lambda d: d['windows'][windows[0]]['p95_ms'], reverse=True)
+
+        return json_response(200, {
+            'windows': windows,
+            'latency_buckets_ms': FORWARD_LATENCY_BUCKETS_MS,
+            'destinations': result
+        })
+
+    except Exception as e:
+        return json_response(500, {'error': str(e)})
+    finally:
+        cur.close()
+        conn.close()
@@ -1,117 +1,306 @@
 import json
 import os
+import re
+import select
+import time
 import psycopg2
-from typing import Dict, Any
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Any, Tuple, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Min-LSN',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+POLL_HEADERS = {**JSON_HEADERS, 'Cache-Control': 'no-store'}
+
+# Long-poll: запрос с since_id и wait держится до NOTIFY от webhook-receive о новой переадресации.
+# Пока событий нет, соединение только слушает канал и запросов к БД не делает
+EVENTS_CHANNEL = 'owner_events'
+MAX_WAIT_SECONDS = 25
+
+LOGS_QUERY = '''
+    SELECT 
+        wfl.id,
+        wfl.webhook_payment_id,
+        wfl.forward_url,
+        wfl.status_code,
+        wfl.error_message,
+        wfl.response_time_ms,
+        wfl.created_at,
+        wp.payment_id,
+        wp.order_id,
+        wp.amount_kopecks,
+        wp.status as payment_status
+    FROM t_p83864310_fintech_payment_reco.webhook_forward_logs wfl
+    LEFT JOIN t_p83864310_fintech_payment_reco.webhook_payments wp ON wp.id = wfl.webhook_payment_id
+    LEFT JOIN t_p83864310_fintech_payment_reco.user_integrations ui ON ui.id = wp.integration_id
+    WHERE ui.owner_id = %s
+'''
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT shard, status FROM t_p83864310_fintech_payment_reco.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+def get_connection(owner_id: Any):
+    '''
+    Соединение с primary шарда владельца; функция только читает, поэтому перенос владельца ей не мешает
+    '''
+    shard, _ = resolve_shard(owner_id)
+    return psycopg2.connect(shard_dsn(shard))
+
+# Реплики для чтения по шардам: {"main": "postgres://replica...", "shard-2": "..."}.
+# Шард без реплики, отставшая или недоступная реплика — чтение с primary
+REPLICA_DSNS: Dict[str, str] = json.loads(os.environ.get('REPLICA_DSNS') or '{}')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_RETRY_SECONDS = 10
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+_replica_skip_until: Dict[str, float] = {}
+
+def read_min_lsn(event: Dict[str, Any]) -> Optional[str]:
+    '''
+    X-Min-LSN клиента — X-Write-LSN его последней записи: реплика должна догнать этот LSN
+    '''
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    value = (headers.get('x-min-lsn') or '').strip()
+    return value if LSN_PATTERN.match(value) else None
+
+def get_read_connection(owner_id: Any, min_lsn: Optional[str] = None) -> Tuple[Any, str]:
+    '''
+    Соединение для чтения: реплика шарда, если лаг не больше REPLICA_MAX_LAG_SECONDS и она проиграла
+    min_lsn (чтение своих записей), иначе primary. Отставшая или недоступная реплика пропускается
+    на REPLICA_RETRY_SECONDS, чтобы не платить за проверку в каждом запросе
+    Returns: (conn, 'replica' | 'primary')
+    '''
+    shard, _ = resolve_shard(owner_id)
+    replica_dsn = REPLICA_DSNS.get(shard)
+    if replica_dsn and _replica_skip_until.get(shard, 0) <= time.monotonic():
+        try:
+            conn = psycopg2.connect(replica_dsn)
+        except psycopg2.OperationalError as e:
+            print(f"[DEBUG] Replica {shard} unavailable: {str(e).strip()}")
+            _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+        else:
+            cur = conn.cursor()
+            # Реплика, проигравшая все полученное, не отстает, даже если на primary давно не было записей
+            cur.execute('''
+                SELECT
+                    CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                         ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END,
+                    %s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+            ''', (min_lsn, min_lsn))
+            lag_seconds, caught_up = cur.fetchone()
+            cur.close()
+            if lag_seconds <= REPLICA_MAX_LAG_SECONDS and caught_up:
+                return conn, 'replica'
+            conn.close()
+            if lag_seconds > REPLICA_MAX_LAG_SECONDS:
+                print(f"[DEBUG] Replica {shard} lag {float(lag_seconds):.1f}s, reading from primary")
+                _replica_skip_until[shard] = time.monotonic() + REPLICA_RETRY_SECONDS
+    return psycopg2.connect(shard_dsn(shard)), 'primary'
+
+def json_default(value: Any) -> Any:
+    '''
+    Decimal и даты из psycopg2 сериализуются энкодером, без обхода строк вручную
+    '''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def dumps(payload: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload, default=json_default).decode('utf-8')
+    return json.dumps(payload, default=json_default)
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': dumps(payload),
+        'isBase64Encoded': False
+    }
+
+def fetch_logs(cur, owner_id: str, integration_id: Any, since_id: Any, limit: int) -> list:
+    '''
+    Без since_id — последние limit записей (новые сверху); с since_id — только более новые, по возрастанию id
+    '''
+    query = LOGS_QUERY
+    params_list = [owner_id]
+    
+    if integration_id:
+        query += ' AND ui.id = %s'
+        params_list.append(integration_id)
+    
+    if since_id is not None:
+        query += ' AND wfl.id > %s ORDER BY wfl.id LIMIT %s'
+        params_list.append(since_id)
+    else:
+        query += ' ORDER BY wfl.created_at DESC LIMIT %s'
+    params_list.append(limit)
+    
+    cur.execute(query, params_list)
+    
+    logs = []
+    for row in cur.fetchall():
+        logs.append({
+            'id': row[0],
+            'webhook_payment_id': row[1],
+            'forward_url': row[2],
+            'status_code': row[3],
+            'error_message': row[4],
+            'response_time_ms': row[5],
+            'created_at': row[6],
+            'payment_id': row[7],
+            'order_id': row[8],
+            # Строка лога без платежа (LEFT JOIN) — суммы нет
+            'amount': row[9] / 100 if row[9] is not None else None,
+            'amount_kopecks': row[9],
+            'payment_status': row[10]
+        })
+    return logs
+
+def wait_for_event(conn, owner_id: str, integration_id: Any, timeout: float) -> bool:
+    '''
+    Ожидание NOTIFY о новой переадресации этого владельца (и интеграции, если задана)
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if select.select([conn], [], [], remaining) == ([], [], []):
+            return False
+        conn.poll()
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            try:
+                payload = json.loads(notify.payload)
+            except ValueError:
+                continue
+            if payload.get('type') != 'forward_log' or str(payload.get('owner_id')) != str(owner_id):
+                continue
+            if integration_id and str(payload.get('integration_id')) != str(integration_id):
+                continue
+            return True
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Получение логов переадресации вебхуков
     GET /webhook-logs?owner_id=123&integration_id=456&limit=50
+    GET /webhook-logs?owner_id=123&since_id=789&wait=25 — только новые записи, long-poll до их появления
+    Returns: logs и cursor (максимальный id) для следующего запроса
     '''
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': CORS_PREFLIGHT_HEADERS,
             'body': '',
             'isBase64Encoded': False
         }
     
     if method != 'GET':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return json_response(405, {'error': 'Method not allowed'})
     
     params = event.get('queryStringParameters', {}) or {}
     owner_id = params.get('owner_id')
     integration_id = params.get('integration_id')
-    limit = int(params.get('limit', '100'))
+    since_id = params.get('since_id')
     
     if not owner_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'owner_id required'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'owner_id required'})
     
-    dsn = os.environ['DATABASE_URL']
-    conn = psycopg2.connect(dsn)
+    try:
+        owner_id = int(owner_id)
+    except (TypeError, ValueError):
+        return json_response(400, {'error': 'owner_id must be a number'})
+    
+    try:
+        limit = max(1, int(params.get('limit', '100')))
+        since_id = int(since_id) if since_id not in (None, '') else None
+        wait = min(max(float(params.get('wait', '0')), 0.0), MAX_WAIT_SECONDS)
+    except ValueError:
+        return json_response(400, {'error': 'limit, since_id and wait must be numbers'})
+    
+    # LISTEN на реплике недоступен: long-poll всегда на primary, обычные запросы — на реплику
+    try:
+        if since_id is not None and wait > 0:
+            conn, read_source = get_connection(owner_id), 'primary'
+        else:
+            conn, read_source = get_read_connection(owner_id, read_min_lsn(event))
+    except psycopg2.OperationalError as e:
+        print(f"[DEBUG] Database unavailable: {str(e).strip()}")
+        return json_response(503, {'error': 'Database unavailable'})
     cur = conn.cursor()
+    listening = False
     
     try:
-        query = '''
-            SELECT 
-                wfl.id,
-                wfl.webhook_payment_id,
-                wfl.forward_url,
-                wfl.status_code,
-                wfl.error_message,
-                wfl.response_time_ms,
-                wfl.created_at,
-                wp.payment_id,
-                wp.order_id,
-                wp.amount,
-                wp.status as payment_status
-            FROM t_p83864310_fintech_payment_reco.webhook_forward_logs wfl
-            LEFT JOIN t_p83864310_fintech_payment_reco.webhook_payments wp ON wp.id = wfl.webhook_payment_id
-            LEFT JOIN t_p83864310_fintech_payment_reco.user_integrations ui ON ui.id = wp.integration_id
-            WHERE ui.owner_id = %s
-        '''
+        if since_id is not None and wait > 0:
+            # LISTEN до выборки: запись, появившаяся между выборкой и ожиданием, не потеряется
+            conn.autocommit = True
+            cur.execute(f'LISTEN {EVENTS_CHANNEL}')
+            listening = True
         
-        params_list = [owner_id]
+        logs = fetch_logs(cur, owner_id, integration_id, since_id, limit)
         
-        if integration_id:
-            query += ' AND ui.id = %s'
-            params_list.append(integration_id)
+        if not logs and listening and wait_for_event(conn, owner_id, integration_id, wait):
+            logs = fetch_logs(cur, owner_id, integration_id, since_id, limit)
         
-        query += ' ORDER BY wfl.created_at DESC LIMIT %s'
-        params_list.append(limit)
-        
-        cur.execute(query, params_list)
-        
-        logs = []
-        for row in cur.fetchall():
-            logs.append({
-                'id': row[0],
-                'webhook_payment_id': row[1],
-                'forward_url': row[2],
-                'status_code': row[3],
-                'error_message': row[4],
-                'response_time_ms': row[5],
-                'created_at': row[6].isoformat() if row[6] else None,
-                'payment_id': row[7],
-                'order_id': row[8],
-                'amount': float(row[9]) if row[9] else None,
-                'payment_status': row[10]
-            })
-        
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'logs': logs}),
-            'isBase64Encoded': False
-        }
+        cursor = max([log['id'] for log in logs], default=since_id)
+        payload = {'logs': logs, 'cursor': cursor}
+        if since_id is not None:
+            payload['has_more'] = len(logs) >= limit
+            return json_response(200, payload, {**POLL_HEADERS, 'X-Read-Source': read_source})
+        return json_response(200, payload, {**JSON_HEADERS, 'X-Read-Source': read_source})
         
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'error': str(e)})
     finally:
+        if listening and not conn.closed:
+            try:
+                cur.execute('UNLISTEN *')
+            except psycopg2.Error:
+                pass
         cur.close()
         conn.close()
@@ -1,11 +1,539 @@
+import fcntl
 import json
 import os
-import hashlib
 import psycopg2
-import urllib.request
-import urllib.error
+import struct
 import time
-from typing import Dict, Any
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# Кэш повторов: T-Банк повторяет уведомления, пока не получит OK. Ключ (integration_id, PaymentId, Status)
+# попадает сюда после успешной записи, и повтор отвечается OK сразу после проверки подписи, без БД.
+# Точное множество с TTL и LRU-вытеснением: на объемах одного инстанса bloom-фильтр не нужен,
+# а ложных срабатываний (потерянных уникальных вебхуков) быть не должно. Источник истины — уникальный индекс.
+DEDUPE_TTL_SECONDS = 600
+DEDUPE_MAX_ENTRIES = 50000
+# Строки интеграций по токену кэшируются ненадолго, чтобы повтор не шел в БД даже за конфигом.
+# Кэш отвечает только на повторы уже сохраненных платежей: запись перечитывает интеграцию в своей
+# транзакции, так что удаленная, отключенная или со сменившимся паролем интеграция новых вебхуков не примет
+INTEGRATION_CACHE_TTL_SECONDS = 30
+# Сводка попаданий в кэш повторов печатается раз в столько проверок, а не на каждый вебхук
+DEDUPE_LOG_EVERY = 1000
+
+_dedupe_cache: 'OrderedDict[Tuple, float]' = OrderedDict()
+_integration_cache: Dict[str, Tuple[float, tuple]] = {}
+_cache_lock = threading.Lock()
+_dedupe_stats = {'hits': 0, 'misses': 0}
+
+# Допуск к БД: не больше INGEST_MAX_CONCURRENCY одновременных соединений на инстанс (общее число
+# соединений всех инстансов семафор не ограничивает). Кто не дождался слота за INGEST_ACQUIRE_TIMEOUT_SECONDS
+# или не смог подключиться (max_connections), получает 503 с Retry-After — провайдер доставит повторно.
+# Если задан WEBHOOK_SPOOL_DIR — постоянный том, общий с scripts/replay_spool.py (не /tmp инстанса), —
+# вебхук пишется туда с fsync и получает OK, дозагрузку делает replay_spool.py
+INGEST_MAX_CONCURRENCY = int(os.environ.get('INGEST_MAX_CONCURRENCY', '8'))
+INGEST_ACQUIRE_TIMEOUT_SECONDS = float(os.environ.get('INGEST_ACQUIRE_TIMEOUT_SECONDS', '2'))
+INGEST_RETRY_AFTER_SECONDS = 5
+WEBHOOK_SPOOL_DIR = os.environ.get('WEBHOOK_SPOOL_DIR', '')
+# Журнал всех принятых вебхуков для переигрывания (выключен, пока не задана директория)
+WEBHOOK_CAPTURE_DIR = os.environ.get('WEBHOOK_CAPTURE_DIR', '')
+WEBHOOK_CAPTURE_FSYNC = os.environ.get('WEBHOOK_CAPTURE_FSYNC', '') == '1'
+WEBHOOK_CAPTURE_MAX_SEGMENTS = int(os.environ.get('WEBHOOK_CAPTURE_MAX_SEGMENTS', '20'))
+SEGMENT_MAX_BYTES = int(os.environ.get('WEBHOOK_SEGMENT_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Формат сегмента: SEGMENT_MAGIC, затем записи SEGMENT_HEADER + token + body.
+# Заголовок: crc32, длина body, received_at (unix, double), длина token; crc32 считается
+# от всего, что после него (остаток заголовка, token, body). Читатель — scripts/replay_spool.py
+SEGMENT_MAGIC = b'WHSEG001'
+SEGMENT_HEADER = struct.Struct('<IIdH')
+
+_ingest_slots = threading.BoundedSemaphore(INGEST_MAX_CONCURRENCY)
+
+# Шардирование по owner_id: справочник owner_shards в основной БД (DATABASE_URL, шард main),
+# DSN остальных шардов — SHARD_DSNS ({"shard-2": "postgres://..."}). Без SHARD_DSNS все данные в main
+SHARD_DSNS: Dict[str, str] = json.loads(os.environ.get('SHARD_DSNS') or '{}')
+SHARD_CACHE_TTL_SECONDS = 30
+_shard_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
+# Владелец по токену вебхука с тем же TTL: маршрут интеграции не меняется, пока она существует
+_route_cache: Dict[str, Tuple[float, int]] = {}
+# Перенос владельца идет SETTLE_SECONDS shard_rebalance и время копирования — провайдеру повторять не чаще
+SHARD_MOVING_RETRY_AFTER_SECONDS = 30
+
+CORS_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Max-Age': '86400'
+}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+class ShardMovingError(Exception):
+    '''
+    Данные владельца переносятся между шардами (scripts/shard_rebalance.py), запись временно запрещена
+    '''
+
+def shard_dsn(shard: str) -> str:
+    return os.environ['DATABASE_URL'] if shard == 'main' else SHARD_DSNS[shard]
+
+def resolve_shard(owner_id: Any) -> Tuple[str, str]:
+    '''
+    Шард владельца и статус переноса из owner_shards, с кэшем на SHARD_CACHE_TTL_SECONDS
+    Returns: (shard, status)
+    '''
+    if not SHARD_DSNS:
+        return 'main', 'active'
+    key = str(owner_id)
+    cached = _shard_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT shard, status FROM t_p83864310_fintech_payment_reco.owner_shards WHERE owner_id = %s', (int(owner_id),))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+
+    route = (row[0], row[1]) if row else ('main', 'active')
+    _shard_cache[key] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, route)
+    return route
+
+def get_connection(owner_id: Any, write: bool = False):
+    '''
+    Соединение с шардом владельца; запись во время переноса — ShardMovingError
+    '''
+    shard, status = resolve_shard(owner_id)
+    if write and status == 'moving':
+        raise ShardMovingError(f'owner {owner_id} is being moved, retry later')
+    return psycopg2.connect(shard_dsn(shard))
+
+def resolve_integration_owner(webhook_token: str) -> Optional[int]:
+    '''
+    Владелец интеграции из integration_routes основной БД, с кэшем на SHARD_CACHE_TTL_SECONDS;
+    без SHARD_DSNS запрос не нужен (None — шард main). Отсутствие маршрута не кэшируется: новая интеграция
+    должна стать доступной сразу
+    '''
+    if not SHARD_DSNS:
+        return None
+    cached = _route_cache.get(webhook_token)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            'SELECT owner_id FROM t_p83864310_fintech_payment_reco.integration_routes WHERE webhook_token = %s',
+            (webhook_token,)
+        )
+        row = cur.fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    if len(_route_cache) > DEDUPE_MAX_ENTRIES:
+        _route_cache.clear()
+    _route_cache[webhook_token] = (time.monotonic() + SHARD_CACHE_TTL_SECONDS, row[0])
+    return row[0]
+
+class SegmentWriter:
+    '''
+    Дозапись в сегментный журнал <prefix>-<ms>-<pid>.seg с ротацией по размеру.
+    Запись идет под flock; если файл забрали переименованием (replay_spool.py), открывается новый
+    '''
+    def __init__(self, directory: str, prefix: str, fsync: bool, max_segments: Optional[int] = None):
+        self.directory = directory
+        self.prefix = prefix
+        self.fsync = fsync
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+        self._path: Optional[str] = None
+    
+    def _open(self, path: str) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o640)
+        self._path = path
+    
+    def _rotate(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._open(os.path.join(self.directory, f'{self.prefix}-{int(time.time() * 1000):013d}-{os.getpid()}.seg'))
+        if self.max_segments:
+            segments = sorted(name for name in os.listdir(self.directory)
+                              if name.startswith(self.prefix + '-') and name.endswith('.seg'))
+            for name in segments[:-self.max_segments]:
+                os.remove(os.path.join(self.directory, name))
+    
+    def _is_current(self) -> bool:
+        try:
+            return os.stat(self._path).st_ino == os.fstat(self._fd).st_ino
+        except OSError:
+            return False
+    
+    def append(self, token: str, body: str, received_at: float) -> str:
+        token_bytes = token.encode('utf-8')
+        body_bytes = body.encode('utf-8')
+        tail = struct.pack('<dH', received_at, len(token_bytes)) + token_bytes + body_bytes
+        record = struct.pack('<II', zlib.crc32(struct.pack('<I', len(body_bytes)) + tail), len(body_bytes)) + tail
+        
+        with self._lock:
+            if self._fd is None:
+                self._rotate()
+            while True:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+                if self._is_current():
+                    break
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                self._open(self._path)
+            try:
+                size = os.fstat(self._fd).st_size
+                if size == 0:
+                    os.write(self._fd, SEGMENT_MAGIC)
+                os.write(self._fd, record)
+                if self.fsync:
+                    os.fsync(self._fd)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            
+            if size + len(record) >= SEGMENT_MAX_BYTES:
+                self._rotate()
+            return self._path
+
+_spool_writer = SegmentWriter(WEBHOOK_SPOOL_DIR, 'spool', fsync=True) if WEBHOOK_SPOOL_DIR else None
+_capture_writer = SegmentWriter(WEBHOOK_CAPTURE_DIR, 'capture', WEBHOOK_CAPTURE_FSYNC,
+                                WEBHOOK_CAPTURE_MAX_SEGMENTS) if WEBHOOK_CAPTURE_DIR else None
+
+def dedupe_key(integration_id: int, webhook_data: Dict[str, Any]) -> Tuple:
+    return (integration_id, str(webhook_data.get('PaymentId')), webhook_data.get('Status'))
+
+def dedupe_seen(key: Tuple) -> bool:
+    '''
+    Проверка ключа в кэше повторов с учетом TTL, обновляет счетчики попаданий
+    '''
+    now = time.monotonic()
+    with _cache_lock:
+        expires_at = _dedupe_cache.get(key)
+        hit = expires_at is not None and expires_at > now
+        if expires_at is not None and not hit:
+            del _dedupe_cache[key]
+        _dedupe_stats['hits' if hit else 'misses'] += 1
+        total = _dedupe_stats['hits'] + _dedupe_stats['misses']
+        if total % DEDUPE_LOG_EVERY == 0:
+            print(f"[DEDUPE] hit_rate={_dedupe_stats['hits'] / total:.3f} ({_dedupe_stats['hits']}/{total}), size={len(_dedupe_cache)}")
+        return hit
+
+def dedupe_remember(key: Tuple) -> None:
+    with _cache_lock:
+        _dedupe_cache[key] = time.monotonic() + DEDUPE_TTL_SECONDS
+        _dedupe_cache.move_to_end(key)
+        while len(_dedupe_cache) > DEDUPE_MAX_ENTRIES:
+            _dedupe_cache.popitem(last=False)
+
+def integration_cache_get(webhook_token: str) -> Optional[tuple]:
+    with _cache_lock:
+        cached = _integration_cache.get(webhook_token)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        _integration_cache.pop(webhook_token, None)
+        return None
+
+def integration_cache_put(webhook_token: str, integration: tuple) -> None:
+    with _cache_lock:
+        if len(_integration_cache) > DEDUPE_MAX_ENTRIES:
+            _integration_cache.clear()
+        _integration_cache[webhook_token] = (time.monotonic() + INTEGRATION_CACHE_TTL_SECONDS, integration)
+
+def integration_cache_drop(webhook_token: str) -> None:
+    with _cache_lock:
+        _integration_cache.pop(webhook_token, None)
+
+def fetch_integration(cur, webhook_token: str) -> Optional[tuple]:
+    '''
+    Активная интеграция по токену: (id, owner_id, config, webhook_settings, provider_slug, forward_url)
+    '''
+    cur.execute('''
+        SELECT 
+            ui.id, 
+            ui.owner_id, 
+            ui.config,
+            ui.webhook_settings,
+            p.slug,
+            ui.forward_url
+        FROM t_p83864310_fintech_payment_reco.user_integrations ui
+        JOIN t_p83864310_fintech_payment_reco.integration_providers p ON p.id = ui.provider_id
+        WHERE ui.webhook_token = %s AND ui.status = 'active'
+    ''', (webhook_token,))
+    
+    row = cur.fetchone()
+    if not row:
+        return None
+    
+    integration_id, owner_id, config, webhook_settings, provider_slug, forward_url = row
+    config = json.loads(config) if isinstance(config, str) else config
+    webhook_settings = json.loads(webhook_settings) if isinstance(webhook_settings, str) else webhook_settings
+    
+    return (integration_id, owner_id, config or {}, webhook_settings or {}, provider_slug, forward_url)
+
+def capture_webhook(webhook_token: str, raw_body: str, received_at: float) -> None:
+    if _capture_writer is None:
+        return
+    try:
+        _capture_writer.append(webhook_token, raw_body, received_at)
+    except OSError as e:
+        print(f"[CAPTURE] write failed: {str(e)}")
+
+def retry_later_response(reason: str, retry_after: int = INGEST_RETRY_AFTER_SECONDS) -> Dict[str, Any]:
+    print(f"[INGEST] webhook deferred to provider retry: reason={reason}")
+    return json_response(503, {'error': 'Service overloaded'}, {**JSON_HEADERS, 'Retry-After': str(retry_after)})
+
+def spool_webhook(webhook_token: str, raw_body: str, received_at: float, reason: str) -> Dict[str, Any]:
+    '''
+    Сохранение сырого вебхука в spool-сегмент (fsync) вместо БД, если spool настроен; иначе 503.
+    Подпись и маппинг выполнит replay_spool.py тем же handler
+    '''
+    if _spool_writer is None:
+        return retry_later_response(reason)
+    try:
+        path = _spool_writer.append(webhook_token, raw_body, received_at)
+    except OSError as e:
+        print(f"[SPOOL] write failed: {str(e)}")
+        return retry_later_response(reason)
+    
+    print(f"[SPOOL] webhook spooled: reason={reason}, file={path}")
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'text/plain', 'X-Spooled': reason},
+        'body': 'OK',
+        'isBase64Encoded': False
+    }
+
+def ok_response(dedupe: Optional[str] = None) -> Dict[str, Any]:
+    headers = {'Content-Type': 'text/plain'}
+    if dedupe:
+        headers['X-Dedupe'] = dedupe
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': 'OK',
+        'isBase64Encoded': False
+    }
+
+# Исходящий HTTP: постоянные соединения по хостам, одна попытка на запрос.
+# Одинаковый блок в webhook-receive, notifications-dispatch и ofd-sync-scheduler (общих модулей у функций нет):
+# повторы у них не в клиенте — outbox, следующий цикл планировщика, журнал webhook_forward_logs.
+# Клиент с повторами, gzip и token bucket — в ofd-fetch-receipts, проверка копий — scripts/http_client_check.py.
+# http.client/ssl импортируются при первом запросе: webhook-receive без пересылки их не загружает
+# (cold_start_budget.json)
+class HttpError(Exception):
+    '''
+    Ответ со статусом >= 400
+    '''
+    def __init__(self, status: int, body: bytes, headers: Dict[str, str]):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+        self.body = body
+        self.headers = headers
+
+class HttpResponse:
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+class HttpClient:
+    '''
+    Клиент с пулом keep-alive соединений на (scheme, host, port), одна попытка на запрос. Соединение,
+    закрытое сервером между вызовами, переоткрывается: запрос до сервера не дошел
+    '''
+    def __init__(self, timeout: float = 30.0, connect_timeout: float = 5.0, pool_size: int = 4):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.pool_size = pool_size
+        self._pools: Dict[Tuple[str, str, int], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def _checkout(self, key: Tuple[str, str, int]) -> Tuple[Any, bool]:
+        import http.client
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool:
+                return pool.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            import ssl
+            return http.client.HTTPSConnection(host, port, timeout=self.connect_timeout,
+                                               context=ssl.create_default_context()), False
+        return http.client.HTTPConnection(host, port, timeout=self.connect_timeout), False
+
+    def _checkin(self, key: Tuple[str, str, int], conn: Any) -> None:
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def _send(self, key: Tuple[str, str, int], method: str, target: str, body: Optional[bytes],
+              headers: Dict[str, str], timeout: float) -> Tuple[int, Dict[str, str], bytes]:
+        import http.client
+        for fresh_retry in (False, True):
+            conn, reused = self._checkout(key)
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.settimeout(timeout)
+                conn.request(method, target, body=body, headers=headers)
+                response = conn.getresponse()
+                raw = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # Сервер закрыл простаивавшее соединение: повтор на новом
+                if reused and not fresh_retry:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(key, conn)
+            return response.status, {name.lower(): value for name, value in response.getheaders()}, raw
+        raise ConnectionError('connection closed by server')
+
+    def request(self, method: str, url: str, body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None,
+                timeout: Optional[float] = None) -> HttpResponse:
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url)
+        scheme = parts.scheme or 'http'
+        key = (scheme, parts.hostname or '', parts.port or (443 if scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        request_headers = {'Connection': 'keep-alive', **(headers or {})}
+
+        status, response_headers, raw = self._send(key, method, target, body, request_headers, timeout or self.timeout)
+        if status >= 400:
+            raise HttpError(status, raw, response_headers)
+        return HttpResponse(status, response_headers, raw)
+
+# Пересылка в вебхук клиента: одна попытка с коротким таймаутом — провайдер ждет ответа, повторы внутри его
+# запроса добавляли бы таймауты к задержке и дубли у клиента. Неудача остается в webhook_forward_logs.
+# Idempotency-Key — id записи webhook_payments: по нему клиент отличит повторную доставку того же
+# уведомления от нового платежа.
+# Соединения с URL клиента живут между вызовами теплого инстанса
+FORWARD_HTTP = HttpClient(timeout=5.0, connect_timeout=2.0)
+
+# Верхние границы корзин гистограммы задержек переадресации (мс), последняя корзина — всё, что больше.
+# Должны совпадать с webhook-forward-stats и миграцией V0010.
+FORWARD_LATENCY_BUCKETS_MS = [25, 50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000]
+
+# Статусы, о которых уведомляем покупателя через мессенджер (через outbox, без HTTP в пути вебхука)
+CUSTOMER_NOTIFY_STATUSES = ('CONFIRMED', 'REFUNDED')
+MESSENGER_PROVIDERS = ('ek_max', 'ek_wa', 'ek_tg')
+
+def parse_kopecks(value: Any) -> int:
+    '''
+    Amount провайдера в копейках -> int. Провайдер присылает и числа, и строки ("25050", "250.50"): разбор
+    через Decimal, дробная часть округляется half-up. Пустое значение — 0, нечисловое — ValueError
+    '''
+    if value is None or value == '':
+        return 0
+    if isinstance(value, bool):
+        raise ValueError(f'invalid amount: {value!r}')
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f'invalid amount: {value!r}')
+    if not amount.is_finite():
+        raise ValueError(f'invalid amount: {value!r}')
+    return int(amount.quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def enqueue_customer_notification(cur, integration_id: int, owner_id: int, webhook_payment_id: int,
+                                  webhook_data: Dict[str, Any], webhook_settings: Dict[str, Any],
+                                  amount_kopecks: int) -> bool:
+    '''
+    Запись события в notification_outbox в текущей транзакции.
+    Провайдер мессенджера берется из webhook_settings.notify_customer_provider,
+    фильтр по статусам — те же флаги notify_on_*
+    '''
+    status = webhook_data.get('Status')
+    provider = webhook_settings.get('notify_customer_provider')
+    recipient = webhook_data.get('Phone')
+    
+    if status not in CUSTOMER_NOTIFY_STATUSES or provider not in MESSENGER_PROVIDERS or not recipient:
+        return False
+    
+    if not webhook_settings.get(f'notify_on_{status.lower()}', True):
+        return False
+    
+    cur.execute('''
+        INSERT INTO t_p83864310_fintech_payment_reco.notification_outbox
+        (integration_id, owner_id, webhook_payment_id, event_type, provider, recipient, payload)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ''', (
+        integration_id,
+        owner_id,
+        webhook_payment_id,
+        status,
+        provider,
+        recipient,
+        json.dumps({
+            'payment_id': webhook_data.get('PaymentId'),
+            'order_id': webhook_data.get('OrderId'),
+            'amount_kopecks': amount_kopecks
+        })
+    ))
+    return True
+
+def latency_bucket_index(response_time_ms: int) -> int:
+    '''
+    Номер корзины гистограммы (с 1, как индексы массивов PostgreSQL)
+    '''
+    for index, upper_bound in enumerate(FORWARD_LATENCY_BUCKETS_MS):
+        if response_time_ms <= upper_bound:
+            return index + 1
+    return len(FORWARD_LATENCY_BUCKETS_MS) + 1
+
+def record_forward_stats(cur, integration_id: int, owner_id: int, forward_url: str,
+                         status_code: int, response_time_ms: int) -> None:
+    '''
+    Инкрементальное обновление 5-минутного окна статистики переадресации
+    '''
+    is_error = 1 if not status_code or status_code >= 400 else 0
+    bucket = latency_bucket_index(response_time_ms)
+    
+    cur.execute('''
+        INSERT INTO t_p83864310_fintech_payment_reco.webhook_forward_stats AS s (
+            integration_id, owner_id, forward_url, bucket_start,
+            request_count, error_count, latency_sum_ms, latency_max_ms, latency_hist
+        ) VALUES (
+            %s, %s, %s,
+            date_trunc('hour', NOW()) + floor(date_part('minute', NOW()) / 5) * INTERVAL '5 minutes',
+            1, %s, %s, %s,
+            (SELECT array_agg(CASE WHEN i = %s THEN 1 ELSE 0 END ORDER BY i) FROM generate_series(1, %s) AS i)
+        )
+        ON CONFLICT (integration_id, forward_url, bucket_start) DO UPDATE SET
+            request_count = s.request_count + 1,
+            error_count = s.error_count + EXCLUDED.error_count,
+            latency_sum_ms = s.latency_sum_ms + EXCLUDED.latency_sum_ms,
+            latency_max_ms = GREATEST(s.latency_max_ms, EXCLUDED.latency_max_ms),
+            latency_hist[%s] = s.latency_hist[%s] + 1
+    ''', (
+        integration_id, owner_id, forward_url,
+        is_error, response_time_ms, response_time_ms,
+        bucket, len(FORWARD_LATENCY_BUCKETS_MS) + 1,
+        bucket, bucket
+    ))
+
+def notify_owner_event(cur, payload: Dict[str, Any]) -> None:
+    '''
+    NOTIFY в канал owner_events для подписчиков владельца (long-poll webhook-logs, scripts/push_server.py)
+    '''
+    cur.execute("SELECT pg_notify('owner_events', %s)", (json.dumps(payload),))
 
 def verify_tbank_token(data: Dict[str, Any], terminal_password: str) -> bool:
     '''
@@ -21,6 +549,9 @@ def verify_tbank_token(data: Dict[str, Any], terminal_password: str) -> bool:
     if not received_token:
         return False
     
+    # Ленивый импорт: не платим за него на холодном старте запросов без подписи
+    import hashlib
+    
     params_to_hash = {}
     
     for key, value in data.items():
@@ -53,6 +584,14 @@ def verify_tbank_token(data: Dict[str, Any], terminal_password: str) -> bool:
     
     return calculated_token == received_token
 
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps(payload),
+        'isBase64Encoded': False
+    }
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Прием вебхуков от платежных провайдеров по уникальному токену
@@ -66,12 +605,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': CORS_PREFLIGHT_HEADERS,
             'body': '',
             'isBase64Encoded': False
         }
@@ -88,67 +622,90 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     webhook_token = params.get('token', '')
     
     if not webhook_token:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Token required'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'Token required'})
     
     try:
         webhook_data = json.loads(event.get('body', '{}'))
     except json.JSONDecodeError:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': 'Invalid JSON'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'Invalid JSON'})
+    
+    received_at = time.time()
+    raw_body = event.get('body') or '{}'
+    # Переигрываемые из журнала записи повторно не пишем
+    if not (event.get('headers') or {}).get('X-Spool-Replay'):
+        capture_webhook(webhook_token, raw_body, received_at)
+    
+    # Горячий путь повторов: интеграция из кэша, подпись, ключ в кэше повторов — без обращения к БД
+    integration = integration_cache_get(webhook_token)
+    signature_valid = None
+    dedupe_checked = False
+    if integration and integration[4] == 'tbank':
+        signature_valid = verify_tbank_token(webhook_data, integration[2].get('terminal_password', ''))
+        if signature_valid:
+            dedupe_checked = True
+            if dedupe_seen(dedupe_key(integration[0], webhook_data)):
+                return ok_response('hit')
     
-    dsn = os.environ['DATABASE_URL']
-    conn = psycopg2.connect(dsn)
+    if not _ingest_slots.acquire(timeout=INGEST_ACQUIRE_TIMEOUT_SECONDS):
+        return spool_webhook(webhook_token, raw_body, received_at, 'saturated')
+    # Слот освобождается при любом исходе, включая неожиданные исключения маршрутизации
+    try:
+        return store_webhook(webhook_token, webhook_data, raw_body, received_at, integration, signature_valid, dedupe_checked)
+    finally:
+        _ingest_slots.release()
+
+def store_webhook(webhook_token: str, webhook_data: Dict[str, Any], raw_body: str, received_at: float,
+                  integration: Optional[tuple], signature_valid: Optional[bool], dedupe_checked: bool) -> Dict[str, Any]:
+    '''
+    Запись вебхука в шард владельца, пересылка и статистика; вызывается с занятым слотом _ingest_slots
+    '''
+    try:
+        # Шард по владельцу из кэша интеграции или маршрута токена; без маршрута — основная БД
+        route_owner_id = integration[1] if integration else resolve_integration_owner(webhook_token)
+        if route_owner_id is None:
+            conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        else:
+            conn = get_connection(route_owner_id, write=True)
+    except ShardMovingError:
+        # Владелец переносится: не подтверждаем, провайдер повторит доставку уже на новый шард
+        return retry_later_response('shard_moving', SHARD_MOVING_RETRY_AFTER_SECONDS)
+    except psycopg2.OperationalError as e:
+        print(f"[SPOOL] database unavailable: {str(e).strip()}")
+        return spool_webhook(webhook_token, raw_body, received_at, 'db_unavailable')
     cur = conn.cursor()
     
     try:
-        cur.execute('''
-            SELECT 
-                ui.id, 
-                ui.owner_id, 
-                ui.config,
-                ui.webhook_settings,
-                p.slug,
-                ui.forward_url
-            FROM t_p83864310_fintech_payment_reco.user_integrations ui
-            JOIN t_p83864310_fintech_payment_reco.integration_providers p ON p.id = ui.provider_id
-            WHERE ui.webhook_token = %s AND ui.status = 'active'
-        ''', (webhook_token,))
-        
-        integration_row = cur.fetchone()
-        if not integration_row:
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json'},
-                'body': json.dumps({'error': 'Integration not found'}),
-                'isBase64Encoded': False
-            }
+        # Строка из кэша могла устареть: запись идет только по интеграции, прочитанной в этой транзакции.
+        # Если она изменилась (например, пароль терминала), подпись и повтор проверяются заново
+        fresh_integration = fetch_integration(cur, webhook_token)
+        if fresh_integration != integration:
+            signature_valid = None
+            dedupe_checked = False
+        integration = fresh_integration
+        if integration:
+            integration_cache_put(webhook_token, integration)
+        else:
+            integration_cache_drop(webhook_token)
         
-        integration_id, owner_id, config, webhook_settings, provider_slug, forward_url = integration_row
+        if not integration:
+            return json_response(404, {'error': 'Integration not found'})
         
-        config = json.loads(config) if isinstance(config, str) else config
-        webhook_settings = json.loads(webhook_settings) if isinstance(webhook_settings, str) else webhook_settings
+        integration_id, owner_id, config, webhook_settings, provider_slug, forward_url = integration
+        webhook_payment_id = None
+        payment_key = None
         
         if provider_slug == 'tbank':
-            terminal_password = config.get('terminal_password', '')
-            signature_valid = verify_tbank_token(webhook_data, terminal_password)
+            if signature_valid is None:
+                terminal_password = config.get('terminal_password', '')
+                signature_valid = verify_tbank_token(webhook_data, terminal_password)
             
             if not signature_valid:
                 print(f"[SECURITY] Invalid signature rejected")
-                return {
-                    'statusCode': 403,
-                    'headers': {'Content-Type': 'application/json'},
-                    'body': json.dumps({'error': 'Invalid signature'}),
-                    'isBase64Encoded': False
-                }
+                return json_response(403, {'error': 'Invalid signature'})
+            
+            payment_key = dedupe_key(integration_id, webhook_data)
+            if not dedupe_checked and dedupe_seen(payment_key):
+                return ok_response('hit')
             
             status = webhook_data.get('Status', '')
             print(f"[DEBUG] Webhook status: {status}, settings: {webhook_settings}")
@@ -171,14 +728,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
-            webhook_payment_id = None
+            # Amount провайдера — копейки; рубли для старой колонки amount делит БД в numeric, без float
+            try:
+                amount_kopecks = parse_kopecks(webhook_data.get('Amount'))
+            except ValueError as e:
+                print(f"[DEBUG] Webhook rejected: {e}")
+                return json_response(400, {'error': 'Amount must be a number'})
             cur.execute('''
                 INSERT INTO t_p83864310_fintech_payment_reco.webhook_payments (
                     integration_id, owner_id, payment_id, terminal_key,
-                    amount, order_id, status, payment_status, error_code,
+                    amount_kopecks, amount, order_id, status, payment_status, error_code,
                     customer_email, customer_phone, pan, card_type, exp_date,
                     raw_data
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ) VALUES (%s, %s, %s, %s, %s, %s::bigint / 100.0, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 ON CONFLICT (integration_id, payment_id, status) DO NOTHING
                 RETURNING id
             ''', (
@@ -186,7 +748,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 owner_id,
                 webhook_data.get('PaymentId'),
                 webhook_data.get('TerminalKey'),
-                float(webhook_data.get('Amount', 0)) / 100,
+                amount_kopecks,
+                amount_kopecks,
                 webhook_data.get('OrderId'),
                 webhook_data.get('Status'),
                 webhook_data.get('PaymentStatus'),
@@ -203,39 +766,66 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             if result:
                 webhook_payment_id = result[0]
                 print(f"[DEBUG] Webhook saved: id={webhook_payment_id}, status={webhook_data.get('Status')}")
+                notify_owner_event(cur, {
+                    'type': 'payment',
+                    'owner_id': owner_id,
+                    'integration_id': integration_id,
+                    'id': webhook_payment_id,
+                    'payment_id': webhook_data.get('PaymentId'),
+                    'status': webhook_data.get('Status'),
+                    'amount_kopecks': amount_kopecks
+                })
+                if status in ('CONFIRMED', 'REFUNDED'):
+                    # День попадет в отчет о расхождениях при следующей сверке или загрузке чеков
+                    cur.execute('''
+                        INSERT INTO t_p83864310_fintech_payment_reco.reconciliation_dirty_days (owner_id, day)
+                        VALUES (%s, NOW()::date)
+                        ON CONFLICT (owner_id, day) DO NOTHING
+                    ''', (owner_id,))
+                
+                if enqueue_customer_notification(cur, integration_id, owner_id, webhook_payment_id, webhook_data, webhook_settings or {},
+                                                 amount_kopecks):
+                    print(f"[DEBUG] Customer notification queued: payment={webhook_data.get('PaymentId')}, status={webhook_data.get('Status')}")
             else:
                 print(f"[DEBUG] Webhook duplicate skipped: integration={integration_id}, payment={webhook_data.get('PaymentId')}, status={webhook_data.get('Status')}")
         
-        cur.execute('''
-            UPDATE t_p83864310_fintech_payment_reco.user_integrations 
-            SET last_webhook_at = NOW(), 
-                webhook_count = webhook_count + 1,
-                updated_at = NOW()
-            WHERE id = %s
-        ''', (integration_id,))
+        # Повтор уже сохраненного статуса не считается новым вебхуком
+        if payment_key is None or webhook_payment_id:
+            cur.execute('''
+                UPDATE t_p83864310_fintech_payment_reco.user_integrations 
+                SET last_webhook_at = NOW(), 
+                    webhook_count = webhook_count + 1,
+                    updated_at = NOW()
+                WHERE id = %s
+            ''', (integration_id,))
         
         conn.commit()
         
+        if payment_key is not None:
+            dedupe_remember(payment_key)
+        
         if forward_url and webhook_payment_id:
             start_time = int(time.time() * 1000)
             status_code = None
             error_message = None
             
             try:
-                req = urllib.request.Request(
+                response = FORWARD_HTTP.request(
+                    'POST',
                     forward_url,
-                    data=json.dumps(webhook_data).encode('utf-8'),
-                    headers={'Content-Type': 'application/json'},
-                    method='POST'
+                    body=json.dumps(webhook_data).encode('utf-8'),
+                    headers={
+                        'Content-Type': 'application/json',
+                        'Idempotency-Key': f'webhook-payment-{webhook_payment_id}'
+                    }
                 )
-                with urllib.request.urlopen(req, timeout=5) as response:
-                    status_code = response.status
-            except urllib.error.HTTPError as e:
-                status_code = e.code
-                error_message = f"HTTP {e.code}: {e.reason}"
-            except urllib.error.URLError as e:
+                status_code = response.status
+            except HttpError as e:
+                status_code = e.status
+                error_message = f"HTTP {e.status}: {e.body[:200].decode('utf-8', 'replace')}"
+            except OSError as e:
                 status_code = 0
-                error_message = f"URL Error: {str(e.reason)}"
+                error_message = f"URL Error: {str(e)}"
             except Exception as e:
                 status_code = 0
                 error_message = f"Error: {str(e)}"
@@ -246,24 +836,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 INSERT INTO t_p83864310_fintech_payment_reco.webhook_forward_logs 
                 (webhook_payment_id, forward_url, status_code, error_message, response_time_ms)
                 VALUES (%s, %s, %s, %s, %s)
+                RETURNING id
             ''', (webhook_payment_id, forward_url, status_code, error_message, response_time))
+            forward_log_id = cur.fetchone()[0]
+            record_forward_stats(cur, integration_id, owner_id, forward_url, status_code, response_time)
+            # Будит long-poll webhook-logs; уведомление уходит только при commit
+            notify_owner_event(cur, {
+                'type': 'forward_log',
+                'owner_id': owner_id,
+                'integration_id': integration_id,
+                'id': forward_log_id
+            })
             conn.commit()
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'text/plain'},
-            'body': 'OK',
-            'isBase64Encoded': False
-        }
+        return ok_response('miss' if payment_key is not None else None)
         
     except Exception as e:
         conn.rollback()
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'error': str(e)})
     finally:
         cur.close()
         conn.close()
\ No newline at end of file
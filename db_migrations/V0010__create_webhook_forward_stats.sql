@@ -0,0 +1,19 @@
+-- Агрегированная статистика переадресации вебхуков по 5-минутным окнам
+-- Гистограмма latency_hist обновляется инкрементально при каждой переадресации,
+-- границы корзин (мс): 25, 50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, +inf
+CREATE TABLE t_p83864310_fintech_payment_reco.webhook_forward_stats (
+    id SERIAL PRIMARY KEY,
+    integration_id INTEGER NOT NULL,
+    owner_id INTEGER NOT NULL,
+    forward_url TEXT NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    request_count INTEGER NOT NULL DEFAULT 0,
+    error_count INTEGER NOT NULL DEFAULT 0,
+    latency_sum_ms BIGINT NOT NULL DEFAULT 0,
+    latency_max_ms INTEGER NOT NULL DEFAULT 0,
+    latency_hist INTEGER[] NOT NULL DEFAULT array_fill(0, ARRAY[13]),
+    CONSTRAINT unique_forward_stats_bucket UNIQUE (integration_id, forward_url, bucket_start)
+);
+
+-- Индекс для выборки окон по владельцу
+CREATE INDEX idx_webhook_forward_stats_owner ON t_p83864310_fintech_payment_reco.webhook_forward_stats(owner_id, bucket_start DESC);
@@ -0,0 +1,24 @@
+-- Outbox уведомлений покупателям: пишется в одной транзакции с платежом в webhook-receive,
+-- отправляется пакетами функцией notifications-dispatch через send-message
+CREATE TABLE t_p83864310_fintech_payment_reco.notification_outbox (
+    id SERIAL PRIMARY KEY,
+    integration_id INTEGER NOT NULL,
+    owner_id INTEGER NOT NULL,
+    webhook_payment_id INTEGER,
+    event_type VARCHAR(50) NOT NULL,
+    provider VARCHAR(20) NOT NULL,
+    recipient VARCHAR(100) NOT NULL,
+    payload JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    locked_at TIMESTAMP,
+    sent_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Очередь на отправку: только необработанные события
+CREATE INDEX idx_notification_outbox_pending ON t_p83864310_fintech_payment_reco.notification_outbox(next_attempt_at, id) WHERE status IN ('pending', 'processing');
+
+CREATE INDEX idx_notification_outbox_owner ON t_p83864310_fintech_payment_reco.notification_outbox(owner_id, created_at DESC);
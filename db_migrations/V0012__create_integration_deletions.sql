@@ -0,0 +1,22 @@
+-- Фоновое удаление интеграций: integrations-delete помечает интеграцию как deleting,
+-- integrations-purge удаляет дочерние строки порциями и ведет прогресс здесь
+CREATE TABLE t_p83864310_fintech_payment_reco.integration_deletions (
+    integration_id INTEGER PRIMARY KEY,
+    owner_id INTEGER NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    payments_total INTEGER,
+    payments_deleted INTEGER NOT NULL DEFAULT 0,
+    forward_logs_deleted INTEGER NOT NULL DEFAULT 0,
+    receipts_deleted INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    lease_until TIMESTAMP,
+    requested_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX idx_integration_deletions_active ON t_p83864310_fintech_payment_reco.integration_deletions(requested_at) WHERE status IN ('pending', 'running');
+
+-- Для порционного удаления событий outbox по интеграции
+CREATE INDEX idx_notification_outbox_integration ON t_p83864310_fintech_payment_reco.notification_outbox(integration_id);
@@ -0,0 +1,2 @@
+-- Индекс для списка интеграций владельца (integrations-list)
+CREATE INDEX IF NOT EXISTS idx_user_integrations_owner ON t_p83864310_fintech_payment_reco.user_integrations(owner_id, created_at DESC);
@@ -0,0 +1,16 @@
+-- Уже загруженные из OFD интервалы времени по каждой ККТ интеграции.
+-- ofd-fetch-receipts запрашивает только непокрытые промежутки и сливает соседние интервалы в один
+CREATE TABLE t_p83864310_fintech_payment_reco.ofd_sync_ranges (
+    id SERIAL PRIMARY KEY,
+    integration_id INTEGER NOT NULL,
+    kkt VARCHAR(50) NOT NULL,
+    range_from TIMESTAMP NOT NULL,
+    range_to TIMESTAMP NOT NULL,
+    synced_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    CONSTRAINT ofd_sync_ranges_order CHECK (range_from <= range_to)
+);
+
+CREATE INDEX idx_ofd_sync_ranges_kkt ON t_p83864310_fintech_payment_reco.ofd_sync_ranges(integration_id, kkt, range_from);
+
+-- Время последнего изменения чека при повторной загрузке (upsert по raw_data)
+ALTER TABLE t_p83864310_fintech_payment_reco.ofd_receipts ADD COLUMN updated_at TIMESTAMP;
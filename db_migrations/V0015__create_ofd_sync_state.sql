@@ -0,0 +1,33 @@
+-- Фоновая синхронизация чеков OFD: ofd-sync-scheduler вызывается по таймеру и догружает
+-- каждую активную OFD-интеграцию от отметки high_water_mark (последний doc_datetime)
+CREATE TABLE t_p83864310_fintech_payment_reco.ofd_sync_state (
+    integration_id INTEGER PRIMARY KEY,
+    owner_id INTEGER NOT NULL,
+    high_water_mark TIMESTAMP,
+    last_run_at TIMESTAMP,
+    last_success_at TIMESTAMP,
+    last_status VARCHAR(20),
+    last_error TEXT,
+    consecutive_failures INTEGER NOT NULL DEFAULT 0,
+    lease_until TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Статистика каждого запуска синхронизации
+CREATE TABLE t_p83864310_fintech_payment_reco.ofd_sync_runs (
+    id SERIAL PRIMARY KEY,
+    integration_id INTEGER NOT NULL,
+    owner_id INTEGER NOT NULL,
+    slot INTEGER NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    date_from TIMESTAMP,
+    receipts_fetched INTEGER NOT NULL DEFAULT 0,
+    inserted INTEGER NOT NULL DEFAULT 0,
+    updated INTEGER NOT NULL DEFAULT 0,
+    bytes_received BIGINT NOT NULL DEFAULT 0,
+    duration_ms INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    started_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX idx_ofd_sync_runs_integration ON t_p83864310_fintech_payment_reco.ofd_sync_runs(integration_id, started_at DESC);
@@ -0,0 +1,30 @@
+-- Результаты сверки платежей с чеками OFD (reconciliation-match).
+-- Одно сопоставление связывает один или несколько платежей с одним или несколькими чеками;
+-- каждый платеж и чек входит не более чем в одно сопоставление (уникальный индекс по элементам)
+CREATE TABLE t_p83864310_fintech_payment_reco.reconciliation_matches (
+    id SERIAL PRIMARY KEY,
+    owner_id INTEGER NOT NULL,
+    direction VARCHAR(10) NOT NULL,
+    match_type VARCHAR(20) NOT NULL,
+    payments_kopecks BIGINT NOT NULL,
+    receipts_kopecks BIGINT NOT NULL,
+    difference_kopecks BIGINT NOT NULL DEFAULT 0,
+    time_delta_seconds INTEGER NOT NULL DEFAULT 0,
+    confidence NUMERIC(4, 3) NOT NULL,
+    matched_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX idx_reconciliation_matches_owner ON t_p83864310_fintech_payment_reco.reconciliation_matches(owner_id, matched_at DESC);
+
+CREATE TABLE t_p83864310_fintech_payment_reco.reconciliation_match_items (
+    match_id INTEGER NOT NULL REFERENCES t_p83864310_fintech_payment_reco.reconciliation_matches(id),
+    item_type VARCHAR(10) NOT NULL,
+    item_id INTEGER NOT NULL,
+    kopecks BIGINT NOT NULL,
+    CONSTRAINT unique_reconciliation_item UNIQUE (item_type, item_id)
+);
+
+CREATE INDEX idx_reconciliation_match_items_match ON t_p83864310_fintech_payment_reco.reconciliation_match_items(match_id);
+
+-- Выборка чеков владельца по времени документа для окон сопоставления
+CREATE INDEX idx_ofd_receipts_owner_datetime ON t_p83864310_fintech_payment_reco.ofd_receipts(owner_id, doc_datetime);
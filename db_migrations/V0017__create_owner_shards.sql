@@ -0,0 +1,26 @@
+-- Справочник шардов: данные владельца (интеграции, платежи, чеки, логи, сверка) живут в одной БД-шарде.
+-- Таблицы справочника используются только в основной БД (DATABASE_URL, шард main);
+-- владелец без строки в owner_shards — в main. DSN остальных шардов — в SHARD_DSNS функций.
+-- status = 'moving' на время переноса scripts/shard_rebalance.py: запись у владельца запрещена
+CREATE TABLE t_p83864310_fintech_payment_reco.owner_shards (
+    owner_id INTEGER PRIMARY KEY,
+    shard VARCHAR(64) NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'active',
+    moved_at TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    CONSTRAINT owner_shards_status CHECK (status IN ('active', 'moving'))
+);
+
+CREATE INDEX idx_owner_shards_shard ON t_p83864310_fintech_payment_reco.owner_shards(shard);
+
+-- Маршрут вебхука и фоновых вызовов по integration_id/webhook_token к владельцу (а через него к шарду).
+-- Пишется integrations-create, удаляется integrations-purge; id интеграций уникальны между шардами
+-- за счет непересекающихся диапазонов последовательностей (shard_rebalance.py init-shard)
+CREATE TABLE t_p83864310_fintech_payment_reco.integration_routes (
+    integration_id INTEGER PRIMARY KEY,
+    owner_id INTEGER NOT NULL,
+    webhook_token VARCHAR(64) NOT NULL UNIQUE
+);
+
+INSERT INTO t_p83864310_fintech_payment_reco.integration_routes (integration_id, owner_id, webhook_token)
+SELECT id, owner_id, webhook_token FROM t_p83864310_fintech_payment_reco.user_integrations;
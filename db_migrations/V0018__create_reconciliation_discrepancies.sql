@@ -0,0 +1,52 @@
+-- Отчет о расхождениях сверки: платежи без чека, чеки без платежа, сопоставления с расхождением суммы.
+-- Строки пересчитываются по дням владельца: webhook-receive, ofd-fetch-receipts, reconciliation-match
+-- и integrations-purge помечают затронутые дни в reconciliation_dirty_days, пересчет идет после сверки
+-- и загрузки чеков (reconciliation-match, ofd-fetch-receipts). Чтение — reconciliation-report
+CREATE TABLE t_p83864310_fintech_payment_reco.reconciliation_discrepancies (
+    id BIGSERIAL PRIMARY KEY,
+    owner_id INTEGER NOT NULL,
+    integration_id INTEGER NOT NULL,
+    day DATE NOT NULL,
+    kind VARCHAR(20) NOT NULL,
+    direction VARCHAR(10) NOT NULL,
+    item_type VARCHAR(10) NOT NULL,
+    item_id INTEGER NOT NULL,
+    match_id INTEGER,
+    reference VARCHAR(255),
+    occurred_at TIMESTAMP NOT NULL,
+    amount_kopecks BIGINT NOT NULL,
+    difference_kopecks BIGINT NOT NULL DEFAULT 0,
+    CONSTRAINT reconciliation_discrepancies_kind CHECK (kind IN ('missing_receipt', 'missing_payment', 'amount_mismatch'))
+);
+
+-- Страницы отчета: keyset по (day, id) от новых к старым, с фильтром по типу или интеграции
+CREATE INDEX idx_reconciliation_discrepancies_page ON t_p83864310_fintech_payment_reco.reconciliation_discrepancies(owner_id, day DESC, id DESC);
+CREATE INDEX idx_reconciliation_discrepancies_kind ON t_p83864310_fintech_payment_reco.reconciliation_discrepancies(owner_id, kind, day DESC, id DESC);
+CREATE INDEX idx_reconciliation_discrepancies_integration ON t_p83864310_fintech_payment_reco.reconciliation_discrepancies(integration_id, day DESC, id DESC);
+
+-- Итоги по дню, интеграции и типу: сводка отчета за месяцы суммирует десятки строк, а не все расхождения
+CREATE TABLE t_p83864310_fintech_payment_reco.reconciliation_discrepancy_days (
+    owner_id INTEGER NOT NULL,
+    day DATE NOT NULL,
+    integration_id INTEGER NOT NULL,
+    kind VARCHAR(20) NOT NULL,
+    items INTEGER NOT NULL,
+    amount_kopecks BIGINT NOT NULL,
+    difference_kopecks BIGINT NOT NULL,
+    PRIMARY KEY (owner_id, day, integration_id, kind)
+);
+
+CREATE TABLE t_p83864310_fintech_payment_reco.reconciliation_dirty_days (
+    owner_id INTEGER NOT NULL,
+    day DATE NOT NULL,
+    marked_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (owner_id, day)
+);
+
+-- Существующие данные: все дни с платежами и чеками помечены, отчет заполнится при следующих пересчетах
+INSERT INTO t_p83864310_fintech_payment_reco.reconciliation_dirty_days (owner_id, day)
+SELECT owner_id, created_at::date FROM t_p83864310_fintech_payment_reco.webhook_payments
+WHERE status IN ('CONFIRMED', 'REFUNDED')
+UNION
+SELECT owner_id, doc_datetime::date FROM t_p83864310_fintech_payment_reco.ofd_receipts
+WHERE operation_type IN ('Income', 'RefundIncome') AND doc_datetime IS NOT NULL;
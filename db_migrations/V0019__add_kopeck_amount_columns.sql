@@ -0,0 +1,13 @@
+-- Денежные суммы в копейках (BIGINT): сверка, итоги и отчеты считают целыми числами, без DECIMAL и float.
+-- Колонки amount / total_sum / cash_sum / ecash_sum остаются и пишутся вместе с копейками
+-- для старых потребителей; читают и сравнивают функции только копейки.
+-- DEFAULT 0 у NOT NULL колонки — ADD COLUMN без перезаписи таблицы. Существующие строки миграция
+-- не заполняет: один UPDATE всей таблицы держал бы блокировки строк до конца транзакции миграции.
+-- Копейки заполняет scripts/backfill_kopecks.py порциями по id — после миграций и до выкладки функций
+ALTER TABLE t_p83864310_fintech_payment_reco.webhook_payments
+    ADD COLUMN amount_kopecks BIGINT NOT NULL DEFAULT 0;
+
+ALTER TABLE t_p83864310_fintech_payment_reco.ofd_receipts
+    ADD COLUMN total_kopecks BIGINT NOT NULL DEFAULT 0,
+    ADD COLUMN cash_kopecks BIGINT NOT NULL DEFAULT 0,
+    ADD COLUMN ecash_kopecks BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,35 @@
+-- Архив raw_data: старые payload переносятся scripts/raw_archive.py в сжатые сегменты (локальный диск
+-- или S3-совместимое хранилище), в строке остается указатель на блок сегмента и md5 payload.
+-- Читает архив функция raw-payload-fetch, когда открывают карточку платежа или чека.
+-- Новые колонки без DEFAULT — ALTER без перезаписи таблиц
+ALTER TABLE t_p83864310_fintech_payment_reco.webhook_payments
+    ALTER COLUMN raw_data DROP NOT NULL,
+    ADD COLUMN raw_archive_segment VARCHAR(255),
+    ADD COLUMN raw_archive_offset BIGINT,
+    ADD COLUMN raw_archive_length INTEGER,
+    ADD COLUMN raw_archive_md5 CHAR(32);
+
+-- is_correction и calculation_method заполняет архиватор из raw_data перед его удалением:
+-- список чеков показывает их без чтения архива
+ALTER TABLE t_p83864310_fintech_payment_reco.ofd_receipts
+    ADD COLUMN raw_archive_segment VARCHAR(255),
+    ADD COLUMN raw_archive_offset BIGINT,
+    ADD COLUMN raw_archive_length INTEGER,
+    ADD COLUMN raw_archive_md5 CHAR(32),
+    ADD COLUMN is_correction BOOLEAN,
+    ADD COLUMN calculation_method SMALLINT;
+
+-- Каталог сегментов: состав, сжатие и диапазон id. Строки ссылаются на сегмент по ключу объекта,
+-- поэтому перенос владельца между шардами (shard_rebalance) указатели не ломает
+CREATE TABLE t_p83864310_fintech_payment_reco.raw_archive_segments (
+    segment_key VARCHAR(255) PRIMARY KEY,
+    table_name VARCHAR(50) NOT NULL,
+    codec VARCHAR(10) NOT NULL,
+    row_count INTEGER NOT NULL,
+    block_count INTEGER NOT NULL,
+    raw_bytes BIGINT NOT NULL,
+    stored_bytes BIGINT NOT NULL,
+    min_id INTEGER NOT NULL,
+    max_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
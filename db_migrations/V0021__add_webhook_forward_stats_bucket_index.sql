@@ -0,0 +1,3 @@
+-- Срок хранения webhook_forward_stats: integrations-purge порциями удаляет корзины старше
+-- FORWARD_STATS_RETENTION_DAYS по bucket_start, индекс по владельцу для этого не подходит
+CREATE INDEX idx_webhook_forward_stats_bucket_start ON t_p83864310_fintech_payment_reco.webhook_forward_stats(bucket_start);
@@ -0,0 +1,5 @@
+-- Ключ идемпотентности отправки: notifications-dispatch сохраняет его на событиях сообщения до вызова
+-- send-message и при повторе отправляет те же события одним сообщением с тем же ключом,
+-- поэтому шлюз не дублирует сообщение, ушедшее до таймаута. NULL — событие еще не отправлялось
+ALTER TABLE t_p83864310_fintech_payment_reco.notification_outbox
+    ADD COLUMN dispatch_key VARCHAR(64);
@@ -0,0 +1,36 @@
+-- V0019 добавила копейки с DEFAULT 0. Строки, которые между миграцией и выкладкой функций записывает
+-- старый код (только amount / total_sum / cash_sum / ecash_sum), получают ноль в копейках.
+-- Триггер выводит копейки из рублевой колонки, пока ее пишет старый код; уже записанные строки
+-- заполняет scripts/backfill_kopecks.py порциями по id, с пометкой дней для отчета о расхождениях.
+-- Новый код пишет обе колонки, и триггер их не трогает
+CREATE FUNCTION t_p83864310_fintech_payment_reco.webhook_payments_derive_kopecks() RETURNS trigger AS $$
+BEGIN
+    IF NEW.amount_kopecks = 0 AND NEW.amount IS NOT NULL AND NEW.amount <> 0 THEN
+        NEW.amount_kopecks := ROUND(NEW.amount * 100)::bigint;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER webhook_payments_derive_kopecks
+    BEFORE INSERT OR UPDATE ON t_p83864310_fintech_payment_reco.webhook_payments
+    FOR EACH ROW EXECUTE FUNCTION t_p83864310_fintech_payment_reco.webhook_payments_derive_kopecks();
+
+CREATE FUNCTION t_p83864310_fintech_payment_reco.ofd_receipts_derive_kopecks() RETURNS trigger AS $$
+BEGIN
+    IF NEW.total_kopecks = 0 AND NEW.total_sum IS NOT NULL AND NEW.total_sum <> 0 THEN
+        NEW.total_kopecks := ROUND(NEW.total_sum * 100)::bigint;
+    END IF;
+    IF NEW.cash_kopecks = 0 AND NEW.cash_sum IS NOT NULL AND NEW.cash_sum <> 0 THEN
+        NEW.cash_kopecks := ROUND(NEW.cash_sum * 100)::bigint;
+    END IF;
+    IF NEW.ecash_kopecks = 0 AND NEW.ecash_sum IS NOT NULL AND NEW.ecash_sum <> 0 THEN
+        NEW.ecash_kopecks := ROUND(NEW.ecash_sum * 100)::bigint;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER ofd_receipts_derive_kopecks
+    BEFORE INSERT OR UPDATE ON t_p83864310_fintech_payment_reco.ofd_receipts
+    FOR EACH ROW EXECUTE FUNCTION t_p83864310_fintech_payment_reco.ofd_receipts_derive_kopecks();
@@ -0,0 +1,118 @@
+'''
+Заполнение копеек (amount_kopecks, total_kopecks, cash_kopecks, ecash_kopecks) из рублевых колонок
+у строк, записанных до V0019 или старым кодом после нее
+
+Миграции V0019 и V0023 только добавляют колонки и триггер: один UPDATE всей таблицы в транзакции
+миграции держал бы блокировки строк и раздувал таблицу до конца. Скрипт идет по id диапазонами
+по --batch-rows, каждый диапазон — своя короткая транзакция; дни исправленных строк помечаются
+в reconciliation_dirty_days для пересчета отчета о расхождениях. Повторный запуск безопасен: трогаются
+только строки с нулем в копейках и ненулевой суммой в рублях. Запускать после миграций и до выкладки
+функций, которые читают копейки. Шарды — DATABASE_URL и SHARD_DSNS, как у функций.
+
+    DATABASE_URL=postgres://... python scripts/backfill_kopecks.py
+    DATABASE_URL=postgres://... python scripts/backfill_kopecks.py --table receipts --batch-rows 5000 --pause 0.2
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+import psycopg2
+
+SCHEMA = 't_p83864310_fintech_payment_reco'
+
+# Таблица -> (колонка дня для отчета о расхождениях, SET, условие строки без копеек)
+BACKFILLS = {
+    'payments': ('webhook_payments', 'created_at', '''
+        amount_kopecks = ROUND(amount * 100)::bigint
+    ''', '''
+        amount_kopecks = 0 AND amount IS NOT NULL AND amount <> 0
+    '''),
+    'receipts': ('ofd_receipts', 'doc_datetime', '''
+        total_kopecks = CASE WHEN total_kopecks = 0 THEN ROUND(COALESCE(total_sum, 0) * 100)::bigint ELSE total_kopecks END,
+        cash_kopecks = CASE WHEN cash_kopecks = 0 THEN ROUND(COALESCE(cash_sum, 0) * 100)::bigint ELSE cash_kopecks END,
+        ecash_kopecks = CASE WHEN ecash_kopecks = 0 THEN ROUND(COALESCE(ecash_sum, 0) * 100)::bigint ELSE ecash_kopecks END
+    ''', '''
+        (total_kopecks = 0 AND COALESCE(total_sum, 0) <> 0)
+        OR (cash_kopecks = 0 AND COALESCE(cash_sum, 0) <> 0)
+        OR (ecash_kopecks = 0 AND COALESCE(ecash_sum, 0) <> 0)
+    ''')
+}
+
+def shard_dsns(only: str = None) -> Dict[str, str]:
+    dsns = {'main': os.environ['DATABASE_URL']}
+    dsns.update(json.loads(os.environ.get('SHARD_DSNS') or '{}'))
+    if only:
+        if only not in dsns:
+            sys.exit(f'shard {only} must be main or listed in SHARD_DSNS')
+        return {only: dsns[only]}
+    return dsns
+
+def selected_tables(name: str) -> List[str]:
+    return list(BACKFILLS) if name == 'all' else [name]
+
+def backfill_table(conn, shard: str, name: str, batch_rows: int, pause: float) -> Dict[str, int]:
+    table, day_column, set_sql, condition_sql = BACKFILLS[name]
+    cur = conn.cursor()
+    cur.execute(f'SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM {SCHEMA}.{table}')
+    min_id, max_id = cur.fetchone()
+    conn.commit()
+
+    totals = {'batches': 0, 'rows': 0, 'days': 0}
+    started = time.monotonic()
+    after_id = min_id - 1
+    while after_id < max_id:
+        upper_id = after_id + batch_rows
+        cur.execute(f'''
+            WITH fixed AS (
+                UPDATE {SCHEMA}.{table}
+                SET {set_sql}
+                WHERE id > %s AND id <= %s AND ({condition_sql})
+                RETURNING owner_id, {day_column}::date AS day
+            ), days AS (
+                INSERT INTO {SCHEMA}.reconciliation_dirty_days (owner_id, day)
+                SELECT DISTINCT owner_id, day FROM fixed WHERE day IS NOT NULL
+                ON CONFLICT (owner_id, day) DO NOTHING
+                RETURNING 1
+            )
+            SELECT (SELECT COUNT(*) FROM fixed), (SELECT COUNT(*) FROM days)
+        ''', (after_id, upper_id))
+        rows, days = cur.fetchone()
+        conn.commit()
+        after_id = upper_id
+        totals['batches'] += 1
+        totals['rows'] += rows
+        totals['days'] += days
+        if rows:
+            elapsed = time.monotonic() - started
+            print(f'[kopecks] {shard} {table}: id <= {upper_id}/{max_id}, {totals["rows"]} rows fixed, '
+                  f'{totals["rows"] / max(elapsed, 0.001):.0f} rows/s')
+        if pause:
+            time.sleep(pause)
+    return totals
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Заполнение копеек из рублевых колонок порциями по id')
+    parser.add_argument('--table', choices=['payments', 'receipts', 'all'], default='all')
+    parser.add_argument('--batch-rows', type=int, default=10000, help='ширина диапазона id на одну транзакцию')
+    parser.add_argument('--pause', type=float, default=0.0, help='пауза между порциями, секунд')
+    parser.add_argument('--shard', help='только этот шард (main или из SHARD_DSNS)')
+    args = parser.parse_args()
+    if args.batch_rows < 1:
+        parser.error('--batch-rows must be positive')
+
+    for shard, dsn in sorted(shard_dsns(args.shard).items()):
+        conn = psycopg2.connect(dsn)
+        try:
+            for name in selected_tables(args.table):
+                totals = backfill_table(conn, shard, name, args.batch_rows, args.pause)
+                print(f'{shard} {BACKFILLS[name][0]}: {totals["rows"]} rows fixed in {totals["batches"]} batches, '
+                      f'{totals["days"]} report days marked')
+        finally:
+            conn.close()
+    print('Report days are refreshed by the next reconciliation-match or ofd-fetch-receipts run')
+
+if __name__ == '__main__':
+    main()
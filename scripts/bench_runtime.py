@@ -0,0 +1,111 @@
+'''
+Бенчмарк холодного старта и сериализации ответов функций backend/*
+
+Холодный старт: каждая функция импортируется в отдельном свежем интерпретаторе, берется медиана.
+Сериализация: синтетические строки платежей (Decimal/datetime) старым способом
+(обход строк с float()/isoformat() + json.dumps) и через dumps() из payments-list.
+
+    python scripts/bench_runtime.py --runs 5 --rows 1000
+'''
+import argparse
+import importlib.util
+import json
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+
+IMPORT_SNIPPET = '''
+import importlib.util, sys, time
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location("fn_index", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print((time.perf_counter() - started) * 1000)
+'''
+
+def load_module(name: str):
+    spec = importlib.util.spec_from_file_location(f'{name.replace("-", "_")}_index', BACKEND_DIR / name / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def measure_import_ms(index_path: Path, runs: int):
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET, str(index_path)], capture_output=True, text=True)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+        samples.append(float(result.stdout.strip()))
+    return statistics.median(samples), None
+
+def make_rows(count: int):
+    now = datetime.now()
+    return [
+        (i, f'PAY-{i}', Decimal('1234.50') + i, f'ORDER-{i}', 'CONFIRMED', None, '0', 'a@b.ru', '+79990000000',
+         '430000******0777', 'Visa', '1230', 'TK', {'Amount': 123450 + i, 'Status': 'CONFIRMED'}, None,
+         now - timedelta(minutes=i), 'Терминал', 'Т-Банк')
+        for i in range(count)
+    ]
+
+def legacy_serialize(rows):
+    payments = []
+    for row in rows:
+        payments.append({
+            'id': row[0], 'payment_id': row[1], 'amount': float(row[2]) if row[2] else 0,
+            'order_id': row[3], 'status': row[4], 'payment_status': row[5], 'error_code': row[6],
+            'customer_email': row[7], 'customer_phone': row[8], 'pan': row[9], 'card_type': row[10],
+            'exp_date': row[11], 'terminal_key': row[12], 'raw_data': row[13], 'receipt_id': row[14],
+            'created_at': row[15].isoformat() if row[15] else None,
+            'integration_name': row[16], 'provider_name': row[17]
+        })
+    return json.dumps({'payments': payments})
+
+def runtime_serialize(module, rows):
+    payments = []
+    for row in rows:
+        payments.append({
+            'id': row[0], 'payment_id': row[1], 'amount': row[2] or 0,
+            'order_id': row[3], 'status': row[4], 'payment_status': row[5], 'error_code': row[6],
+            'customer_email': row[7], 'customer_phone': row[8], 'pan': row[9], 'card_type': row[10],
+            'exp_date': row[11], 'terminal_key': row[12], 'raw_data': row[13], 'receipt_id': row[14],
+            'created_at': row[15], 'integration_name': row[16], 'provider_name': row[17]
+        })
+    return module.dumps({'payments': payments})
+
+def time_it(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарк холодного старта и сериализации')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--rows', type=int, default=1000)
+    args = parser.parse_args()
+
+    print('== cold import (median ms)')
+    for index_path in sorted(BACKEND_DIR.glob('*/index.py')):
+        median_ms, error = measure_import_ms(index_path, args.runs)
+        label = index_path.parent.name
+        print(f'{label:28s} {median_ms:8.1f}' if error is None else f'{label:28s}   failed: {error}')
+
+    print(f'\n== serialization of {args.rows} payment rows (median ms)')
+    module = load_module('payments-list')
+    rows = make_rows(args.rows)
+    legacy_ms = time_it(lambda: legacy_serialize(rows), 20)
+    runtime_ms = time_it(lambda: runtime_serialize(module, rows), 20)
+    backend = 'orjson' if module.orjson is not None else 'json'
+    print(f'legacy (per-row conversion + json) {legacy_ms:8.2f}')
+    print(f'runtime dumps ({backend:6s})          {runtime_ms:8.2f}  x{legacy_ms / runtime_ms:.1f}')
+
+if __name__ == '__main__':
+    main()
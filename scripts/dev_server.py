@@ -0,0 +1,289 @@
+'''
+Локальный эмулятор функций: все backend/*/index.py в одном долгоживущем процессе
+
+Каждая функция доступна по пути /<имя из func2url.json>, HTTP-запрос превращается в event
+платформы (httpMethod, headers, queryStringParameters, body, isBase64Encoded, requestContext),
+handler выполняется в пуле потоков. psycopg2.connect внутри функций подменяется выдачей
+соединения из общего ThreadedConnectionPool, close() возвращает его в пул; когда пул занят,
+connect ждет освободившееся соединение (не дольше --timeout). Keep-alive соединение, простаивающее
+дольше --idle-timeout, закрывается и освобождает поток пула.
+
+    DATABASE_URL=postgres://... python scripts/dev_server.py --port 8000 --workers 16
+    curl 'http://127.0.0.1:8000/payments-list?owner_id=1'
+
+Режим self-hosted: --host 0.0.0.0 и workers под число соединений, которое выдержит БД.
+'''
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Dict
+from urllib.parse import parse_qs, urlsplit
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+BACKEND_DIR = ROOT_DIR / 'backend'
+
+class PooledConnection:
+    '''
+    Обертка соединения из пула: close() откатывает незавершенную транзакцию и возвращает соединение
+    '''
+    def __init__(self, pool, conn, slots: threading.BoundedSemaphore):
+        self._pool = pool
+        self._conn = conn
+        self._slots = slots
+        self._released = False
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        broken = bool(self._conn.closed)
+        if not broken:
+            try:
+                self._conn.rollback()
+                if self._conn.autocommit:
+                    self._conn.autocommit = False
+                self._conn.notifies.clear()
+            except Exception:
+                broken = True
+        try:
+            self._pool.putconn(self._conn, close=broken)
+        finally:
+            self._slots.release()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class PooledPsycopg2(ModuleType):
+    '''
+    Замена модуля psycopg2 для функций: connect() берет соединение из общего пула по DSN.
+    ThreadedConnectionPool при исчерпании сразу бросает PoolError, поэтому выдача ограничена семафором
+    на maxconn: connect ждет, пока другой запрос вернет соединение, но не дольше wait_seconds
+    '''
+    def __init__(self, real_module, maxconn: int, wait_seconds: float):
+        super().__init__('psycopg2')
+        self._real = real_module
+        self._maxconn = maxconn
+        self._wait_seconds = wait_seconds
+        self._pools: Dict[str, Any] = {}
+        self._slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _pool_for(self, dsn: str):
+        with self._lock:
+            if dsn not in self._pools:
+                import psycopg2.pool
+                self._pools[dsn] = psycopg2.pool.ThreadedConnectionPool(1, self._maxconn, dsn)
+                self._slots[dsn] = threading.BoundedSemaphore(self._maxconn)
+            return self._pools[dsn], self._slots[dsn]
+
+    def connect(self, dsn=None, **kwargs):
+        if dsn is None or kwargs:
+            return self._real.connect(dsn, **kwargs)
+        pool, slots = self._pool_for(dsn)
+        if not slots.acquire(timeout=self._wait_seconds):
+            raise self._real.OperationalError(f'connection pool exhausted: {self._maxconn} connections busy for {self._wait_seconds}s')
+        try:
+            conn = pool.getconn()
+        except Exception:
+            slots.release()
+            raise
+        return PooledConnection(pool, conn, slots)
+
+    def closeall(self):
+        for pool in self._pools.values():
+            pool.closeall()
+
+    def __getattr__(self, name):
+        return getattr(self._real, name)
+
+class Context:
+    '''
+    Минимальный context платформы для handler
+    '''
+    def __init__(self, function_name: str, timeout_seconds: int):
+        self.request_id = str(uuid.uuid4())
+        self.function_name = function_name
+        self.function_version = 'local'
+        self.memory_limit_in_mb = 128
+        self._deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+def load_functions(pooled_psycopg2) -> Dict[str, ModuleType]:
+    '''
+    Импорт всех функций, у которых есть index.py; имена — как в func2url.json
+    '''
+    functions = {}
+    for index_path in sorted(BACKEND_DIR.glob('*/index.py')):
+        name = index_path.parent.name
+        spec = importlib.util.spec_from_file_location(f'fn_{name.replace("-", "_")}', index_path)
+        module = importlib.util.module_from_spec(spec)
+        sys.path.insert(0, str(index_path.parent))
+        try:
+            spec.loader.exec_module(module)
+        except Exception as e:
+            print(f'[dev-server] skip {name}: {e}')
+            continue
+        finally:
+            sys.path.remove(str(index_path.parent))
+        if pooled_psycopg2 is not None and hasattr(module, 'psycopg2'):
+            module.psycopg2 = pooled_psycopg2
+        functions[name] = module
+    return functions
+
+def build_event(handler: BaseHTTPRequestHandler, body: bytes) -> Dict[str, Any]:
+    url = urlsplit(handler.path)
+    query = {key: values[-1] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+    try:
+        text_body, is_base64 = body.decode('utf-8'), False
+    except UnicodeDecodeError:
+        text_body, is_base64 = base64.b64encode(body).decode('ascii'), True
+
+    return {
+        'httpMethod': handler.command,
+        'path': url.path,
+        'headers': dict(handler.headers.items()),
+        'queryStringParameters': query,
+        'body': text_body,
+        'isBase64Encoded': is_base64,
+        'requestContext': {
+            'requestId': str(uuid.uuid4()),
+            'identity': {'sourceIp': handler.client_address[0]},
+            'httpMethod': handler.command
+        }
+    }
+
+def make_request_handler(functions: Dict[str, ModuleType], timeout_seconds: int, idle_timeout: float):
+    class FunctionRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Таймаут сокета: keep-alive соединение без нового запроса закрывается, поток пула освобождается
+        timeout = idle_timeout
+
+        def handle_any(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            name = urlsplit(self.path).path.strip('/').split('/')[0]
+
+            if name == '_health':
+                self.reply(200, {'Content-Type': 'application/json'}, json.dumps({'functions': sorted(functions)}).encode())
+                return
+
+            module = functions.get(name)
+            if module is None:
+                self.reply(404, {'Content-Type': 'application/json'}, json.dumps({'error': f'Unknown function: {name}'}).encode())
+                return
+
+            started = time.perf_counter()
+            try:
+                response = module.handler(build_event(self, body), Context(name, timeout_seconds))
+            except Exception:
+                traceback.print_exc()
+                self.reply(502, {'Content-Type': 'application/json'}, json.dumps({'error': 'Handler crashed'}).encode())
+                return
+
+            payload = response.get('body') or ''
+            if response.get('isBase64Encoded'):
+                data = base64.b64decode(payload)
+            else:
+                data = payload.encode('utf-8') if isinstance(payload, str) else json.dumps(payload).encode('utf-8')
+
+            status = response.get('statusCode', 200)
+            self.reply(status, response.get('headers') or {}, data)
+            print(f'[dev-server] {self.command} {self.path} -> {status} {(time.perf_counter() - started) * 1000:.1f}ms')
+
+        def reply(self, status: int, headers: Dict[str, str], data: bytes):
+            self.send_response(status)
+            for key, value in headers.items():
+                if key.lower() != 'content-length':
+                    self.send_header(key, str(value))
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = do_OPTIONS = handle_any
+
+        def log_message(self, format, *args):
+            pass
+
+    return FunctionRequestHandler
+
+class PoolHTTPServer(HTTPServer):
+    '''
+    HTTPServer, обрабатывающий соединения в фиксированном пуле потоков
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, handler_class, workers: int):
+        super().__init__(address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fn')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Локальный сервер всех функций backend')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=16, help='потоков обработки и соединений в пуле на DSN')
+    parser.add_argument('--timeout', type=int, default=30, help='таймаут функции в context и ожидания соединения из пула, сек')
+    parser.add_argument('--idle-timeout', type=float, default=5.0, help='закрывать keep-alive соединение после стольких секунд простоя')
+    parser.add_argument('--no-pool', action='store_true', help='не подменять psycopg2.connect пулом')
+    args = parser.parse_args()
+
+    pooled = None
+    if not args.no_pool:
+        try:
+            import psycopg2
+            pooled = PooledPsycopg2(psycopg2, args.workers, args.timeout)
+        except ImportError:
+            print('[dev-server] psycopg2 not installed, connection pool disabled')
+
+    functions = load_functions(pooled)
+    server = PoolHTTPServer((args.host, args.port), make_request_handler(functions, args.timeout, args.idle_timeout), args.workers)
+
+    print(f'[dev-server] http://{args.host}:{server.server_address[1]}/ workers={args.workers} '
+          f'pool={"on" if pooled else "off"} DATABASE_URL={"set" if os.environ.get("DATABASE_URL") else "unset"}')
+    for name in sorted(functions):
+        print(f'  /{name}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if pooled:
+            pooled.closeall()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+'''
+Сверка копий блока отчета о расхождениях (DISCREPANCY_REFRESH_MAX_DAYS, mark_dirty_days,
+refresh_discrepancies) в функциях reconciliation-match и ofd-fetch-receipts
+
+Общих модулей у функций нет, поэтому блок скопирован; правка одной копии без другой дает разный
+отчет в зависимости от того, какая функция пересчитала день.
+
+    python scripts/discrepancy_block_check.py
+'''
+import argparse
+import difflib
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+FUNCTIONS = ['reconciliation-match', 'ofd-fetch-receipts']
+BLOCK_START = '# Отчет о расхождениях:'
+# Конец refresh_discrepancies
+BLOCK_END = '    return len(days)\n'
+
+def discrepancy_block(function_name: str) -> str:
+    source = (BACKEND_DIR / function_name / 'index.py').read_text(encoding='utf-8')
+    start = source.index(BLOCK_START)
+    return source[start:source.index(BLOCK_END, start) + len(BLOCK_END)]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Сверка копий блока отчета о расхождениях')
+    parser.parse_args()
+
+    reference, *others = FUNCTIONS
+    expected = discrepancy_block(reference)
+    failed = False
+    for name in others:
+        actual = discrepancy_block(name)
+        if actual != expected:
+            failed = True
+            print(f'FAIL {name} differs from {reference}:')
+            sys.stdout.writelines(difflib.unified_diff(
+                expected.splitlines(keepends=True), actual.splitlines(keepends=True), reference, name))
+    if failed:
+        sys.exit('discrepancy block copies differ')
+    print(f"discrepancy block identical in {', '.join(FUNCTIONS)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+'''
+Проверка HttpClient функций ofd-fetch-receipts, webhook-receive, send-message, notifications-dispatch
+и ofd-sync-scheduler на локальной заглушке
+
+Клиент трех видов: full (повторы, gzip, token bucket на хост, метрики, deadline) — ofd-fetch-receipts,
+retry (повторы без gzip и token bucket) — send-message, single (одна попытка) — остальные функции.
+Заглушка (HTTP/1.1, keep-alive) считает TCP-соединения и POST и отдает: сжатый gzip JSON, ответы 503/429
+перед успехом, 404, соединение, закрытое сервером после ответа, медленный ответ. Каждая копия проходит
+проверки, подходящие ее виду; отдельно сверяется, что копии одного вида совпадают.
+
+    python scripts/http_client_check.py
+    python scripts/http_client_check.py --verbose
+'''
+import argparse
+import gzip
+import importlib.util
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+FUNCTIONS = {
+    'ofd-fetch-receipts': 'full',
+    'send-message': 'retry',
+    'webhook-receive': 'single',
+    'notifications-dispatch': 'single',
+    'ofd-sync-scheduler': 'single'
+}
+BLOCK_START = '# Исходящий HTTP:'
+
+# Похоже на ответ OFD: много однотипных чеков, gzip сжимает в разы
+RECEIPTS_BODY = json.dumps({'Status': 'Success', 'Data': [
+    {'Id': f'r-{i}', 'OperationType': 'Income', 'TotalSumm': 10000 + i, 'DocDateTime': '2024-05-01T10:00:00'}
+    for i in range(500)
+]}).encode('utf-8')
+
+def load_module(function_name: str):
+    spec = importlib.util.spec_from_file_location(function_name.replace('-', '_'), BACKEND_DIR / function_name / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def client_block(function_name: str) -> str:
+    '''
+    Блок от комментария BLOCK_START до конца класса HttpClient (первой строки без отступа после него)
+    '''
+    source = (BACKEND_DIR / function_name / 'index.py').read_text(encoding='utf-8')
+    start = source.index(BLOCK_START)
+    class_start = source.index('\nclass HttpClient', start) + 1
+    end = re.compile(r'^\S', re.M).search(source, source.index('\n', class_start) + 1).start()
+    return source[start:end].rstrip() + '\n'
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    posts = 0
+    flaky_calls: dict = {}
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with StubHandler.lock:
+            StubHandler.connections += 1
+
+    def reply(self, status: int, body: bytes, headers: dict = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.route()
+
+    def route(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        if parts.path == '/receipts':
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                self.reply(200, gzip.compress(RECEIPTS_BODY), {'Content-Encoding': 'gzip', 'Content-Type': 'application/json'})
+            else:
+                self.reply(200, RECEIPTS_BODY, {'Content-Type': 'application/json'})
+        elif parts.path == '/flaky':
+            key = query['key'][0]
+            with StubHandler.lock:
+                calls = StubHandler.flaky_calls[key] = StubHandler.flaky_calls.get(key, 0) + 1
+            if calls == 1:
+                self.reply(503, b'busy')
+            elif calls == 2:
+                self.reply(429, b'slow down', {'Retry-After': '0'})
+            else:
+                self.reply(200, b'ok')
+        elif parts.path == '/drop':
+            # Ответ без Connection: close, но сокет закрывается — клиент узнает об этом на следующем запросе
+            self.reply(200, b'dropped')
+            self.close_connection = True
+        elif parts.path == '/slow':
+            time.sleep(float(query.get('seconds', ['1'])[0]))
+            self.reply(503, b'late')
+        else:
+            self.reply(404, b'not found')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        with StubHandler.lock:
+            StubHandler.posts += 1
+        if urlsplit(self.path).path == '/post':
+            self.reply(503, b'busy')
+        else:
+            self.route()
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Клиент с истекшим deadline обрывает соединение посреди ответа — это и проверяется
+        pass
+
+def check(name: str, condition: bool, details: str, failures: list, verbose: bool) -> None:
+    if not condition:
+        failures.append(f'{name}: {details}')
+        print(f'FAIL {name}: {details}')
+    elif verbose:
+        print(f'ok   {name}: {details}')
+
+def run_checks(module, variant: str, base_url: str, label: str, failures: list, verbose: bool) -> None:
+    if variant == 'single':
+        client = module.HttpClient(timeout=5.0)
+    else:
+        client = module.HttpClient(timeout=5.0, max_attempts=3, backoff_base=0.05, backoff_max=0.2)
+    host = urlsplit(base_url).hostname
+
+    before = StubHandler.connections
+    for _ in range(5):
+        response = client.request('GET', f'{base_url}/receipts')
+    opened = StubHandler.connections - before
+    check(f'{label} keep-alive', opened == 1, f'5 requests, {opened} connections', failures, verbose)
+
+    if variant == 'full':
+        check(f'{label} reused metric', client.metrics[host]['reused'] == 4,
+              f'reused={client.metrics[host]["reused"]}', failures, verbose)
+        check(f'{label} gzip', response.body == RECEIPTS_BODY and response.wire_bytes < len(RECEIPTS_BODY) / 3,
+              f'{response.wire_bytes} bytes on wire, {len(response.body)} decoded', failures, verbose)
+
+    if variant == 'full':
+        response = client.request('GET', f'{base_url}/flaky?key={label}')
+        check(f'{label} retry 503/429', response.status == 200 and response.attempts == 3,
+              f'status={response.status}, attempts={response.attempts}', failures, verbose)
+    elif variant == 'retry':
+        response = client.request('POST', f'{base_url}/flaky?key={label}', body=b'{}',
+                                  headers={'Idempotency-Key': label})
+        check(f'{label} retry 503/429 with Idempotency-Key', response.status == 200 and response.attempts == 3,
+              f'status={response.status}, attempts={response.attempts}', failures, verbose)
+
+    try:
+        client.request('GET', f'{base_url}/missing')
+        check(f'{label} 404 not retried', False, 'no HttpError', failures, verbose)
+    except module.HttpError as e:
+        check(f'{label} 404 not retried', e.status == 404, f'status={e.status}', failures, verbose)
+
+    posts_before = StubHandler.posts
+    try:
+        client.request('POST', f'{base_url}/post', body=b'{}')
+        check(f'{label} POST not retried by default', False, 'no HttpError', failures, verbose)
+    except module.HttpError as e:
+        posts = StubHandler.posts - posts_before
+        check(f'{label} POST not retried by default', e.status == 503 and posts == 1,
+              f'status={e.status}, posts={posts}', failures, verbose)
+
+    client.request('GET', f'{base_url}/drop')
+    before = StubHandler.connections
+    response = client.request('GET', f'{base_url}/receipts')
+    opened = StubHandler.connections - before
+    check(f'{label} stale connection reopened', response.status == 200 and opened == 1,
+          f'status={response.status}, {opened} new connections', failures, verbose)
+
+    if variant != 'full':
+        return
+
+    limited = module.HttpClient(rate_per_host=20, burst=1)
+    started = time.monotonic()
+    for _ in range(11):
+        limited.request('GET', f'{base_url}/receipts')
+    elapsed = time.monotonic() - started
+    check(f'{label} token bucket', elapsed >= 0.45, f'11 requests at 20/s in {elapsed:.2f}s', failures, verbose)
+
+    started = time.monotonic()
+    try:
+        client.request('GET', f'{base_url}/slow?seconds=0.3', deadline=time.monotonic() + 0.5)
+    except (module.HttpError, OSError):
+        pass
+    elapsed = time.monotonic() - started
+    check(f'{label} deadline', elapsed < 0.9, f'gave up after {elapsed:.2f}s with 0.5s budget', failures, verbose)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Проверка HttpClient функций на локальной заглушке')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args()
+
+    failures: list = []
+    for variant in sorted(set(FUNCTIONS.values())):
+        names = [name for name, kind in FUNCTIONS.items() if kind == variant]
+        blocks = {client_block(name) for name in names}
+        check(f'{variant} copies identical', len(blocks) == 1, ', '.join(names), failures, args.verbose)
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    try:
+        for name, variant in FUNCTIONS.items():
+            run_checks(load_module(name), variant, base_url, name, failures, args.verbose)
+    finally:
+        server.shutdown()
+
+    if failures:
+        sys.exit(f'{len(failures)} checks failed')
+    print('all checks passed')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''
+Локальная заглушка шлюза мессенджеров для нагрузочных тестов send-message
+
+Запуск заглушки:
+    python scripts/messenger_stub.py --port 8765 --latency-ms 50 --fail-rate 0.05
+
+Замер пропускной способности пакетной отправки (заглушка поднимается в том же процессе):
+    python scripts/messenger_stub.py --bench 300 --latency-ms 50
+'''
+import argparse
+import importlib.util
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+
+def make_handler(latency_ms: int, fail_rate: float, throttle_rate: float):
+    class StubGatewayHandler(BaseHTTPRequestHandler):
+        received = 0
+        lock = threading.Lock()
+        # Idempotency-Key -> id сообщения: повтор с тем же ключом не доставляется второй раз
+        delivered = {}
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length) or b'{}')
+
+            with StubGatewayHandler.lock:
+                StubGatewayHandler.received += 1
+
+            if latency_ms:
+                time.sleep(latency_ms / 1000)
+
+            roll = random.random()
+            if roll < throttle_rate:
+                self.reply(429, {'error': 'Too many requests'})
+            elif roll < throttle_rate + fail_rate:
+                self.reply(503, {'error': 'Service unavailable'})
+            elif not self.headers.get('X-Api-Key'):
+                self.reply(401, {'error': 'X-Api-Key required'})
+            else:
+                key = self.headers.get('Idempotency-Key')
+                with StubGatewayHandler.lock:
+                    message_id = StubGatewayHandler.delivered.get(key) if key else None
+                    if message_id is None:
+                        message_id = str(uuid.uuid4())
+                        if key:
+                            StubGatewayHandler.delivered[key] = message_id
+                self.reply(200, {'id': message_id, 'provider': payload.get('provider')})
+
+        def reply(self, status: int, body: dict):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubGatewayHandler
+
+def load_send_message():
+    spec = importlib.util.spec_from_file_location('send_message_index', BACKEND_DIR / 'send-message' / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run_bench(server: ThreadingHTTPServer, count: int) -> None:
+    os.environ['MESSENGER_API_URL'] = f'http://127.0.0.1:{server.server_address[1]}/'
+    os.environ.setdefault('MESSENGER_API_KEY', 'stub-key')
+    send_message = load_send_message()
+
+    providers = list(send_message.PROVIDER_RATE_LIMITS.keys())
+    # Ключ идемпотентности, как у сообщений notifications-dispatch: без него send-message не повторяет отправку
+    messages = [
+        {'provider': providers[i % len(providers)], 'recipient': f'+7999{i:07d}', 'message': f'Тест #{i}',
+         'idempotency_key': f'bench-{i}'}
+        for i in range(count)
+    ]
+
+    started_at = time.monotonic()
+    response = send_message.handler({'httpMethod': 'POST', 'body': json.dumps({'messages': messages})}, None)
+    elapsed = time.monotonic() - started_at
+
+    body = json.loads(response['body'])
+    retried = sum(1 for r in body.get('results', []) if r.get('attempts', 0) > 1)
+    print(f"messages={count} sent={body.get('sent')} failed={body.get('failed')} retried={retried} "
+          f"gateway_requests={server.RequestHandlerClass.received} "
+          f"elapsed={elapsed:.2f}s throughput={count / elapsed:.1f} msg/s")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Заглушка шлюза мессенджеров')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency-ms', type=int, default=50)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='доля ответов 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--bench', type=int, default=0, help='отправить N сообщений через send-message и выйти')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(args.latency_ms, args.fail_rate, args.throttle_rate))
+
+    if args.bench:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            run_bench(server, args.bench)
+        finally:
+            server.shutdown()
+        return
+
+    print(f'Stub messenger gateway on http://127.0.0.1:{server.server_address[1]}/')
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
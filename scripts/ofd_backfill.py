@@ -0,0 +1,455 @@
+'''
+Загрузка истории чеков OFD.RU для владельца за длинный период (подключение нового клиента)
+
+Период каждой OFD-интеграции владельца режется на куски по --shard-days дней; куски загружаются
+пулом процессов (--workers). Каждый кусок — один запрос к OFD и одна транзакция: COPY во временную
+таблицу, upsert в ofd_receipts тем же правилом, что ofd-fetch-receipts (обновление только при
+изменении raw_data), отметка в ofd_sync_ranges и пометка дней для отчета о расхождениях.
+
+Прогресс пишется в файл контрольной точки после каждого куска; --resume продолжает с него после
+падения. Куски, уже покрытые ofd_sync_ranges, пропускаются и без файла (--force — загрузить заново).
+Лимит --rate (запросов в секунду к OFD) общий на все процессы: каждому достается rate / workers.
+HTTP — клиент функции ofd-fetch-receipts (HttpClient): keep-alive, gzip, повторы 429 и 5xx с паузой
+по Retry-After или экспоненциальной с джиттером.
+
+Платежи так не загрузить: они приходят только вебхуками, API выгрузки истории у провайдеров
+в проекте нет — для них есть scripts/replay_spool.py --capture.
+
+    DATABASE_URL=postgres://... python scripts/ofd_backfill.py run --owner-id 42 --date-from 2024-01-01 --date-to 2024-12-31
+    DATABASE_URL=postgres://... python scripts/ofd_backfill.py run --owner-id 42 --date-from 2024-01-01 --date-to 2024-12-31 --resume
+    python scripts/ofd_backfill.py status --checkpoint .ofd-backfill/owner-42-2024-01-01-2024-12-31.json
+'''
+import argparse
+import csv
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import psycopg2
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+HANDLER_PATH = ROOT_DIR / 'backend' / 'ofd-fetch-receipts' / 'index.py'
+SCHEMA = 't_p83864310_fintech_payment_reco'
+
+CHECKPOINT_DIR = Path('.ofd-backfill')
+FETCH_TIMEOUT_SECONDS = 60
+MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 2.0
+MAX_BACKOFF_SECONDS = 120.0
+
+STAGE_COLUMNS = [
+    'receipt_id', 'operation_type', 'total_kopecks', 'cash_kopecks', 'ecash_kopecks',
+    'doc_number', 'doc_datetime', 'fn_number', 'raw_data'
+]
+
+def load_module():
+    spec = importlib.util.spec_from_file_location('ofd_fetch_receipts', HANDLER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def split_period(date_from: date, date_to: date, shard_days: int) -> List[Tuple[date, date]]:
+    '''
+    Куски [from, to] по shard_days дней включительно; последний может быть короче
+    '''
+    shards = []
+    current = date_from
+    while current <= date_to:
+        end = min(current + timedelta(days=shard_days - 1), date_to)
+        shards.append((current, end))
+        current = end + timedelta(days=1)
+    return shards
+
+def shard_key(integration_id: int, shard_from: date) -> str:
+    return f'{integration_id}:{shard_from.isoformat()}'
+
+class Checkpoint:
+    '''
+    Файл прогресса: параметры задания, готовые куски со статистикой и ошибки.
+    Пишет только родительский процесс, через временный файл и os.replace — файл всегда целый
+    '''
+    def __init__(self, path: Path, job: Dict[str, Any]):
+        self.path = path
+        self.data = {'job': job, 'done': {}, 'failed': {}}
+
+    @classmethod
+    def load(cls, path: Path) -> 'Checkpoint':
+        checkpoint = cls(path, {})
+        checkpoint.data = json.loads(path.read_text(encoding='utf-8'))
+        return checkpoint
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self.data, ensure_ascii=False, indent=1), encoding='utf-8')
+        os.replace(tmp_path, self.path)
+
+    def mark_done(self, key: str, stats: Dict[str, Any]) -> None:
+        self.data['done'][key] = stats
+        self.data['failed'].pop(key, None)
+        self.save()
+
+    def mark_failed(self, key: str, error: str) -> None:
+        self.data['failed'][key] = error
+        self.save()
+
+# Состояние процесса пула: модуль функции, соединение с шардом и HTTP-клиент, создаются один раз
+_worker: Dict[str, Any] = {}
+
+def init_worker(dsn: str, rate_per_worker: float) -> None:
+    module = load_module()
+    _worker['module'] = module
+    _worker['conn'] = psycopg2.connect(dsn)
+    # Клиент функции (keep-alive, gzip, повторы 429/5xx с Retry-After); token bucket без запаса —
+    # ровно rate_per_worker запросов в секунду на процесс
+    _worker['http'] = module.HttpClient(
+        timeout=FETCH_TIMEOUT_SECONDS,
+        max_attempts=MAX_ATTEMPTS,
+        backoff_base=BACKOFF_BASE_SECONDS,
+        backoff_max=MAX_BACKOFF_SECONDS,
+        rate_per_host=rate_per_worker,
+        burst=1
+    )
+
+def fetch_receipts(config: Dict[str, Any], range_from: datetime, range_to: datetime) -> Tuple[List[Dict[str, Any]], int]:
+    '''
+    Чеки ККТ за интервал; повторы при 429/5xx и сетевых ошибках — в HttpClient
+    Returns: (чеки, байт получено по сети)
+    '''
+    api_url = config.get('api_url', 'https://ofd.ru')
+    url = f"{api_url}/api/integration/v2/inn/{config['inn']}/kkt/{config['kkt']}/receipts-with-fpd-short"
+    params = urllib.parse.urlencode({
+        'dateFrom': range_from.strftime('%Y-%m-%dT%H:%M:%S'),
+        'dateTo': range_to.strftime('%Y-%m-%dT%H:%M:%S'),
+        'AuthToken': config['auth_token']
+    })
+
+    try:
+        response = _worker['http'].request('GET', f'{url}?{params}')
+    except _worker['module'].HttpError as e:
+        raise RuntimeError(f'OFD HTTP {e.status}: {e.body[:300].decode("utf-8", "replace")}')
+    data = json.loads(response.body.decode('utf-8'))
+    if isinstance(data, dict) and data.get('Status') == 'Failed':
+        raise RuntimeError(f"OFD API returned error: {data.get('Errors', [])}")
+    receipts = (data.get('Data') or []) if isinstance(data, dict) else data
+    return receipts, response.wire_bytes
+
+def copy_receipts(cur, integration_id: int, owner_id: int,
+                  receipts: List[Dict[str, Any]]) -> Tuple[int, int, set, List[Dict[str, Any]]]:
+    '''
+    COPY чеков во временную таблицу и один upsert из нее в ofd_receipts.
+    Чеки проверяет receipt_row функции ofd-fetch-receipts: некорректный пропускается, а не обрывает COPY
+    Returns: (вставлено, обновлено, дни затронутых чеков, пропущенные чеки)
+    '''
+    module = _worker['module']
+    receipt_row = module.receipt_row
+    # Один чек может повториться на стыке кусков внутри ответа; ключ конфликта в одном INSERT — один раз
+    rows = {}
+    skipped = []
+    for receipt in receipts:
+        try:
+            row = receipt_row(integration_id, owner_id, receipt)
+        except ValueError as e:
+            skipped.append(module.skipped_receipt(receipt, e))
+            continue
+        rows[row[2]] = (row, receipt)
+    if skipped:
+        print(f'[DEBUG] integration {integration_id}: skipped {len(skipped)} malformed receipts: {skipped[:20]}')
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for receipt_id, (row, receipt) in rows.items():
+        writer.writerow([
+            receipt_id,
+            row[3] or '',
+            row[4],
+            row[5],
+            row[6],
+            row[10] or '',
+            row[11] or '',
+            row[12] or '',
+            json.dumps(receipt, ensure_ascii=False)
+        ])
+    buffer.seek(0)
+
+    cur.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS ofd_backfill_stage (
+            receipt_id VARCHAR(255), operation_type VARCHAR(50),
+            total_kopecks BIGINT, cash_kopecks BIGINT, ecash_kopecks BIGINT,
+            doc_number VARCHAR(50), doc_datetime TIMESTAMP, fn_number VARCHAR(50), raw_data JSONB
+        ) ON COMMIT DELETE ROWS
+    ''')
+    cur.copy_expert(
+        f"COPY ofd_backfill_stage ({', '.join(STAGE_COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '')",
+        buffer
+    )
+    cur.execute(f'''
+        INSERT INTO {SCHEMA}.ofd_receipts AS r (
+            integration_id, owner_id, receipt_id, operation_type,
+            total_kopecks, cash_kopecks, ecash_kopecks,
+            total_sum, cash_sum, ecash_sum, doc_number, doc_datetime,
+            fn_number, raw_data
+        )
+        SELECT %s, %s, receipt_id, operation_type,
+               total_kopecks, cash_kopecks, ecash_kopecks,
+               total_kopecks / 100.0, cash_kopecks / 100.0, ecash_kopecks / 100.0, doc_number, doc_datetime,
+               fn_number, raw_data
+        FROM ofd_backfill_stage
+        ON CONFLICT (integration_id, receipt_id) DO UPDATE SET
+            operation_type = EXCLUDED.operation_type,
+            total_kopecks = EXCLUDED.total_kopecks,
+            cash_kopecks = EXCLUDED.cash_kopecks,
+            ecash_kopecks = EXCLUDED.ecash_kopecks,
+            total_sum = EXCLUDED.total_sum,
+            cash_sum = EXCLUDED.cash_sum,
+            ecash_sum = EXCLUDED.ecash_sum,
+            doc_number = EXCLUDED.doc_number,
+            doc_datetime = EXCLUDED.doc_datetime,
+            fn_number = EXCLUDED.fn_number,
+            raw_data = EXCLUDED.raw_data,
+            raw_archive_segment = NULL,
+            raw_archive_offset = NULL,
+            raw_archive_length = NULL,
+            raw_archive_md5 = NULL,
+            updated_at = NOW()
+        -- Чек с raw_data в архиве (scripts/raw_archive.py) сравнивается по md5, иначе повторная загрузка вернула бы его в таблицу
+        WHERE CASE WHEN r.raw_data IS NULL AND r.raw_archive_md5 IS NOT NULL
+                   THEN r.raw_archive_md5 <> md5(EXCLUDED.raw_data::text)
+                   ELSE r.raw_data IS DISTINCT FROM EXCLUDED.raw_data END
+        RETURNING (xmax = 0), doc_datetime::date
+    ''', (integration_id, owner_id))
+    result = cur.fetchall()
+    inserted = sum(1 for (is_new, _) in result if is_new)
+    return inserted, len(result) - inserted, {day for (_, day) in result if day is not None}, skipped
+
+def load_shard(task: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Один кусок в процессе пула: запрос к OFD, COPY, отметка ofd_sync_ranges — одна транзакция
+    '''
+    module = _worker['module']
+    conn = _worker['conn']
+    started = time.perf_counter()
+    range_from = datetime.fromisoformat(task['from'])
+    range_to = datetime.fromisoformat(task['to']).replace(hour=23, minute=59, second=59)
+
+    receipts, bytes_received = fetch_receipts(task['config'], range_from, range_to)
+
+    cur = conn.cursor()
+    try:
+        inserted, updated, days, skipped = copy_receipts(cur, task['integration_id'], task['owner_id'], receipts)
+        # Хвост моложе OFD_SYNC_LAG_MINUTES OFD еще может дослать — его не отмечаем, как и ofd-fetch-receipts
+        covered_until = min(range_to, datetime.now() - timedelta(minutes=module.SYNC_LAG_MINUTES))
+        # Дни пропущенных чеков не отмечаются: следующий запуск или ofd-fetch-receipts запросит их снова
+        if covered_until > range_from:
+            for synced_from, synced_to in module.synced_ranges(range_from, covered_until, skipped):
+                module.record_synced_range(cur, task['integration_id'], str(task['config']['kkt']), synced_from, synced_to)
+        module.mark_dirty_days(cur, task['owner_id'], days)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    return {
+        'receipts': len(receipts),
+        'inserted': inserted,
+        'updated': updated,
+        'skipped': len(skipped),
+        'bytes': bytes_received,
+        'seconds': round(time.perf_counter() - started, 2)
+    }
+
+def owner_integrations(cur, owner_id: int, integration_ids: Optional[List[int]]) -> List[Tuple[int, Dict[str, Any]]]:
+    cur.execute(f'''
+        SELECT ui.id, ui.config
+        FROM {SCHEMA}.user_integrations ui
+        JOIN {SCHEMA}.integration_providers p ON p.id = ui.provider_id
+        WHERE ui.owner_id = %s AND ui.status = 'active' AND p.slug = 'ofdru'
+        ORDER BY ui.id
+    ''', (owner_id,))
+    integrations = []
+    for integration_id, config in cur.fetchall():
+        config = json.loads(config) if isinstance(config, str) else (config or {})
+        if integration_ids and integration_id not in integration_ids:
+            continue
+        if not all([config.get('inn'), config.get('kkt'), config.get('auth_token')]):
+            print(f'[backfill] integration {integration_id}: no INN, KKT or auth_token in config, skipped')
+            continue
+        integrations.append((integration_id, config))
+    return integrations
+
+def covered_shard(cur, integration_id: int, kkt: str, shard_from: date, shard_to: date) -> bool:
+    '''
+    Кусок целиком внутри уже загруженного интервала ofd_sync_ranges
+    '''
+    cur.execute(f'''
+        SELECT 1 FROM {SCHEMA}.ofd_sync_ranges
+        WHERE integration_id = %s AND kkt = %s AND range_from <= %s AND range_to >= %s
+        LIMIT 1
+    ''', (integration_id, kkt, datetime.combine(shard_from, datetime.min.time()),
+          datetime.combine(shard_to, datetime.max.time()).replace(microsecond=0)))
+    return cur.fetchone() is not None
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    return f'{seconds // 60}m{seconds % 60:02d}s'
+
+def run(args) -> None:
+    date_from = date.fromisoformat(args.date_from)
+    date_to = date.fromisoformat(args.date_to)
+    if date_to < date_from:
+        sys.exit('--date-to is before --date-from')
+
+    checkpoint_path = Path(args.checkpoint) if args.checkpoint else \
+        CHECKPOINT_DIR / f'owner-{args.owner_id}-{date_from}-{date_to}.json'
+    job = {'owner_id': args.owner_id, 'date_from': args.date_from, 'date_to': args.date_to,
+           'shard_days': args.shard_days, 'integration_ids': args.integration_id or []}
+    if args.resume and checkpoint_path.exists():
+        checkpoint = Checkpoint.load(checkpoint_path)
+        if checkpoint.data['job'] != job:
+            sys.exit(f'{checkpoint_path} belongs to another job: {checkpoint.data["job"]}')
+        print(f"[backfill] resuming: {len(checkpoint.data['done'])} shards done, {len(checkpoint.data['failed'])} failed")
+    elif checkpoint_path.exists() and not args.resume:
+        sys.exit(f'{checkpoint_path} exists, use --resume or --checkpoint')
+    else:
+        checkpoint = Checkpoint(checkpoint_path, job)
+        checkpoint.save()
+
+    module = load_module()
+    try:
+        conn = module.get_connection(args.owner_id, write=True)
+    except module.ShardMovingError as e:
+        sys.exit(str(e))
+    shard, _ = module.resolve_shard(args.owner_id)
+    dsn = module.shard_dsn(shard)
+
+    cur = conn.cursor()
+    integrations = owner_integrations(cur, args.owner_id, args.integration_id)
+    if not integrations:
+        sys.exit(f'owner {args.owner_id} has no active OFD integrations with credentials')
+
+    tasks = []
+    skipped_covered = 0
+    for integration_id, config in integrations:
+        for shard_from, shard_to in split_period(date_from, date_to, args.shard_days):
+            key = shard_key(integration_id, shard_from)
+            if key in checkpoint.data['done']:
+                continue
+            if not args.force and covered_shard(cur, integration_id, str(config['kkt']), shard_from, shard_to):
+                skipped_covered += 1
+                continue
+            tasks.append({
+                'key': key,
+                'integration_id': integration_id,
+                'owner_id': args.owner_id,
+                'config': config,
+                'from': shard_from.isoformat(),
+                'to': shard_to.isoformat()
+            })
+    conn.commit()
+
+    print(f'[backfill] owner {args.owner_id} on {shard}: {len(integrations)} integrations, {len(tasks)} shards to load, '
+          f'{skipped_covered} already covered, workers={args.workers}, rate={args.rate}/s')
+    if args.dry_run or not tasks:
+        conn.close()
+        return
+
+    started = time.monotonic()
+    completed = 0
+    failed = 0
+    rows = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                             initargs=(dsn, args.rate / args.workers)) as pool:
+        futures = {pool.submit(load_shard, task): task for task in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                stats = future.result()
+            except Exception as e:
+                failed += 1
+                checkpoint.mark_failed(task['key'], str(e))
+                print(f"[backfill] {task['key']}: FAILED {e}")
+                continue
+
+            checkpoint.mark_done(task['key'], stats)
+            completed += 1
+            rows += stats['receipts']
+            elapsed = time.monotonic() - started
+            remaining = len(tasks) - completed - failed
+            eta = elapsed / (completed + failed) * remaining
+            print(f"[backfill] {task['key']}..{task['to']}: {stats['receipts']} receipts "
+                  f"(+{stats['inserted']} ~{stats['updated']} !{stats['skipped']}) in {stats['seconds']}s | "
+                  f"{completed + failed}/{len(tasks)} shards, {rows / elapsed:.0f} rows/s, ETA {format_duration(eta)}")
+
+    # Отчет о расхождениях — по всем помеченным дням владельца, порциями функции
+    refreshed = 0
+    while True:
+        days = module.refresh_discrepancies(cur, args.owner_id)
+        conn.commit()
+        refreshed += days
+        if days == 0:
+            break
+    cur.execute("SELECT pg_notify('owner_events', %s)", (json.dumps({
+        'type': 'receipts', 'owner_id': args.owner_id, 'backfill': True, 'receipts': rows
+    }),))
+    conn.commit()
+    conn.close()
+
+    elapsed = time.monotonic() - started
+    print(f'[backfill] done in {format_duration(elapsed)}: {completed} shards, {rows} receipts, '
+          f'{rows / max(elapsed, 0.001):.0f} rows/s, {refreshed} report days refreshed, {failed} failed')
+    if failed:
+        sys.exit(f'{failed} shards failed, rerun with --resume')
+
+def status(args) -> None:
+    checkpoint = Checkpoint.load(Path(args.checkpoint))
+    job = checkpoint.data['job']
+    done = checkpoint.data['done']
+    print(f"owner {job['owner_id']} {job['date_from']}..{job['date_to']} by {job['shard_days']}d")
+    print(f"  done:   {len(done)} shards, {sum(s['receipts'] for s in done.values())} receipts, "
+          f"{sum(s['bytes'] for s in done.values()) / 1024 / 1024:.1f} MB")
+    print(f"  failed: {len(checkpoint.data['failed'])}")
+    for key, error in sorted(checkpoint.data['failed'].items()):
+        print(f'    {key}: {error}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Загрузка истории чеков OFD.RU пулом процессов с контрольными точками')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='загрузить период для владельца')
+    run_parser.add_argument('--owner-id', type=int, required=True)
+    run_parser.add_argument('--integration-id', type=int, action='append', help='только эти интеграции (можно несколько)')
+    run_parser.add_argument('--date-from', required=True, help='YYYY-MM-DD')
+    run_parser.add_argument('--date-to', required=True, help='YYYY-MM-DD, включительно')
+    run_parser.add_argument('--shard-days', type=int, default=7, help='дней в одном запросе к OFD (1 — по дням)')
+    run_parser.add_argument('--workers', type=int, default=4)
+    run_parser.add_argument('--rate', type=float, default=2.0, help='запросов к OFD в секунду на все процессы')
+    run_parser.add_argument('--checkpoint', help=f'файл прогресса, по умолчанию {CHECKPOINT_DIR}/owner-<id>-<from>-<to>.json')
+    run_parser.add_argument('--resume', action='store_true', help='продолжить по файлу прогресса')
+    run_parser.add_argument('--force', action='store_true', help='загрузить и уже покрытые ofd_sync_ranges куски')
+    run_parser.add_argument('--dry-run', action='store_true', help='только посчитать куски')
+
+    status_parser = commands.add_parser('status', help='прогресс по файлу контрольной точки')
+    status_parser.add_argument('--checkpoint', required=True)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        if args.shard_days < 1 or args.workers < 1 or args.rate <= 0:
+            parser.error('--shard-days, --workers and --rate must be positive')
+        run(args)
+    else:
+        status(args)
+
+if __name__ == '__main__':
+    main()
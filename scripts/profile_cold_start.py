@@ -0,0 +1,169 @@
+'''
+Профиль холодного старта функций backend/*/index.py
+
+Для каждой функции в свежем интерпретаторе с -X importtime замеряется:
+  import_ms        — импорт index.py целиком
+  psycopg2_ms      — из него импорт psycopg2
+  connect_ms       — psycopg2.connect(DATABASE_URL), если переменная задана
+  first_invoke_ms  — первый вызов handler (GET-кейс из tests.json при наличии БД, иначе OPTIONS)
+  warm_invoke_ms   — повторный такой же вызов
+и разбивка импорта по пакетам верхнего уровня (cumulative, как в -X importtime).
+
+    python scripts/profile_cold_start.py                    # таблица по всем функциям
+    python scripts/profile_cold_start.py webhook-receive -v # с разбивкой импорта
+    python scripts/profile_cold_start.py --check            # exit 1, если превышен бюджет
+
+Бюджеты — scripts/cold_start_budget.json (default + переопределения по функциям).
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+BACKEND_DIR = ROOT_DIR / 'backend'
+BUDGET_PATH = Path(__file__).resolve().parent / 'cold_start_budget.json'
+
+CHILD_SNIPPET = r'''
+import importlib.util, os, sys, time
+index_path, event_json = sys.argv[1], sys.argv[2]
+result = {}
+
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location("fn_index", index_path)
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+result["import_ms"] = (time.perf_counter() - started) * 1000
+
+import json
+
+psycopg2 = sys.modules.get("psycopg2")
+if psycopg2 is not None and os.environ.get("DATABASE_URL"):
+    started = time.perf_counter()
+    psycopg2.connect(os.environ["DATABASE_URL"]).close()
+    result["connect_ms"] = (time.perf_counter() - started) * 1000
+
+event = json.loads(event_json)
+for key in ("first_invoke_ms", "warm_invoke_ms"):
+    started = time.perf_counter()
+    response = module.handler(dict(event), None)
+    result[key] = (time.perf_counter() - started) * 1000
+    result["status_code"] = response.get("statusCode")
+
+print("@@RESULT@@" + json.dumps(result))
+'''
+
+def build_event(function_dir: Path, with_db: bool) -> Dict[str, Any]:
+    '''
+    Событие первого вызова: безопасный GET из tests.json, если есть БД, иначе OPTIONS
+    '''
+    if with_db:
+        tests_path = function_dir / 'tests.json'
+        tests = json.loads(tests_path.read_text()).get('tests', []) if tests_path.exists() else []
+        for test in tests:
+            if test.get('method') == 'GET':
+                path = test.get('path', '/')
+                query = path.split('?', 1)[1] if '?' in path else ''
+                params = dict(pair.split('=', 1) for pair in query.split('&') if '=' in pair)
+                return {'httpMethod': 'GET', 'queryStringParameters': params, 'headers': {}, 'body': ''}
+    return {'httpMethod': 'OPTIONS', 'queryStringParameters': {}, 'headers': {}, 'body': ''}
+
+def parse_importtime(stderr: str) -> List[Dict[str, Any]]:
+    '''
+    Строки "import time: self [us] | cumulative | package" -> пакеты верхнего уровня
+    '''
+    packages = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if name.startswith('  '):
+            continue
+        packages.append({'package': name.strip(), 'self_ms': int(self_us) / 1000, 'cumulative_ms': int(cumulative_us) / 1000})
+    return packages
+
+def profile_function(function_dir: Path) -> Dict[str, Any]:
+    with_db = bool(os.environ.get('DATABASE_URL'))
+    event = build_event(function_dir, with_db)
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD_SNIPPET, str(function_dir / 'index.py'), json.dumps(event)],
+        capture_output=True, text=True, cwd=function_dir
+    )
+
+    marker = next((line for line in completed.stdout.splitlines() if line.startswith('@@RESULT@@')), None)
+    if completed.returncode != 0 or marker is None:
+        tail = completed.stderr.strip().splitlines()
+        return {'function': function_dir.name, 'error': tail[-1] if tail else f'exit code {completed.returncode}'}
+
+    result = json.loads(marker[len('@@RESULT@@'):])
+    packages = parse_importtime(completed.stderr)
+    psycopg2_entry = next((p for p in packages if p['package'] == 'psycopg2'), None)
+    result['psycopg2_ms'] = psycopg2_entry['cumulative_ms'] if psycopg2_entry else 0.0
+    result['packages'] = sorted(packages, key=lambda p: p['cumulative_ms'], reverse=True)
+    result['function'] = function_dir.name
+    result['event'] = event['httpMethod']
+    return result
+
+def budget_for(budgets: Dict[str, Any], name: str) -> Dict[str, float]:
+    return {**budgets.get('default', {}), **budgets.get('functions', {}).get(name, {})}
+
+def check_budget(result: Dict[str, Any], budget: Dict[str, float]) -> List[str]:
+    violations = []
+    for metric, limit in budget.items():
+        value: Optional[float] = result.get(metric)
+        if value is not None and value > limit:
+            violations.append(f'{metric}={value:.1f} > {limit}')
+    return violations
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Профиль холодного старта функций')
+    parser.add_argument('functions', nargs='*', help='имена функций (по умолчанию все)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='разбивка импорта по пакетам')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--check', action='store_true', help='проверить бюджеты, exit 1 при превышении')
+    parser.add_argument('--json', action='store_true', help='вывести результат в JSON')
+    args = parser.parse_args()
+
+    budgets = json.loads(BUDGET_PATH.read_text())
+    function_dirs = sorted(p.parent for p in BACKEND_DIR.glob('*/index.py'))
+    if args.functions:
+        function_dirs = [d for d in function_dirs if d.name in args.functions]
+
+    results = [profile_function(d) for d in function_dirs]
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print(f'{"function":26s} {"event":8s} {"import":>8s} {"psycopg2":>9s} {"connect":>8s} {"first":>8s} {"warm":>8s}')
+        for result in results:
+            if 'error' in result:
+                print(f'{result["function"]:26s} failed: {result["error"]}')
+                continue
+            connect = f'{result["connect_ms"]:8.1f}' if 'connect_ms' in result else f'{"-":>8s}'
+            print(f'{result["function"]:26s} {result["event"]:8s} {result["import_ms"]:8.1f} {result["psycopg2_ms"]:9.1f} '
+                  f'{connect} {result["first_invoke_ms"]:8.1f} {result["warm_invoke_ms"]:8.1f}')
+            if args.verbose:
+                for package in result['packages'][:args.top]:
+                    print(f'    {package["cumulative_ms"]:8.1f} ms  {package["package"]}')
+
+    failed = False
+    if args.check:
+        for result in results:
+            if 'error' in result:
+                print(f'FAIL {result["function"]}: {result["error"]}')
+                failed = True
+                continue
+            violations = check_budget(result, budget_for(budgets, result['function']))
+            if violations:
+                print(f'FAIL {result["function"]}: ' + ', '.join(violations))
+                failed = True
+        if not failed:
+            print('All functions within cold start budget')
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
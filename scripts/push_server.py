@@ -0,0 +1,330 @@
+'''
+Push-сервер событий владельца: LISTEN owner_events -> SSE-подписчики по owner_id
+
+Функции пишут события через pg_notify('owner_events', {"type", "owner_id", ...}):
+webhook-receive — payment и forward_log, ofd-fetch-receipts — receipts.
+Сервер держит по соединению LISTEN на основную БД и каждый шард (SHARD_DSNS)
+и раздает события подписчикам своего владельца.
+У каждого подключения ограниченная очередь: медленный клиент не копит память,
+при переполнении очередь сбрасывается и клиент получает событие resync (перечитать данные).
+
+    DATABASE_URL=postgres://... python scripts/push_server.py serve --port 8010
+    python scripts/push_server.py client --url http://127.0.0.1:8010 --owner-id 1
+    DATABASE_URL=postgres://... python scripts/push_server.py publish --owner-id 1 --type payment
+
+Без БД: serve --no-listen --allow-publish и publish --url http://127.0.0.1:8010
+В браузере: VITE_PUSH_URL=http://127.0.0.1:8010 (хук src/hooks/use-owner-events.ts)
+'''
+import argparse
+import itertools
+import json
+import os
+import queue
+import select
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Set
+from urllib.parse import parse_qs, urlsplit
+
+EVENTS_CHANNEL = 'owner_events'
+HEARTBEAT_SECONDS = 15
+RECONNECT_DELAY_SECONDS = 2
+
+class Subscriber:
+    '''
+    Подключение клиента: фильтр типов и ограниченная очередь событий
+    '''
+    def __init__(self, owner_id: str, types: Optional[Set[str]], buffer_size: int):
+        self.owner_id = owner_id
+        self.types = types
+        self.events: 'queue.Queue[Dict[str, Any]]' = queue.Queue(maxsize=buffer_size)
+        self.dropped = 0
+        # publish вызывается из потоков LISTEN всех шардов: без блокировки чужой put_nowait мог занять
+        # место между очисткой очереди и записью resync, и queue.Full уходил в listen_forever
+        self._offer_lock = threading.Lock()
+
+    def offer(self, event: Dict[str, Any]) -> None:
+        if self.types and event.get('type') not in self.types:
+            return
+        with self._offer_lock:
+            try:
+                self.events.put_nowait(event)
+            except queue.Full:
+                # Клиент не успевает: отдельные события уже потеряны, проще попросить его перечитать состояние
+                self.dropped += self.events.qsize()
+                while True:
+                    try:
+                        self.events.get_nowait()
+                    except queue.Empty:
+                        break
+                self.events.put_nowait({'type': 'resync', 'owner_id': self.owner_id, 'dropped': self.dropped})
+
+class Hub:
+    '''
+    Топики по owner_id: publish раздает событие только подписчикам этого владельца
+    '''
+    def __init__(self):
+        self._topics: Dict[str, Set[Subscriber]] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.published = 0
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            self._topics.setdefault(subscriber.owner_id, set()).add(subscriber)
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            topic = self._topics.get(subscriber.owner_id)
+            if topic:
+                topic.discard(subscriber)
+                if not topic:
+                    del self._topics[subscriber.owner_id]
+
+    def publish(self, event: Dict[str, Any]) -> int:
+        owner_id = str(event.get('owner_id'))
+        event = {**event, 'event_id': next(self._ids)}
+        with self._lock:
+            subscribers = list(self._topics.get(owner_id, ()))
+            self.published += 1
+        for subscriber in subscribers:
+            subscriber.offer(event)
+        return len(subscribers)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'owners': len(self._topics),
+                'subscribers': sum(len(topic) for topic in self._topics.values()),
+                'published': self.published
+            }
+
+def listen_forever(dsn: str, hub: Hub, stop: threading.Event) -> None:
+    '''
+    Соединение LISTEN к одной БД (основной или шарду), переподключение при обрыве
+    '''
+    import psycopg2
+
+    while not stop.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(dsn)
+            conn.autocommit = True
+            conn.cursor().execute(f'LISTEN {EVENTS_CHANNEL}')
+            print(f'[push] listening on {EVENTS_CHANNEL}')
+            while not stop.is_set():
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        hub.publish(json.loads(notify.payload))
+                    except ValueError:
+                        print(f'[push] skip malformed payload: {notify.payload[:200]}')
+        except Exception as e:
+            print(f'[push] listener error: {e}, reconnect in {RECONNECT_DELAY_SECONDS}s')
+            stop.wait(RECONNECT_DELAY_SECONDS)
+        finally:
+            # Старое соединение закрывается до переподключения, иначе каждая ошибка оставляет сессию LISTEN в БД
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+def make_request_handler(hub: Hub, buffer_size: int, allow_publish: bool):
+    class PushRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_OPTIONS(self):
+            self.send_response(204)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+            self.send_header('Access-Control-Allow-Headers', 'Content-Type, Last-Event-ID')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+            if url.path == '/_health':
+                self.reply_json(200, hub.stats())
+                return
+            if url.path != '/events':
+                self.reply_json(404, {'error': 'Not found'})
+                return
+            if not query.get('owner_id'):
+                self.reply_json(400, {'error': 'owner_id required'})
+                return
+
+            types = set(filter(None, query.get('types', '').split(','))) or None
+            subscriber = Subscriber(query['owner_id'], types, buffer_size)
+            hub.subscribe(subscriber)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-store')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Connection', 'keep-alive')
+            self.end_headers()
+            self.close_connection = True
+
+            try:
+                self.wfile.write(f'retry: {RECONNECT_DELAY_SECONDS * 1000}\n: subscribed\n\n'.encode())
+                self.wfile.flush()
+                while True:
+                    try:
+                        event = subscriber.events.get(timeout=HEARTBEAT_SECONDS)
+                    except queue.Empty:
+                        self.wfile.write(b': ping\n\n')
+                        self.wfile.flush()
+                        continue
+                    message = f"id: {event.get('event_id', '')}\n" \
+                              f"event: {event.get('type', 'message')}\n" \
+                              f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+                    self.wfile.write(message.encode('utf-8'))
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                hub.unsubscribe(subscriber)
+
+        def do_POST(self):
+            if urlsplit(self.path).path != '/_publish' or not allow_publish:
+                self.reply_json(404, {'error': 'Not found'})
+                return
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                event = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                self.reply_json(400, {'error': 'Invalid JSON'})
+                return
+            self.reply_json(200, {'delivered_to': hub.publish(event)})
+
+        def reply_json(self, status: int, payload: Dict[str, Any]):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return PushRequestHandler
+
+def serve(args) -> None:
+    hub = Hub()
+    stop = threading.Event()
+    dsn = os.environ.get('DATABASE_URL')
+
+    if not args.no_listen:
+        if not dsn:
+            sys.exit('DATABASE_URL is required (or --no-listen)')
+        # Функции пишут NOTIFY в шард владельца: слушаем основную БД и все шарды из SHARD_DSNS
+        shard_dsns = {'main': dsn, **json.loads(os.environ.get('SHARD_DSNS') or '{}')}
+        for shard, shard_dsn in shard_dsns.items():
+            threading.Thread(target=listen_forever, args=(shard_dsn, hub, stop), daemon=True, name=f'listen-{shard}').start()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_request_handler(hub, args.buffer, args.allow_publish))
+    server.daemon_threads = True
+    print(f'[push] http://{args.host}:{server.server_address[1]}/events?owner_id=... buffer={args.buffer} '
+          f'listen={"off" if args.no_listen else "on"} publish={"on" if args.allow_publish else "off"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+
+def client(args) -> None:
+    '''
+    Подставной клиент: подписка на SSE и печать событий с задержкой доставки
+    '''
+    url = f'{args.url.rstrip("/")}/events?owner_id={args.owner_id}'
+    if args.types:
+        url += f'&types={args.types}'
+
+    received = 0
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=HEARTBEAT_SECONDS * 3) as response:
+                print(f'[client] subscribed: {url}')
+                event_type, data = 'message', ''
+                for raw_line in response:
+                    line = raw_line.decode('utf-8').rstrip('\n')
+                    if line.startswith('event: '):
+                        event_type = line[len('event: '):]
+                    elif line.startswith('data: '):
+                        data = line[len('data: '):]
+                    elif line == '' and data:
+                        received += 1
+                        payload = json.loads(data)
+                        lag = ''
+                        if 'sent_at' in payload:
+                            lag = f' lag={(time.time() - payload["sent_at"]) * 1000:.1f}ms'
+                        print(f'[client] #{received} {event_type}{lag}: {data}')
+                        event_type, data = 'message', ''
+                        if args.count and received >= args.count:
+                            return
+        except KeyboardInterrupt:
+            return
+        except Exception as e:
+            print(f'[client] disconnected: {e}, reconnecting')
+            time.sleep(RECONNECT_DELAY_SECONDS)
+
+def publish(args) -> None:
+    event = {'type': args.type, 'owner_id': int(args.owner_id), 'sent_at': time.time(), 'test': True}
+    if args.url:
+        req = urllib.request.Request(
+            f'{args.url.rstrip("/")}/_publish',
+            data=json.dumps(event).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        with urllib.request.urlopen(req, timeout=5) as response:
+            print(f'[publish] {response.read().decode()}')
+        return
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    conn.cursor().execute('SELECT pg_notify(%s, %s)', (EVENTS_CHANNEL, json.dumps(event)))
+    conn.close()
+    print(f'[publish] NOTIFY {EVENTS_CHANNEL}: {event}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Push-сервер событий владельца (SSE)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help='LISTEN owner_events и раздача по SSE')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8010)
+    serve_parser.add_argument('--buffer', type=int, default=256, help='событий в очереди одного подключения')
+    serve_parser.add_argument('--no-listen', action='store_true', help='не подключаться к БД')
+    serve_parser.add_argument('--allow-publish', action='store_true', help='POST /_publish для локальных проверок')
+
+    client_parser = commands.add_parser('client', help='подставной SSE-клиент')
+    client_parser.add_argument('--url', default='http://127.0.0.1:8010')
+    client_parser.add_argument('--owner-id', required=True)
+    client_parser.add_argument('--types', default='', help='payment,receipts,forward_log')
+    client_parser.add_argument('--count', type=int, default=0, help='выйти после N событий')
+
+    publish_parser = commands.add_parser('publish', help='тестовое событие через pg_notify или /_publish')
+    publish_parser.add_argument('--owner-id', required=True)
+    publish_parser.add_argument('--type', default='payment')
+    publish_parser.add_argument('--url', help='push-сервер с --allow-publish вместо pg_notify')
+
+    args = parser.parse_args()
+    {'serve': serve, 'client': client, 'publish': publish}[args.command](args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+'''
+Перенос старых raw_data платежей и чеков в архив: сжатые сегменты на диске или в S3-совместимом хранилище
+
+Строки старше --older-than-days (по created_at) с непустым raw_data читаются по возрастанию id порциями
+по --segment-rows. Порция — один сегмент: блоки по --block-rows строк, каждый сжат отдельно (gzip или
+zstd). Сегмент целиком пишется в хранилище, затем одна транзакция: в строках raw_data = NULL и указатель
+на блок (ключ сегмента, смещение, длина) с md5 payload, сегмент — в raw_archive_segments. Строка,
+изменившаяся между чтением и записью (md5 не совпал), остается в БД и уйдет в архив при следующем запуске.
+У чеков перед удалением raw_data сохраняются is_correction и calculation_method для списка чеков.
+
+Формат сегментов, хранилища и чтение — код функции raw-payload-fetch (загружается как модуль), она же
+отдает payload карточкам. Шарды — DATABASE_URL и SHARD_DSNS, как у функций. Место в таблицах освобождает
+VACUUM (обычный или autovacuum, не FULL). Сегмент, записанный в хранилище, но не зафиксированный в БД
+(падение между шагами), ни на что не ссылается и просто занимает место.
+
+    DATABASE_URL=postgres://... python scripts/raw_archive.py run --archive-url s3://bucket/raw --older-than-days 180
+    DATABASE_URL=postgres://... python scripts/raw_archive.py run --archive-url /var/lib/raw-archive --codec zstd --table receipts
+    DATABASE_URL=postgres://... python scripts/raw_archive.py verify --archive-url s3://bucket/raw --sample 500
+    DATABASE_URL=postgres://... python scripts/raw_archive.py status
+'''
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+HANDLER_PATH = ROOT_DIR / 'backend' / 'raw-payload-fetch' / 'index.py'
+SCHEMA = 't_p83864310_fintech_payment_reco'
+
+TABLES = {'payments': 'webhook_payments', 'receipts': 'ofd_receipts'}
+
+# Список чеков показывает признак коррекции и способ расчета первой позиции — берутся из raw_data,
+# пока он еще в строке (правая часть SET видит старые значения)
+RECEIPT_SUMMARY_SET = '''
+    is_correction = CASE WHEN jsonb_typeof(t.raw_data->'IsCorrection') = 'boolean'
+                         THEN (t.raw_data->>'IsCorrection')::boolean END,
+    calculation_method = CASE WHEN jsonb_typeof(t.raw_data->'Items'->0->'CalculationMethod') = 'number'
+                              THEN (t.raw_data->'Items'->0->>'CalculationMethod')::smallint END,
+'''
+
+def load_module():
+    spec = importlib.util.spec_from_file_location('raw_payload_fetch', HANDLER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def shard_dsns(only: str = None) -> Dict[str, str]:
+    dsns = {'main': os.environ['DATABASE_URL']}
+    dsns.update(json.loads(os.environ.get('SHARD_DSNS') or '{}'))
+    if only:
+        if only not in dsns:
+            sys.exit(f'shard {only} must be main or listed in SHARD_DSNS')
+        return {only: dsns[only]}
+    return dsns
+
+def selected_tables(name: str) -> List[str]:
+    return list(TABLES.values()) if name == 'all' else [TABLES[name]]
+
+def archive_url(args) -> str:
+    url = args.archive_url or os.environ.get('RAW_ARCHIVE_URL')
+    if not url:
+        sys.exit('--archive-url or RAW_ARCHIVE_URL required')
+    return url
+
+def build_segment(module, rows: List[Tuple[int, str]], block_rows: int, codec: str) -> Tuple[bytes, List[Tuple[int, int, int, str]], int]:
+    '''
+    Сегмент из независимо сжатых блоков
+    Returns: (байты сегмента, указатели (id, смещение блока, длина блока, md5), байт до сжатия)
+    '''
+    blocks = []
+    pointers = []
+    offset = 0
+    raw_bytes = 0
+    for start in range(0, len(rows), block_rows):
+        block_rows_list = rows[start:start + block_rows]
+        plain = module.encode_block(block_rows_list)
+        block = module.compress_block(plain, codec)
+        raw_bytes += len(plain)
+        pointers.extend((row_id, offset, len(block), module.payload_md5(raw_text)) for row_id, raw_text in block_rows_list)
+        blocks.append(block)
+        offset += len(block)
+    return b''.join(blocks), pointers, raw_bytes
+
+def segment_key(module, table: str, shard: str, codec: str, min_id: int, max_id: int) -> str:
+    now = datetime.now(timezone.utc)
+    return f'{table}/{shard}/{now:%Y/%m/%d}/{now:%H%M%S}-{min_id}-{max_id}{module.ARCHIVE_CODECS[codec]}'
+
+def archive_table(conn, module, store: Any, shard: str, table: str, args) -> Dict[str, int]:
+    cur = conn.cursor()
+    totals = {'segments': 0, 'rows': 0, 'archived': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+    after_id = 0
+    started = time.monotonic()
+    while args.max_segments is None or totals['segments'] < args.max_segments:
+        cur.execute(f'''
+            SELECT id, raw_data::text FROM {SCHEMA}.{table}
+            WHERE id > %s AND raw_data IS NOT NULL AND created_at < NOW() - %s * INTERVAL '1 day'
+            ORDER BY id
+            LIMIT %s
+        ''', (after_id, args.older_than_days, args.segment_rows))
+        rows = cur.fetchall()
+        # Загрузка сегмента может занять время — снимок чтения не держим
+        conn.commit()
+        if not rows:
+            break
+        after_id = rows[-1][0]
+
+        data, pointers, raw_bytes = build_segment(module, rows, args.block_rows, args.codec)
+        totals['segments'] += 1
+        totals['rows'] += len(rows)
+        totals['raw_bytes'] += raw_bytes
+        totals['stored_bytes'] += len(data)
+        if args.dry_run:
+            continue
+
+        key = segment_key(module, table, shard, args.codec, rows[0][0], after_id)
+        store.put(key, data)
+
+        summary_set = RECEIPT_SUMMARY_SET if table == 'ofd_receipts' else ''
+        updated = execute_values(cur, f'''
+            UPDATE {SCHEMA}.{table} AS t SET
+                {summary_set}
+                raw_data = NULL,
+                raw_archive_segment = v.segment,
+                raw_archive_offset = v.block_offset,
+                raw_archive_length = v.block_length,
+                raw_archive_md5 = v.md5
+            FROM (VALUES %s) AS v(id, segment, block_offset, block_length, md5)
+            WHERE t.id = v.id AND t.raw_data IS NOT NULL AND md5(t.raw_data::text) = v.md5
+            RETURNING t.id
+        ''', [(row_id, key, offset, length, md5) for row_id, offset, length, md5 in pointers],
+            template='(%s, %s, %s::bigint, %s, %s)', page_size=1000, fetch=True)
+        cur.execute(f'''
+            INSERT INTO {SCHEMA}.raw_archive_segments (
+                segment_key, table_name, codec, row_count, block_count, raw_bytes, stored_bytes, min_id, max_id
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ''', (key, table, args.codec, len(rows), len({pointer[1] for pointer in pointers}), raw_bytes, len(data),
+              rows[0][0], after_id))
+        conn.commit()
+        totals['archived'] += len(updated)
+
+        elapsed = time.monotonic() - started
+        print(f'[archive] {shard} {table}: {key} — {len(updated)}/{len(rows)} rows, '
+              f'{raw_bytes / 1024 / 1024:.1f} MB -> {len(data) / 1024 / 1024:.1f} MB, '
+              f'{totals["rows"] / max(elapsed, 0.001):.0f} rows/s')
+    return totals
+
+def run(args) -> None:
+    module = load_module()
+    # Без zstandard упасть сразу, а не после чтения первой порции
+    if args.codec == 'zstd' and importlib.util.find_spec('zstandard') is None:
+        sys.exit('--codec zstd requires the zstandard package')
+    store = None if args.dry_run else module.open_archive_store(archive_url(args))
+
+    for shard, dsn in sorted(shard_dsns(args.shard).items()):
+        conn = psycopg2.connect(dsn)
+        try:
+            for table in selected_tables(args.table):
+                totals = archive_table(conn, module, store, shard, table, args)
+                ratio = totals['raw_bytes'] / totals['stored_bytes'] if totals['stored_bytes'] else 0
+                prefix = '[dry-run] ' if args.dry_run else ''
+                print(f'{prefix}{shard} {table}: {totals["segments"]} segments, {totals["rows"]} rows '
+                      f'({totals["archived"]} archived), {totals["raw_bytes"] / 1024 / 1024:.1f} MB raw, '
+                      f'{totals["stored_bytes"] / 1024 / 1024:.1f} MB stored, ratio {ratio:.1f}x')
+        finally:
+            conn.close()
+    if not args.dry_run:
+        print('Space is reclaimed by VACUUM (autovacuum or manual, not FULL)')
+
+def verify(args) -> None:
+    '''
+    Чтение случайного диапазона архивированных строк через raw-payload-fetch и сверка md5
+    '''
+    module = load_module()
+    store = module.open_archive_store(archive_url(args))
+    failures = 0
+    for shard, dsn in sorted(shard_dsns(args.shard).items()):
+        conn = psycopg2.connect(dsn)
+        cur = conn.cursor()
+        for table in selected_tables(args.table):
+            cur.execute(f'SELECT MIN(min_id), MAX(max_id) FROM {SCHEMA}.raw_archive_segments WHERE table_name = %s', (table,))
+            min_id, max_id = cur.fetchone()
+            if min_id is None:
+                print(f'{shard} {table}: no segments')
+                continue
+            cur.execute(f'''
+                SELECT id, raw_archive_segment, raw_archive_offset, raw_archive_length, raw_archive_md5
+                FROM {SCHEMA}.{table}
+                WHERE id >= %s AND raw_data IS NULL AND raw_archive_segment IS NOT NULL
+                ORDER BY id
+                LIMIT %s
+            ''', (random.randint(min_id, max_id), args.sample))
+            rows = cur.fetchall()
+            checked = 0
+            started = time.monotonic()
+            for row_id, segment, offset, length, expected_md5 in rows:
+                try:
+                    module.read_archived_payload(store, segment, offset, length, row_id, expected_md5)
+                    checked += 1
+                except Exception as e:
+                    failures += 1
+                    print(f'FAIL {shard} {table} id={row_id}: {str(e)}')
+            print(f'{shard} {table}: {checked}/{len(rows)} payloads ok in {time.monotonic() - started:.2f}s')
+        conn.close()
+    if failures:
+        sys.exit(f'{failures} payloads failed verification')
+
+def status(args) -> None:
+    print('shard       table              segments      rows   raw MB  stored MB  ratio  table size  dead rows')
+    for shard, dsn in sorted(shard_dsns(args.shard).items()):
+        conn = psycopg2.connect(dsn)
+        cur = conn.cursor()
+        for table in TABLES.values():
+            cur.execute(f'''
+                SELECT COUNT(*), COALESCE(SUM(row_count), 0), COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(stored_bytes), 0),
+                       pg_size_pretty(pg_total_relation_size(%s::regclass)),
+                       (SELECT n_dead_tup FROM pg_stat_user_tables WHERE relid = %s::regclass)
+                FROM {SCHEMA}.raw_archive_segments
+                WHERE table_name = %s
+            ''', (f'{SCHEMA}.{table}', f'{SCHEMA}.{table}', table))
+            segments, rows, raw_bytes, stored_bytes, size, dead_rows = cur.fetchone()
+            ratio = raw_bytes / stored_bytes if stored_bytes else 0
+            print(f'{shard:<10}  {table:<17}  {segments:>8}  {rows:>8}  {raw_bytes / 1024 / 1024:>7.1f}  '
+                  f'{stored_bytes / 1024 / 1024:>9.1f}  {ratio:>4.1f}x  {size:>10}  {dead_rows or 0:>9}')
+        conn.close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Архив старых raw_data платежей и чеков в сжатых сегментах')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='перенести старые payload в архив')
+    run_parser.add_argument('--table', choices=['payments', 'receipts', 'all'], default='all')
+    run_parser.add_argument('--older-than-days', type=int, default=180)
+    run_parser.add_argument('--archive-url', help='s3://bucket/prefix или каталог; по умолчанию RAW_ARCHIVE_URL')
+    run_parser.add_argument('--codec', choices=['gzip', 'zstd'], default='gzip', help='zstd требует пакет zstandard')
+    run_parser.add_argument('--segment-rows', type=int, default=20000, help='строк в сегменте (одна транзакция)')
+    run_parser.add_argument('--block-rows', type=int, default=64, help='строк в блоке — единице чтения')
+    run_parser.add_argument('--max-segments', type=int, help='остановиться после N сегментов на таблицу')
+    run_parser.add_argument('--shard', help='только этот шард (main или из SHARD_DSNS)')
+    run_parser.add_argument('--dry-run', action='store_true', help='только посчитать строки и сжатие')
+
+    verify_parser = commands.add_parser('verify', help='прочитать случайные архивированные payload и сверить md5')
+    verify_parser.add_argument('--table', choices=['payments', 'receipts', 'all'], default='all')
+    verify_parser.add_argument('--archive-url', help='по умолчанию RAW_ARCHIVE_URL')
+    verify_parser.add_argument('--sample', type=int, default=200, help='строк на таблицу')
+    verify_parser.add_argument('--shard')
+
+    status_parser = commands.add_parser('status', help='сегменты, сжатие и размер таблиц по шардам')
+    status_parser.add_argument('--shard')
+
+    args = parser.parse_args()
+    {'run': run, 'verify': verify, 'status': status}[args.command](args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+'''
+Переигрывание сегментных журналов webhook-receive через тот же handler
+
+Два источника в одном формате (SEGMENT_MAGIC + записи crc32/длина/received_at/token/body):
+  spool   — WEBHOOK_SPOOL_DIR (постоянный том, общий с функцией), вебхуки, не попавшие в БД при
+            перегрузке. Файлы забираются переименованием в *.replaying и удаляются после прогона.
+  capture — WEBHOOK_CAPTURE_DIR, журнал всех принятых вебхуков. Только чтение: бэкфилл после
+            исправления маппинга и нагрузочные прогоны (--workers) на реальном трафике.
+
+Каждая запись идет через handler: подпись, маппинг и ON CONFLICT — как у живого запроса.
+Записи, которые снова не удалось сохранить, handler сам допишет в spool; ошибки 5xx — в failed-*.seg.
+
+    DATABASE_URL=postgres://... python scripts/replay_spool.py --spool-dir /var/lib/webhook-spool
+    DATABASE_URL=postgres://... python scripts/replay_spool.py --capture /var/lib/webhook-capture --workers 16
+    python scripts/replay_spool.py --capture /var/lib/webhook-capture --dry-run
+'''
+import argparse
+import fcntl
+import importlib.util
+import mmap
+import os
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+HANDLER_PATH = ROOT_DIR / 'backend' / 'webhook-receive' / 'index.py'
+
+def load_module():
+    spec = importlib.util.spec_from_file_location('webhook_receive', HANDLER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class SegmentReader:
+    '''
+    Чтение сегмента через mmap без копирования файла целиком.
+    Оборванный хвост (падение посреди записи) и записи с неверным crc32 завершают чтение сегмента
+    '''
+    def __init__(self, path: Path, magic: bytes, header):
+        self.path = path
+        self.magic = magic
+        self.header = header
+        self.corrupt_bytes = 0
+
+    def __iter__(self) -> Iterator[Tuple[float, str, str]]:
+        with self.path.open('rb') as segment:
+            size = os.fstat(segment.fileno()).st_size
+            if size <= len(self.magic):
+                return
+            with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(self.magic)] != self.magic:
+                    raise ValueError(f'{self.path}: not a webhook segment')
+
+                offset = len(self.magic)
+                while offset + self.header.size <= size:
+                    crc, body_len, received_at, token_len = self.header.unpack_from(mm, offset)
+                    start = offset + self.header.size
+                    end = start + token_len + body_len
+                    if end > size or zlib.crc32(mm[offset + 4:end]) != crc:
+                        break
+                    yield (
+                        received_at,
+                        mm[start:start + token_len].decode('utf-8'),
+                        mm[start + token_len:end].decode('utf-8')
+                    )
+                    offset = end
+                self.corrupt_bytes = size - offset
+
+def claim_spool_files(spool_dir: Path) -> List[Path]:
+    '''
+    Переименование spool-*.seg в *.replaying; незавершенные прошлые прогоны подхватываются тоже
+    '''
+    claimed = sorted(spool_dir.glob('*.replaying'))
+    for path in sorted(spool_dir.glob('spool-*.seg')):
+        target = path.with_name(f'{path.stem}.replaying')
+        path.rename(target)
+        claimed.append(target)
+    return claimed
+
+def wait_for_writers(path: Path) -> None:
+    '''
+    Дождаться записи, начатой до переименования: писатель держит flock на время append
+    '''
+    with path.open('rb') as segment:
+        fcntl.flock(segment.fileno(), fcntl.LOCK_EX)
+        fcntl.flock(segment.fileno(), fcntl.LOCK_UN)
+
+def replay_record(handler, token: str, body: str) -> str:
+    event = {
+        'httpMethod': 'POST',
+        'queryStringParameters': {'token': token},
+        'headers': {'Content-Type': 'application/json', 'X-Spool-Replay': '1'},
+        'body': body,
+        'isBase64Encoded': False
+    }
+    try:
+        response = handler(event, None)
+    except Exception as e:
+        print(f'[replay] handler crashed: {e}')
+        return 'failed'
+    status = response.get('statusCode', 500)
+    if (response.get('headers') or {}).get('X-Spooled'):
+        return 'respooled'
+    if status >= 500:
+        return 'failed'
+    if status >= 400:
+        return 'rejected'
+    return 'saved'
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Переигрывание spool/capture сегментов webhook-receive')
+    parser.add_argument('--spool-dir', help='дозагрузить и удалить spool-сегменты')
+    parser.add_argument('--capture', nargs='+', default=[], help='capture-сегменты или директории, только чтение')
+    parser.add_argument('--workers', type=int, default=1, help='параллельных вызовов handler')
+    parser.add_argument('--limit', type=int, default=0, help='остановиться после N записей')
+    parser.add_argument('--dry-run', action='store_true', help='только прочитать и посчитать записи')
+    args = parser.parse_args()
+
+    if not args.spool_dir and not args.capture:
+        args.spool_dir = os.environ.get('WEBHOOK_SPOOL_DIR')
+        if not args.spool_dir:
+            sys.exit('--spool-dir, WEBHOOK_SPOOL_DIR or --capture required')
+
+    if not args.dry_run and 'DATABASE_URL' not in os.environ:
+        sys.exit('DATABASE_URL is required')
+    # Повторный spool при перегрузке должен идти в ту же директорию, capture не дублируем
+    if args.spool_dir:
+        os.environ['WEBHOOK_SPOOL_DIR'] = args.spool_dir
+    os.environ.pop('WEBHOOK_CAPTURE_DIR', None)
+    module = load_module()
+
+    sources: List[Tuple[Path, bool]] = []
+    if args.spool_dir:
+        spool_dir = Path(args.spool_dir)
+        if spool_dir.is_dir():
+            if args.dry_run:
+                paths = sorted(spool_dir.glob('spool-*.seg')) + sorted(spool_dir.glob('*.replaying'))
+            else:
+                paths = claim_spool_files(spool_dir)
+            sources.extend((path, not args.dry_run) for path in paths)
+        else:
+            print(f'[replay] spool dir {spool_dir} not found')
+    for item in args.capture:
+        path = Path(item)
+        paths = sorted(path.glob('capture-*.seg')) if path.is_dir() else [path]
+        sources.extend((p, False) for p in paths)
+
+    counts: Dict[str, Any] = {'records': 0, 'saved': 0, 'rejected': 0, 'respooled': 0, 'failed': 0, 'corrupt_bytes': 0}
+    counts_lock = threading.Lock()
+    failed_writer = module.SegmentWriter(args.spool_dir or '.', 'failed', fsync=True)
+    executor = ThreadPoolExecutor(max_workers=max(1, args.workers))
+    in_flight = threading.BoundedSemaphore(max(1, args.workers) * 4)
+    started = time.perf_counter()
+    oldest, newest = None, None
+
+    def run(received_at: float, token: str, body: str) -> None:
+        try:
+            outcome = replay_record(module.handler, token, body)
+            if outcome == 'failed':
+                failed_writer.append(token, body, received_at)
+            with counts_lock:
+                counts[outcome] += 1
+        finally:
+            in_flight.release()
+
+    for path, consume in sources:
+        if consume:
+            wait_for_writers(path)
+        reader = SegmentReader(path, module.SEGMENT_MAGIC, module.SEGMENT_HEADER)
+        futures = []
+        for received_at, token, body in reader:
+            if args.limit and counts['records'] >= args.limit:
+                break
+            counts['records'] += 1
+            oldest = received_at if oldest is None else min(oldest, received_at)
+            newest = received_at if newest is None else max(newest, received_at)
+            if args.dry_run:
+                continue
+            in_flight.acquire()
+            futures.append(executor.submit(run, received_at, token, body))
+
+        for future in futures:
+            future.result()
+        counts['corrupt_bytes'] += reader.corrupt_bytes
+        if reader.corrupt_bytes:
+            print(f'[replay] {path.name}: {reader.corrupt_bytes} trailing bytes skipped (torn or corrupt record)')
+        if consume and not (args.limit and counts['records'] >= args.limit):
+            path.unlink()
+        print(f'[replay] {path.name} done: {counts}')
+        if args.limit and counts['records'] >= args.limit:
+            break
+
+    executor.shutdown(wait=True)
+    elapsed = time.perf_counter() - started
+    span = f', received {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(oldest))} .. ' \
+           f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(newest))}' if oldest else ''
+    print(f'[replay] {counts["records"]} records from {len(sources)} segments in {elapsed:.2f}s '
+          f'({counts["records"] / elapsed if elapsed else 0:.0f}/s){span}: {counts}')
+    if counts['failed']:
+        print(f'[replay] failed records kept in {failed_writer.directory}/failed-*.seg')
+
+if __name__ == '__main__':
+    main()
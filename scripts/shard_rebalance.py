@@ -0,0 +1,284 @@
+'''
+Перенос данных владельца между шардами и подготовка новых шардов
+
+Шард — отдельная БД с той же схемой (те же миграции db_migrations). Основная БД (DATABASE_URL) —
+шард main и справочник: owner_shards (owner_id -> shard, статус переноса) и integration_routes.
+DSN остальных шардов — SHARD_DSNS, как у функций.
+
+    export DATABASE_URL=postgres://main... SHARD_DSNS='{"shard-2": "postgres://..."}'
+    python scripts/shard_rebalance.py init-shard --shard shard-2 --index 2
+    python scripts/shard_rebalance.py status
+    python scripts/shard_rebalance.py move --owner-id 42 --to shard-2 --dry-run
+    python scripts/shard_rebalance.py move --owner-id 42 --to shard-2
+
+Перенос: владелец помечается moving (функции, включая webhook-receive, отвечают 503 с Retry-After
+на запись — провайдеры повторяют доставку), ждем истечения кэша маршрутов, копируем строки через COPY
+в одной транзакции на целевом шарде из снимка REPEATABLE READ источника, сверяем число строк,
+переключаем owner_shards, снова ждем и удаляем строки на источнике порциями.
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import psycopg2
+
+SCHEMA = 't_p83864310_fintech_payment_reco'
+
+# Последовательности шарда N начинаются с N * SHARD_ID_BLOCK: id, скопированные с другого шарда,
+# не пересекаются с новыми. SERIAL — int4, поэтому блоков 21 (main — блок 0)
+SHARD_ID_BLOCK = 100_000_000
+MAX_SHARD_INDEX = 2_147_483_647 // SHARD_ID_BLOCK - 1
+# Кэш маршрутов в функциях (SHARD_CACHE_TTL_SECONDS) плюс запас
+SETTLE_SECONDS = 35
+DELETE_BATCH_SIZE = 5000
+COPY_SPOOL_BYTES = 64 * 1024 * 1024
+
+# Таблицы владельца в порядке вставки (родители раньше детей); удаление — в обратном порядке
+OWNER_TABLES: List[Tuple[str, str]] = [
+    ('user_integrations', 'owner_id = %(owner_id)s'),
+    ('webhook_payments', 'owner_id = %(owner_id)s'),
+    ('webhook_forward_logs', f'webhook_payment_id IN (SELECT id FROM {SCHEMA}.webhook_payments WHERE owner_id = %(owner_id)s)'),
+    ('webhook_forward_stats', 'owner_id = %(owner_id)s'),
+    ('notification_outbox', 'owner_id = %(owner_id)s'),
+    ('integration_deletions', 'owner_id = %(owner_id)s'),
+    ('ofd_receipts', 'owner_id = %(owner_id)s'),
+    ('ofd_sync_ranges', f'integration_id IN (SELECT id FROM {SCHEMA}.user_integrations WHERE owner_id = %(owner_id)s)'),
+    ('ofd_sync_state', 'owner_id = %(owner_id)s'),
+    ('ofd_sync_runs', 'owner_id = %(owner_id)s'),
+    ('reconciliation_matches', 'owner_id = %(owner_id)s'),
+    ('reconciliation_match_items', f'match_id IN (SELECT id FROM {SCHEMA}.reconciliation_matches WHERE owner_id = %(owner_id)s)'),
+    ('reconciliation_discrepancies', 'owner_id = %(owner_id)s'),
+    ('reconciliation_discrepancy_days', 'owner_id = %(owner_id)s'),
+    ('reconciliation_dirty_days', 'owner_id = %(owner_id)s'),
+]
+
+def shard_dsns() -> Dict[str, str]:
+    dsns = {'main': os.environ['DATABASE_URL']}
+    dsns.update(json.loads(os.environ.get('SHARD_DSNS') or '{}'))
+    return dsns
+
+def current_route(main_cur, owner_id: int) -> Tuple[str, str]:
+    main_cur.execute(f'SELECT shard, status FROM {SCHEMA}.owner_shards WHERE owner_id = %s', (owner_id,))
+    row = main_cur.fetchone()
+    return (row[0], row[1]) if row else ('main', 'active')
+
+def set_route(main_conn, owner_id: int, shard: str, status: str, moved: bool = False) -> None:
+    cur = main_conn.cursor()
+    cur.execute(f'''
+        INSERT INTO {SCHEMA}.owner_shards (owner_id, shard, status, moved_at)
+        VALUES (%s, %s, %s, CASE WHEN %s THEN NOW() END)
+        ON CONFLICT (owner_id) DO UPDATE SET
+            shard = EXCLUDED.shard,
+            status = EXCLUDED.status,
+            moved_at = COALESCE(EXCLUDED.moved_at, {SCHEMA}.owner_shards.moved_at),
+            updated_at = NOW()
+    ''', (owner_id, shard, status, moved))
+    main_conn.commit()
+
+def table_columns(cur, table: str) -> List[str]:
+    cur.execute('''
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s
+        ORDER BY ordinal_position
+    ''', (SCHEMA, table))
+    return [row[0] for row in cur.fetchall()]
+
+def count_rows(cur, owner_id: int) -> Dict[str, int]:
+    counts = {}
+    for table, predicate in OWNER_TABLES:
+        cur.execute(f'SELECT COUNT(*) FROM {SCHEMA}.{table} WHERE {predicate}', {'owner_id': owner_id})
+        counts[table] = cur.fetchone()[0]
+    return counts
+
+def wait(seconds: int, reason: str) -> None:
+    print(f'[rebalance] waiting {seconds}s: {reason}')
+    time.sleep(seconds)
+
+def copy_owner(source_conn, target_conn, owner_id: int) -> Dict[str, int]:
+    '''
+    COPY строк владельца из снимка источника в целевой шард, без коммита на целевом шарде.
+    Бинарный формат: схемы шардов одинаковые, а разбор текста не нужен ни на одной стороне
+    '''
+    source_cur = source_conn.cursor()
+    target_cur = target_conn.cursor()
+    copied = {}
+    for table, predicate in OWNER_TABLES:
+        columns = table_columns(source_cur, table)
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        select_sql = source_cur.mogrify(
+            f'SELECT {column_list} FROM {SCHEMA}.{table} WHERE {predicate}',
+            {'owner_id': owner_id}
+        ).decode('utf-8')
+
+        started = time.perf_counter()
+        with tempfile.SpooledTemporaryFile(max_size=COPY_SPOOL_BYTES) as buffer:
+            source_cur.copy_expert(f'COPY ({select_sql}) TO STDOUT WITH (FORMAT binary)', buffer)
+            size = buffer.tell()
+            buffer.seek(0)
+            target_cur.copy_expert(f'COPY {SCHEMA}.{table} ({column_list}) FROM STDIN WITH (FORMAT binary)', buffer)
+        target_cur.execute(f'SELECT COUNT(*) FROM {SCHEMA}.{table} WHERE {predicate}', {'owner_id': owner_id})
+        copied[table] = target_cur.fetchone()[0]
+        elapsed = time.perf_counter() - started
+        print(f'[rebalance] {table}: {copied[table]} rows, {size / 1024 / 1024:.1f} MB, {elapsed:.2f}s')
+    return copied
+
+def delete_owner(conn, owner_id: int) -> None:
+    '''
+    Удаление строк владельца на старом шарде порциями, чтобы не держать длинных блокировок
+    '''
+    cur = conn.cursor()
+    for table, predicate in reversed(OWNER_TABLES):
+        deleted = 0
+        while True:
+            cur.execute(f'''
+                DELETE FROM {SCHEMA}.{table}
+                WHERE ctid IN (SELECT ctid FROM {SCHEMA}.{table} WHERE {predicate} LIMIT %(batch)s)
+            ''', {'owner_id': owner_id, 'batch': DELETE_BATCH_SIZE})
+            conn.commit()
+            deleted += cur.rowcount
+            if cur.rowcount < DELETE_BATCH_SIZE:
+                break
+        print(f'[rebalance] {table}: {deleted} rows deleted from source')
+
+def move(args) -> None:
+    dsns = shard_dsns()
+    if args.to not in dsns:
+        sys.exit(f'unknown shard {args.to}, known: {", ".join(sorted(dsns))}')
+
+    main_conn = psycopg2.connect(dsns['main'])
+    source_shard, status = current_route(main_conn.cursor(), args.owner_id)
+    main_conn.commit()
+    if source_shard == args.to:
+        sys.exit(f'owner {args.owner_id} is already on {args.to}')
+    if status == 'moving' and not args.resume:
+        sys.exit(f'owner {args.owner_id} is already moving (previous run interrupted?), use --resume')
+
+    source_conn = psycopg2.connect(dsns[source_shard])
+    target_conn = psycopg2.connect(dsns[args.to])
+
+    source_counts = count_rows(source_conn.cursor(), args.owner_id)
+    source_conn.commit()
+    target_counts = count_rows(target_conn.cursor(), args.owner_id)
+    target_conn.commit()
+    print(f'[rebalance] owner {args.owner_id}: {source_shard} -> {args.to}, {sum(source_counts.values())} rows')
+    for table, _ in OWNER_TABLES:
+        print(f'  {table}: {source_counts[table]}')
+    if any(target_counts.values()):
+        sys.exit(f'target {args.to} already has rows of owner {args.owner_id}: {target_counts}')
+    if args.dry_run:
+        return
+
+    set_route(main_conn, args.owner_id, source_shard, 'moving')
+    try:
+        wait(args.settle, 'functions pick up the moving status')
+
+        # Один согласованный снимок источника на все таблицы
+        source_conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        started = time.perf_counter()
+        copied = copy_owner(source_conn, target_conn, args.owner_id)
+        source_counts = count_rows(source_conn.cursor(), args.owner_id)
+        if copied != source_counts:
+            raise RuntimeError(f'row count mismatch: source={source_counts}, copied={copied}')
+        target_conn.commit()
+        source_conn.commit()
+        print(f'[rebalance] copied {sum(copied.values())} rows in {time.perf_counter() - started:.2f}s')
+    except BaseException:
+        target_conn.rollback()
+        set_route(main_conn, args.owner_id, source_shard, 'active')
+        print(f'[rebalance] move aborted, owner {args.owner_id} stays on {source_shard}')
+        raise
+
+    set_route(main_conn, args.owner_id, args.to, 'active', moved=True)
+    print(f'[rebalance] owner {args.owner_id} now served by {args.to}')
+
+    if args.keep_source:
+        print(f'[rebalance] source rows kept on {source_shard} (--keep-source), scanners skip them')
+    else:
+        wait(args.settle, 'readers drop the cached old route')
+        source_conn.set_session(isolation_level='READ COMMITTED', readonly=False)
+        delete_owner(source_conn, args.owner_id)
+
+    for conn in (main_conn, source_conn, target_conn):
+        conn.close()
+
+def init_shard(args) -> None:
+    '''
+    Сдвиг всех последовательностей схемы нового шарда в его блок id
+    '''
+    dsns = shard_dsns()
+    if args.shard == 'main' or args.shard not in dsns:
+        sys.exit(f'shard {args.shard} must be listed in SHARD_DSNS')
+    if not 1 <= args.index <= MAX_SHARD_INDEX:
+        sys.exit(f'--index must be in 1..{MAX_SHARD_INDEX}')
+
+    conn = psycopg2.connect(dsns[args.shard])
+    cur = conn.cursor()
+    cur.execute('SELECT sequencename, last_value FROM pg_sequences WHERE schemaname = %s', (SCHEMA,))
+    start = args.index * SHARD_ID_BLOCK
+    for name, last_value in cur.fetchall():
+        if last_value is not None and last_value >= start:
+            print(f'[rebalance] {name}: already at {last_value}')
+            continue
+        cur.execute('SELECT setval(%s, %s, false)', (f'{SCHEMA}.{name}', start))
+        print(f'[rebalance] {name}: next id {start}')
+    conn.commit()
+    conn.close()
+
+def status(args) -> None:
+    dsns = shard_dsns()
+    main_conn = psycopg2.connect(dsns['main'])
+    cur = main_conn.cursor()
+    cur.execute(f'SELECT shard, status, COUNT(*) FROM {SCHEMA}.owner_shards GROUP BY shard, status ORDER BY shard, status')
+    routed = cur.fetchall()
+    cur.execute(f'SELECT owner_id, shard, updated_at FROM {SCHEMA}.owner_shards WHERE status = %s', ('moving',))
+    moving = cur.fetchall()
+    main_conn.close()
+
+    print('shard       owners  integrations  payments   receipts   size')
+    for shard, dsn in sorted(dsns.items()):
+        conn = psycopg2.connect(dsn)
+        shard_cur = conn.cursor()
+        shard_cur.execute(f'''
+            SELECT
+                (SELECT COUNT(DISTINCT owner_id) FROM {SCHEMA}.user_integrations),
+                (SELECT COUNT(*) FROM {SCHEMA}.user_integrations),
+                (SELECT reltuples::bigint FROM pg_class WHERE oid = '{SCHEMA}.webhook_payments'::regclass),
+                (SELECT reltuples::bigint FROM pg_class WHERE oid = '{SCHEMA}.ofd_receipts'::regclass),
+                pg_size_pretty(pg_database_size(current_database()))
+        ''')
+        owners, integrations, payments, receipts, size = shard_cur.fetchone()
+        conn.close()
+        print(f'{shard:<10}  {owners:>6}  {integrations:>12}  {max(payments, 0):>8}  {max(receipts, 0):>9}   {size}')
+
+    for shard, route_status, count in routed:
+        print(f'owner_shards: {shard} {route_status} = {count}')
+    for owner_id, shard, updated_at in moving:
+        print(f'moving: owner {owner_id} from {shard} since {updated_at}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Шардирование по owner_id: перенос владельцев и новые шарды')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    move_parser = commands.add_parser('move', help='перенести данные владельца на другой шард')
+    move_parser.add_argument('--owner-id', type=int, required=True)
+    move_parser.add_argument('--to', required=True, help='имя шарда из SHARD_DSNS или main')
+    move_parser.add_argument('--settle', type=int, default=SETTLE_SECONDS, help='ожидание кэша маршрутов, сек')
+    move_parser.add_argument('--keep-source', action='store_true', help='не удалять строки на старом шарде')
+    move_parser.add_argument('--resume', action='store_true', help='повторить прерванный перенос (статус moving)')
+    move_parser.add_argument('--dry-run', action='store_true', help='только посчитать строки')
+
+    init_parser = commands.add_parser('init-shard', help='сдвинуть последовательности нового шарда')
+    init_parser.add_argument('--shard', required=True)
+    init_parser.add_argument('--index', type=int, required=True, help=f'номер блока id, 1..{MAX_SHARD_INDEX}')
+
+    commands.add_parser('status', help='владельцы и объем данных по шардам')
+
+    args = parser.parse_args()
+    {'move': move, 'init-shard': init_shard, 'status': status}[args.command](args)
+
+if __name__ == '__main__':
+    main()
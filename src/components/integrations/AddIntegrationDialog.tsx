@@ -7,6 +7,7 @@ import { Badge } from '@/components/ui/badge';
 import Icon from '@/components/ui/icon';
 import { useToast } from '@/hooks/use-toast';
 import functionUrls from '../../../backend/func2url.json';
+import { rememberWriteLsn } from '@/lib/read-your-writes';
 
 interface Provider {
   id: number;
@@ -107,6 +108,7 @@ const AddIntegrationDialog = ({ open, onOpenChange, provider, editingIntegration
         });
 
         const data = await response.json();
+        rememberWriteLsn(response);
 
         if (response.ok && data.success) {
           toast({ title: 'Интеграция обновлена' });
@@ -133,6 +135,7 @@ const AddIntegrationDialog = ({ open, onOpenChange, provider, editingIntegration
         });
 
         const data = await response.json();
+        rememberWriteLsn(response);
 
         if (response.ok && data.success) {
           setWebhookUrl(data.webhook_url);
@@ -2,6 +2,7 @@ import { Dialog, DialogContent, DialogDescription, DialogHeader, DialogTitle } f
 import { Badge } from '@/components/ui/badge';
 import { Separator } from '@/components/ui/separator';
 import Icon from '@/components/ui/icon';
+import { useRawPayload } from '@/hooks/use-raw-payload';
 
 interface Payment {
   id: number;
@@ -18,6 +19,7 @@ interface Payment {
   exp_date: string;
   terminal_key: string;
   raw_data: any;
+  raw_archived?: boolean;
   receipt_id: number | null;
   created_at: string;
   integration_name: string;
@@ -28,9 +30,12 @@ interface PaymentDetailsDialogProps {
   open: boolean;
   onOpenChange: (open: boolean) => void;
   payment: Payment | null;
+  ownerId: number;
 }
 
-const PaymentDetailsDialog = ({ open, onOpenChange, payment }: PaymentDetailsDialogProps) => {
+const PaymentDetailsDialog = ({ open, onOpenChange, payment, ownerId }: PaymentDetailsDialogProps) => {
+  const { rawData, isLoading: isRawLoading, error: rawError } = useRawPayload(ownerId, 'payment', payment, open);
+
   if (!payment) return null;
 
   const getStatusColor = (status: string) => {
@@ -192,7 +197,7 @@ const PaymentDetailsDialog = ({ open, onOpenChange, payment }: PaymentDetailsDia
             </h3>
             <div className="bg-muted p-4 rounded-lg overflow-x-auto">
               <pre className="text-xs font-mono whitespace-pre-wrap">
-                {JSON.stringify(payment.raw_data, null, 2)}
+                {isRawLoading ? 'Загрузка из архива...' : rawError || JSON.stringify(rawData, null, 2)}
               </pre>
             </div>
           </div>
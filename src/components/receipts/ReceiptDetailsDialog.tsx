@@ -1,6 +1,7 @@
 import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogDescription } from '@/components/ui/dialog';
 import { Badge } from '@/components/ui/badge';
 import { Separator } from '@/components/ui/separator';
+import { useRawPayload } from '@/hooks/use-raw-payload';
 
 interface Receipt {
   source: 'ofd' | 'cash_register';
@@ -17,15 +18,20 @@ interface Receipt {
   fn_number: string;
   created_at: string;
   raw_data: any;
+  raw_archived?: boolean;
+  is_correction?: boolean | null;
+  calculation_method?: number | null;
 }
 
 interface ReceiptDetailsDialogProps {
   receipt: Receipt | null;
   open: boolean;
   onOpenChange: (open: boolean) => void;
+  ownerId: number;
 }
 
-const ReceiptDetailsDialog = ({ receipt, open, onOpenChange }: ReceiptDetailsDialogProps) => {
+const ReceiptDetailsDialog = ({ receipt, open, onOpenChange, ownerId }: ReceiptDetailsDialogProps) => {
+  const { rawData, isLoading: isRawLoading, error: rawError } = useRawPayload(ownerId, 'receipt', receipt, open);
 
   const formatAmount = (amount: number) => {
     return new Intl.NumberFormat('ru-RU', {
@@ -69,8 +75,9 @@ const ReceiptDetailsDialog = ({ receipt, open, onOpenChange }: ReceiptDetailsDia
     return <Badge variant="outline" className={className}>{getOperationTypeLabel(type)}</Badge>;
   };
 
+  // Пока payload загружается из архива, признаки берутся из колонок, заполненных архиватором
   const getReceiptTypeBadge = (rawData: any) => {
-    const isCorrection = rawData?.IsCorrection || false;
+    const isCorrection = (rawData ? rawData.IsCorrection : receipt?.is_correction) || false;
     if (isCorrection) {
       return <Badge variant="outline" className="bg-red-50 text-red-700 border-red-200">Чек коррекции</Badge>;
     }
@@ -79,9 +86,9 @@ const ReceiptDetailsDialog = ({ receipt, open, onOpenChange }: ReceiptDetailsDia
 
   const getCalculationMethodLabel = (rawData: any) => {
     const items = rawData?.Items || [];
-    if (items.length === 0) return '—';
-    
-    const calculationMethod = items[0]?.CalculationMethod;
+    const calculationMethod = rawData ? items[0]?.CalculationMethod : receipt?.calculation_method;
+    if (rawData ? items.length === 0 : calculationMethod == null) return '—';
+
     const methodMap: Record<number, string> = {
       1: 'Предоплата 100%',
       2: 'Предоплата',
@@ -123,13 +130,13 @@ const ReceiptDetailsDialog = ({ receipt, open, onOpenChange }: ReceiptDetailsDia
 
               <div>
                 <div className="text-sm text-muted-foreground mb-1">Тип чека</div>
-                {getReceiptTypeBadge(receipt.raw_data)}
+                {getReceiptTypeBadge(rawData)}
               </div>
 
               <div>
                 <div className="text-sm text-muted-foreground mb-1">Признак расчета</div>
                 <Badge variant="secondary" className="text-xs">
-                  {getCalculationMethodLabel(receipt.raw_data)}
+                  {getCalculationMethodLabel(rawData)}
                 </Badge>
               </div>
 
@@ -195,7 +202,7 @@ const ReceiptDetailsDialog = ({ receipt, open, onOpenChange }: ReceiptDetailsDia
               <div className="text-lg font-semibold mb-3">Raw Data</div>
               <div className="bg-muted/50 rounded-lg p-4 font-mono text-xs overflow-x-auto">
                 <pre className="whitespace-pre-wrap break-words">
-                  {JSON.stringify(receipt.raw_data, null, 2)}
+                  {isRawLoading ? 'Загрузка из архива...' : rawError || JSON.stringify(rawData, null, 2)}
                 </pre>
               </div>
             </div>
@@ -0,0 +1,35 @@
+import * as React from "react"
+
+const PUSH_URL = import.meta.env.VITE_PUSH_URL as string | undefined
+const DEBOUNCE_MS = 500
+
+// Подписка на события владельца из scripts/push_server.py (SSE).
+// Пачка событий схлопывается в один вызов onEvent; resync приходит, если клиент отстал.
+// Без VITE_PUSH_URL хук ничего не делает — страницы обновляются вручную.
+export function useOwnerEvents(ownerId: number, types: string[], onEvent: () => void) {
+  const onEventRef = React.useRef(onEvent)
+  onEventRef.current = onEvent
+  const typesKey = types.join(",")
+
+  React.useEffect(() => {
+    if (!PUSH_URL) return
+
+    const params = new URLSearchParams({ owner_id: ownerId.toString(), types: `${typesKey},resync` })
+    const source = new EventSource(`${PUSH_URL.replace(/\/$/, "")}/events?${params}`)
+    let timer: ReturnType<typeof setTimeout> | undefined
+
+    const schedule = () => {
+      if (timer) clearTimeout(timer)
+      timer = setTimeout(() => onEventRef.current(), DEBOUNCE_MS)
+    }
+
+    const eventTypes = [...typesKey.split(",").filter(Boolean), "resync"]
+    eventTypes.forEach((type) => source.addEventListener(type, schedule))
+
+    return () => {
+      if (timer) clearTimeout(timer)
+      eventTypes.forEach((type) => source.removeEventListener(type, schedule))
+      source.close()
+    }
+  }, [ownerId, typesKey])
+}
@@ -0,0 +1,60 @@
+import * as React from "react"
+import functionUrls from "../../backend/func2url.json"
+import { readHeaders } from "@/lib/read-your-writes"
+
+// raw_data старых платежей и чеков перенесен в архив (scripts/raw_archive.py): список отдает null
+// и raw_archived, полный payload загружает функция raw-payload-fetch только при открытии карточки.
+const RAW_PAYLOAD_URL = (functionUrls as Record<string, string>)["raw-payload-fetch"]
+const LOAD_ERROR = "Не удалось загрузить данные из архива"
+
+interface RawPayloadItem {
+  id: number
+  raw_data: any
+  raw_archived?: boolean
+}
+
+export function useRawPayload(ownerId: number, type: "payment" | "receipt", item: RawPayloadItem | null, enabled: boolean) {
+  const [loaded, setLoaded] = React.useState<{ key: string; rawData: any } | null>(null)
+  const [isLoading, setIsLoading] = React.useState(false)
+  const [error, setError] = React.useState<string | null>(null)
+  const key = item ? `${type}:${item.id}` : ""
+  const needsFetch = Boolean(enabled && item?.raw_archived && item.raw_data == null && loaded?.key !== key)
+
+  React.useEffect(() => {
+    if (!needsFetch || !item) return
+    if (!RAW_PAYLOAD_URL) {
+      setError("Функция raw-payload-fetch не развернута")
+      return
+    }
+
+    let cancelled = false
+    setIsLoading(true)
+    setError(null)
+    const params = new URLSearchParams({ owner_id: ownerId.toString(), type, id: item.id.toString() })
+    fetch(`${RAW_PAYLOAD_URL}?${params}`, { headers: readHeaders() })
+      .then(async (response) => {
+        const data = await response.json()
+        if (cancelled) return
+        if (response.ok && data.success) {
+          setLoaded({ key, rawData: data.raw_data })
+        } else {
+          setError(data.error || LOAD_ERROR)
+        }
+      })
+      .catch(() => {
+        if (!cancelled) setError(LOAD_ERROR)
+      })
+      .finally(() => {
+        if (!cancelled) setIsLoading(false)
+      })
+
+    return () => {
+      cancelled = true
+    }
+  }, [needsFetch, ownerId, type, key])
+
+  if (!item) return { rawData: null, isLoading: false, error: null }
+  if (loaded?.key === key) return { rawData: loaded.rawData, isLoading: false, error: null }
+  if (!item.raw_archived || item.raw_data != null) return { rawData: item.raw_data, isLoading: false, error: null }
+  return { rawData: null, isLoading, error }
+}
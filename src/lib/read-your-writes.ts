@@ -0,0 +1,17 @@
+// Чтение своих записей при чтении с реплик: функции записи отдают X-Write-LSN,
+// функции чтения получают его в X-Min-LSN и идут на primary, пока реплика не догонит этот LSN.
+// Заголовок добавляется только после записи, поэтому обычные GET остаются без preflight.
+const STORAGE_KEY = "write-lsn"
+
+let lastWriteLsn: string | null = sessionStorage.getItem(STORAGE_KEY)
+
+export function rememberWriteLsn(response: Response) {
+  const lsn = response.headers.get("X-Write-LSN")
+  if (!lsn) return
+  lastWriteLsn = lsn
+  sessionStorage.setItem(STORAGE_KEY, lsn)
+}
+
+export function readHeaders(): Record<string, string> {
+  return lastWriteLsn ? { "X-Min-LSN": lastWriteLsn } : {}
+}
@@ -8,6 +8,8 @@ import AccessManagement from './AccessManagement';
 import IntegrationsPage from './IntegrationsPage';
 import PaymentsPage from './PaymentsPage';
 import ReceiptsPage from './ReceiptsPage';
+import functionUrls from '../../backend/func2url.json';
+import { readHeaders } from '@/lib/read-your-writes';
 import {
   LineChart,
   Line,
@@ -78,40 +80,19 @@ const Index = () => {
 
   const loadDashboardStats = async () => {
     try {
-      const [paymentsRes, receiptsRes, integrationsRes] = await Promise.all([
-        fetch(`https://functions.poehali.dev/1a67a47e-88ff-48e0-82fd-82b4dedd80d3?owner_id=${ownerId}&limit=1000&offset=0`),
-        fetch(`https://functions.poehali.dev/f27cd7c6-c93b-49c7-9caa-1c076b0f4e22?owner_id=${ownerId}&limit=1000&offset=0`),
-        fetch(`https://functions.poehali.dev/43050d81-0a0a-4bc5-baee-2a7f3ad7fe50?owner_id=${ownerId}`)
-      ]);
-
-      const [paymentsData, receiptsData, integrationsData] = await Promise.all([
-        paymentsRes.json(),
-        receiptsRes.json(),
-        integrationsRes.json()
-      ]);
-
-      const payments = paymentsData.payments || [];
-      const receipts = receiptsData.receipts || [];
-      const integrations = integrationsData.user_integrations || [];
-
-      const successfulPayments = payments.filter((p: any) => 
-        p.status === 'AUTHORIZED' || p.status === 'CONFIRMED'
-      );
-      
-      const paymentsRevenue = successfulPayments.reduce((sum: number, p: any) => 
-        sum + (p.amount || 0), 0
-      );
-      
-      const receiptsSum = receipts.reduce((sum: number, r: any) => sum + (r.total_sum || 0), 0);
-      const activeIntegrations = integrations.filter((i: any) => i.status === 'active').length;
+      // Агрегаты считаются в БД (dashboard-stats?view=summary): ответ в несколько КБ независимо от истории
+      const res = await fetch(`${functionUrls['dashboard-stats']}?owner_id=${ownerId}&view=summary`, { headers: readHeaders() });
+      const data = await res.json();
+      const summary = data.summary;
+      if (!summary) return;
 
       setStats({
-        totalPayments: payments.length,
-        successfulPayments: successfulPayments.length,
-        paymentsRevenue,
-        totalReceipts: receipts.length,
-        receiptsSum,
-        activeIntegrations
+        totalPayments: summary.payments.total,
+        successfulPayments: summary.payments.successful,
+        paymentsRevenue: summary.payments.revenue,
+        totalReceipts: summary.receipts.total,
+        receiptsSum: summary.receipts.sum,
+        activeIntegrations: summary.integrations.active
       });
     } catch (error) {
       console.error('Failed to load dashboard stats:', error);
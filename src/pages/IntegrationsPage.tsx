@@ -16,6 +16,7 @@ import {
   AlertDialogTitle,
 } from '@/components/ui/alert-dialog';
 import functionUrls from '../../backend/func2url.json';
+import { readHeaders, rememberWriteLsn } from '@/lib/read-your-writes';
 
 interface Provider {
   id: number;
@@ -69,7 +70,7 @@ const IntegrationsPage = () => {
   const fetchIntegrations = async () => {
     setIsLoading(true);
     try {
-      const response = await fetch(`${functionUrls['integrations-list']}?owner_id=${ownerId}`);
+      const response = await fetch(`${functionUrls['integrations-list']}?owner_id=${ownerId}`, { headers: readHeaders() });
       const data = await response.json();
 
       if (response.ok) {
@@ -135,9 +136,10 @@ const IntegrationsPage = () => {
       });
 
       const data = await response.json();
+      rememberWriteLsn(response);
 
       if (response.ok && data.success) {
-        toast({ title: 'Интеграция удалена' });
+        toast({ title: 'Интеграция удаляется', description: 'Данные будут удалены в фоне' });
         fetchIntegrations();
         setShowDeleteDialog(false);
         setDeletingIntegration(null);
@@ -200,6 +202,7 @@ const IntegrationsPage = () => {
       });
 
       const data = await response.json();
+      rememberWriteLsn(response);
 
       if (response.ok && data.success) {
         const periodLabel = days === 1 ? 'за вчера' : `за последние ${days} дней`;
@@ -284,7 +287,7 @@ const IntegrationsPage = () => {
                         </div>
                         <div className="flex items-center gap-2">
                           <Badge variant={integration.status === 'active' ? 'default' : 'secondary'}>
-                            {integration.status === 'active' ? 'Активно' : 'Неактивно'}
+                            {integration.status === 'active' ? 'Активно' : integration.status === 'deleting' ? 'Удаляется' : 'Неактивно'}
                           </Badge>
                           <Button
                             variant="ghost"
@@ -3,16 +3,19 @@ import { Card, CardContent, CardDescription, CardHeader, CardTitle } from '@/com
 import { Button } from '@/components/ui/button';
 import Icon from '@/components/ui/icon';
 import { useToast } from '@/hooks/use-toast';
+import { useOwnerEvents } from '@/hooks/use-owner-events';
 import PaymentDetailsDialog from '@/components/payments/PaymentDetailsDialog';
 import PaymentsStatistics from '@/components/payments/PaymentsStatistics';
 import PaymentsFilters from '@/components/payments/PaymentsFilters';
 import PaymentsTable from '@/components/payments/PaymentsTable';
 import functionUrls from '../../backend/func2url.json';
+import { readHeaders } from '@/lib/read-your-writes';
 
 interface Payment {
   id: number;
   payment_id: string;
   amount: number;
+  amount_kopecks: number;
   order_id: string;
   status: string;
   payment_status: string;
@@ -24,6 +27,7 @@ interface Payment {
   exp_date: string;
   terminal_key: string;
   raw_data: any;
+  raw_archived?: boolean;
   receipt_id: number | null;
   created_at: string;
   integration_name: string;
@@ -66,7 +70,7 @@ const PaymentsPage = () => {
   const fetchPayments = async () => {
     setIsLoading(true);
     try {
-      const response = await fetch(`${functionUrls['payments-list']}?owner_id=${ownerId}&limit=100`);
+      const response = await fetch(`${functionUrls['payments-list']}?owner_id=${ownerId}&limit=100`, { headers: readHeaders() });
       const data = await response.json();
 
       if (response.ok) {
@@ -94,6 +98,8 @@ const PaymentsPage = () => {
     fetchPayments();
   }, []);
 
+  useOwnerEvents(ownerId, ['payment'], fetchPayments);
+
   const handleRowClick = (payment: Payment) => {
     setSelectedPayment(payment);
     setShowDetails(true);
@@ -205,9 +211,10 @@ const PaymentsPage = () => {
     return matchesSearch && matchesStatus && matchesIntegration;
   });
 
+  // Сумма в копейках (целые), в рубли — один раз в конце: сложение float накапливает ошибку
   const totalAmount = groupedPayments
     .filter(p => p.latest_status === 'CONFIRMED')
-    .reduce((sum, p) => sum + p.amount, 0);
+    .reduce((sum, p) => sum + p.payments[0].amount_kopecks, 0) / 100;
 
   if (isLoading) {
     return (
@@ -274,6 +281,7 @@ const PaymentsPage = () => {
           payment={selectedPayment}
           open={showDetails}
           onOpenChange={setShowDetails}
+          ownerId={ownerId}
         />
       )}
     </div>
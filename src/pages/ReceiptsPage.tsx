@@ -6,8 +6,10 @@ import { Input } from '@/components/ui/input';
 import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from '@/components/ui/table';
 import Icon from '@/components/ui/icon';
 import { useToast } from '@/hooks/use-toast';
+import { useOwnerEvents } from '@/hooks/use-owner-events';
 import ReceiptDetailsDialog from '@/components/receipts/ReceiptDetailsDialog';
 import functionUrls from '../../backend/func2url.json';
+import { readHeaders } from '@/lib/read-your-writes';
 
 interface Receipt {
   source: 'ofd' | 'cash_register';
@@ -19,11 +21,17 @@ interface Receipt {
   total_sum: number;
   cash_sum: number;
   ecash_sum: number;
+  total_kopecks: number;
+  cash_kopecks: number;
+  ecash_kopecks: number;
   doc_number: string;
   document_datetime: string;
   fn_number: string;
   created_at: string;
   raw_data: any;
+  raw_archived?: boolean;
+  is_correction?: boolean | null;
+  calculation_method?: number | null;
 }
 
 const ReceiptsPage = () => {
@@ -45,7 +53,7 @@ const ReceiptsPage = () => {
         offset: '0'
       });
 
-      const response = await fetch(`${functionUrls['receipts-list']}?${params}`);
+      const response = await fetch(`${functionUrls['receipts-list']}?${params}`, { headers: readHeaders() });
       const data = await response.json();
 
       if (response.ok && data.success) {
@@ -72,6 +80,8 @@ const ReceiptsPage = () => {
     loadReceipts();
   }, []);
 
+  useOwnerEvents(ownerId, ['receipts'], loadReceipts);
+
   const formatDateTime = (isoString: string) => {
     if (!isoString) return '—';
     const date = new Date(isoString);
@@ -115,19 +125,22 @@ const ReceiptsPage = () => {
     return <Badge variant="outline" className={config.className}>{config.label}</Badge>;
   };
 
-  const getReceiptTypeBadge = (rawData: any) => {
-    const isCorrection = rawData?.IsCorrection || false;
+  // У чека с raw_data в архиве признаки берутся из колонок, заполненных архиватором
+  const getReceiptTypeBadge = (receipt: Receipt) => {
+    const isCorrection = (receipt.raw_data ? receipt.raw_data.IsCorrection : receipt.is_correction) || false;
     if (isCorrection) {
       return <Badge variant="outline" className="bg-red-50 text-red-700 border-red-200">Чек коррекции</Badge>;
     }
     return <Badge variant="outline" className="bg-blue-50 text-blue-700 border-blue-200">Чек</Badge>;
   };
 
-  const getCalculationMethodBadge = (rawData: any) => {
-    const items = rawData?.Items || [];
-    if (items.length === 0) return <span className="text-muted-foreground">—</span>;
-    
-    const calculationMethod = items[0]?.CalculationMethod;
+  const getCalculationMethodBadge = (receipt: Receipt) => {
+    const items = receipt.raw_data?.Items || [];
+    const calculationMethod = receipt.raw_data ? items[0]?.CalculationMethod : receipt.calculation_method;
+    if (receipt.raw_data ? items.length === 0 : calculationMethod == null) {
+      return <span className="text-muted-foreground">—</span>;
+    }
+
     const methodMap: Record<number, string> = {
       1: 'Предоплата 100%',
       2: 'Предоплата',
@@ -158,7 +171,7 @@ const ReceiptsPage = () => {
 
   const totalReceipts = receipts.length;
   const totalIncome = receipts.filter(r => r.operation_type === 'Income').length;
-  const totalSum = receipts.filter(r => r.operation_type === 'Income').reduce((sum, r) => sum + r.total_sum, 0);
+  const totalSum = receipts.filter(r => r.operation_type === 'Income').reduce((sum, r) => sum + r.total_kopecks, 0) / 100;
 
   const statusButtons = [
     { id: 'all', label: 'Все статусы', count: totalReceipts },
@@ -292,7 +305,7 @@ const ReceiptsPage = () => {
                       >
                         <TableCell>{getSourceBadge(receipt.source)}</TableCell>
                         <TableCell>
-                          {getReceiptTypeBadge(receipt.raw_data)}
+                          {getReceiptTypeBadge(receipt)}
                         </TableCell>
                         <TableCell className="text-sm">
                           {formatDateTime(receipt.document_datetime)}
@@ -301,7 +314,7 @@ const ReceiptsPage = () => {
                           {getOperationTypeBadge(receipt.operation_type)}
                         </TableCell>
                         <TableCell>
-                          {getCalculationMethodBadge(receipt.raw_data)}
+                          {getCalculationMethodBadge(receipt)}
                         </TableCell>
                         <TableCell className="font-mono text-sm">
                           {receipt.doc_number || '—'}
@@ -329,6 +342,7 @@ const ReceiptsPage = () => {
         receipt={selectedReceipt}
         open={showDetails}
         onOpenChange={setShowDetails}
+        ownerId={ownerId}
       />
     </div>
   );
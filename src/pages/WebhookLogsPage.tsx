@@ -19,29 +19,69 @@ interface WebhookLog {
   payment_status: string | null;
 }
 
+const LOGS_LIMIT = 100;
+const POLL_WAIT_SECONDS = 25;
+const POLL_RETRY_MS = 5000;
+
 export default function WebhookLogsPage() {
   const { integrationId } = useParams();
   const [logs, setLogs] = useState<WebhookLog[]>([]);
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
-    loadLogs();
-    const interval = setInterval(loadLogs, 5000);
-    return () => clearInterval(interval);
+    const controller = new AbortController();
+    pollLogs(controller.signal);
+    return () => controller.abort();
   }, [integrationId]);
 
-  const loadLogs = async () => {
+  const logsUrl = (params: string) => {
+    const ownerId = localStorage.getItem('user_id');
+    return `${functionUrls['webhook-logs']}?owner_id=${ownerId}&integration_id=${integrationId}&${params}`;
+  };
+
+  const pollLogs = async (signal: AbortSignal) => {
+    let cursor: number | null = null;
+
     try {
-      const ownerId = localStorage.getItem('user_id');
-      const url = `${functionUrls['webhook-logs']}?owner_id=${ownerId}&integration_id=${integrationId}&limit=100`;
-      const res = await fetch(url);
+      const res = await fetch(logsUrl(`limit=${LOGS_LIMIT}`), { signal });
+      if (!res.ok) throw new Error(`HTTP ${res.status}`);
       const data = await res.json();
       setLogs(data.logs || []);
+      cursor = data.cursor ?? 0;
     } catch (error) {
+      if (signal.aborted) return;
       console.error('Failed to load logs:', error);
     } finally {
       setLoading(false);
     }
+
+    // Long-poll: сервер держит запрос до новой переадресации, без повторной загрузки всего списка
+    while (!signal.aborted) {
+      try {
+        // Курсор ставится только по успешной загрузке: иначе since_id=0 отдал бы весь журнал как новые записи
+        if (cursor === null) {
+          const res = await fetch(logsUrl(`limit=${LOGS_LIMIT}`), { signal });
+          if (!res.ok) throw new Error(`HTTP ${res.status}`);
+          const data = await res.json();
+          setLogs(data.logs || []);
+          cursor = data.cursor ?? 0;
+          continue;
+        }
+
+        const res = await fetch(logsUrl(`since_id=${cursor}&wait=${POLL_WAIT_SECONDS}&limit=${LOGS_LIMIT}`), { signal });
+        if (!res.ok) throw new Error(`HTTP ${res.status}`);
+        const data = await res.json();
+        const fresh: WebhookLog[] = data.logs || [];
+        if (fresh.length > 0) {
+          setLogs((prev) => [...fresh.reverse(), ...prev].slice(0, LOGS_LIMIT));
+        }
+        cursor = data.cursor ?? cursor;
+      } catch (error) {
+        if (signal.aborted) return;
+        console.error('Failed to poll logs:', error);
+        await new Promise((resolve) => setTimeout(resolve, POLL_RETRY_MS));
+      }
+    }
   };
 
   const getStatusBadge = (statusCode: number | null) => {